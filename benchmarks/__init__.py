@@ -0,0 +1,7 @@
+'''
+Benchmarks for gs_calendar_base, runnable on a PC without extronlib.
+
+    python -m benchmarks.run --sizes 100 1000 10000 --output bench_output.txt
+
+See run.py for what is timed, stubs.py for the stand-ins used when extronlib/persistent_variables are not installed.
+'''
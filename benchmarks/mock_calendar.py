@@ -0,0 +1,52 @@
+'''
+An in-memory "server" and the _BaseCalendar subclass that syncs from it
+'''
+import itertools
+
+from gs_calendar_base import _BaseCalendar, _CalendarItem
+
+
+class InMemoryCalendar(_BaseCalendar):
+    '''
+    The server is a dict of event dicts (see synthetic.GenerateEvents), UpdateCalendar registers the ones in the window.
+    '''
+
+    def __init__(self, events=(), *a, **k):
+        self.serverEvents = {event['ItemId']: event for event in events}
+        self._newIds = itertools.count()
+        super().__init__(*a, **k)
+
+    def _MakeItem(self, event):
+        data = {key: value for key, value in event.items() if key not in ('Start', 'End')}
+        return _CalendarItem(event['Start'], event['End'], data, self)
+
+    def UpdateCalendar(self, calendar=None, startDT=None, endDT=None):
+        calItems = [
+            self._MakeItem(event) for event in self.serverEvents.values()
+            if (startDT is None or event['End'] >= startDT) and (endDT is None or event['Start'] <= endDT)
+        ]
+        if startDT is None or endDT is None:
+            starts = [item.Get('Start') for item in calItems] or [None]
+            ends = [item.Get('End') for item in calItems] or [None]
+            startDT = startDT or min(starts)
+            endDT = endDT or max(ends)
+
+        if startDT is not None:
+            self.RegisterCalendarItems(calItems, startDT, endDT)
+        self._NewConnectionStatus('Connected')
+
+    def CreateCalendarEvent(self, subject, body, startDT, endDT):
+        itemId = 'new{}'.format(next(self._newIds))
+        self.serverEvents[itemId] = {'ItemId': itemId, 'Subject': subject, 'Body': body, 'Start': startDT, 'End': endDT}
+        return itemId
+
+    def ChangeEventTime(self, calItem, newStartDT, newEndDT):
+        event = self.serverEvents[calItem.Get('ItemId')]
+        event['Start'] = newStartDT
+        event['End'] = newEndDT
+
+    def DeleteEvent(self, calItem):
+        self.serverEvents.pop(calItem.Get('ItemId'), None)
+
+    def GetAttachments(self, calItem):
+        return []
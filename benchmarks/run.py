@@ -0,0 +1,195 @@
+'''
+Times the sync, query, persistence and timezone paths of gs_calendar_base at several calendar sizes.
+
+    python -m benchmarks.run [--sizes 100 1000 10000 100000] [--repeat 5] [--output results.json]
+
+Prints a table to stderr and writes the results as json (to stdout or --output) so runs can be compared:
+    {"meta": {...}, "results": [{"name": "RegisterCalendarItems.new", "size": 1000, "seconds": 0.0123}, ...]}
+'seconds' is the best time of one call over the repeats.
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks import stubs
+
+stubs.Install()
+
+import gs_calendar_base  # noqa: E402
+from benchmarks.mock_calendar import InMemoryCalendar  # noqa: E402
+from benchmarks.synthetic import GenerateEvents, Mutate  # noqa: E402
+
+
+def Best(func, repeat, setup=None):
+    '''
+    :param func: called with the return value of setup() (or nothing)
+    :param repeat: int
+    :param setup: callable that is not timed
+    :return: float, the fastest call in seconds
+    '''
+    best = None
+    for i in range(repeat):
+        args = (setup(),) if setup else ()
+        startTime = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - startTime
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def Window(events):
+    return min(e['Start'] for e in events), max(e['End'] for e in events)
+
+
+def BenchSize(size, repeat, workDir):
+    results = []
+
+    def Record(name, seconds):
+        results.append({'name': name, 'size': size, 'seconds': seconds})
+        print('{:>8} {:<55} {:>12.6f}s'.format(size, name, seconds), file=sys.stderr)
+
+    events = GenerateEvents(size, seed=size)
+    startDT, endDT = Window(events)
+    changedEvents = Mutate(events, 0.05, seed=size)
+    slowRepeat = max(1, repeat // 2) if size >= 10000 else repeat
+
+    # sync #####################################################
+    calendar = InMemoryCalendar(events)
+    Record('_CalendarItem.build', Best(lambda: [calendar._MakeItem(e) for e in events], slowRepeat))
+
+    def NewCalendar():
+        cal = InMemoryCalendar(events)
+        return cal, [cal._MakeItem(e) for e in events]
+
+    Record('RegisterCalendarItems.new', Best(
+        lambda args: args[0].RegisterCalendarItems(args[1], startDT, endDT), slowRepeat, NewCalendar))
+
+    calendar.RegisterCalendarItems([calendar._MakeItem(e) for e in events], startDT, endDT)
+    Record('RegisterCalendarItems.unchanged', Best(
+        lambda items: calendar.RegisterCalendarItems(items, startDT, endDT),
+        slowRepeat,
+        lambda: [calendar._MakeItem(e) for e in events],
+    ))
+
+    def Changed():
+        cal, items = NewCalendar()
+        cal.RegisterCalendarItems(items, startDT, endDT)
+        return cal, [cal._MakeItem(e) for e in changedEvents]
+
+    Record('RegisterCalendarItems.10pct_changed', Best(
+        lambda args: args[0].RegisterCalendarItems(args[1], startDT, endDT), slowRepeat, Changed))
+
+    # queries ##################################################
+    middleDT = startDT + (endDT - startDT) / 2
+    middleDT = middleDT.replace(hour=10, minute=0, second=0, microsecond=0)
+    middleId = events[len(events) // 2]['ItemId']
+    queries = [
+        ('GetCalendarItemByID', lambda: calendar.GetCalendarItemByID(middleId)),
+        ('GetEventAtTime.datetime', lambda: calendar.GetEventAtTime(middleDT)),
+        ('GetEventAtTime.date', lambda: calendar.GetEventAtTime(middleDT.date())),
+        ('GetNowCalItems', calendar.GetNowCalItems),
+        ('GetNextCalItems', calendar.GetNextCalItems),
+        ('GetPreviousCalItems', calendar.GetPreviousCalItems),
+        ('GetEventsInRange.1day_cached', lambda: calendar.GetEventsInRange(
+            middleDT, middleDT + datetime.timedelta(days=1), update=False)),
+        ('GetCalendarItemsBySubject.exact', lambda: calendar.GetCalendarItemsBySubject(exactMatch='Design Review')),
+        ('GetCalendarItemsBySubject.partial', lambda: calendar.GetCalendarItemsBySubject(partialMatch='Review')),
+        ('GetAllEvents', calendar.GetAllEvents),
+    ]
+    for name, func in queries:
+        func()  # warm up, e.g. the subject index is built on first use
+        number = 100
+        Record(name, Best(lambda: [func() for i in range(number)], repeat) / number)
+
+    # persistence ##############################################
+    for mode, snapshotFormat in (('full', 'json'), ('full', 'binary'), ('journal', 'json')):
+        name = '{}.{}'.format(mode, snapshotFormat)
+        path = os.path.join(workDir, '{}_{}.json'.format(size, name))
+        kwargs = dict(persistentStorage=path, persistenceMode=mode, snapshotFormat=snapshotFormat)
+
+        saver = InMemoryCalendar(events, **kwargs)
+        saver.RegisterCalendarItems([saver._MakeItem(e) for e in events], startDT, endDT)
+
+        def Dirty():
+            saver._shouldSave = True
+            if mode == 'journal':
+                # every item changed since the last save, else each repeat after the first would append nothing
+                for calItem in saver.GetAllEvents():
+                    saver._JournalChange(calItem.Get('ItemId'), calItem)
+
+        Record('SaveCalendarItemsToFile.{}'.format(name), Best(
+            lambda ignored: saver.SaveCalendarItemsToFile(), slowRepeat, Dirty))
+
+        if mode == 'journal':
+            # the steady state: one item changed since the last save
+            def OneChange():
+                item = saver._MakeItem(dict(events[0], Subject=str(time.perf_counter())))
+                saver.RegisterCalendarItems([item], item.Get('Start'), item.Get('Start'))
+                saver.SaveCalendarItemsToFile()
+
+            Record('SaveCalendarItemsToFile.{}.one_change'.format(name), Best(OneChange, repeat))
+
+        saver.Flush()
+        saver._timerSaveToFile.Stop()
+
+        def Load():
+            loader = InMemoryCalendar((), **kwargs)
+            loader._timerSaveToFile.Stop()
+            return loader
+
+        Record('LoadCalendarItemsFromFile.{}'.format(name), Best(Load, slowRepeat))
+        Record('LoadCalendarItemsFromFile.{}+GetNextCalItems'.format(name), Best(
+            lambda: Load().GetNextCalItems(), slowRepeat))
+
+    # timezone #################################################
+    strings = [e['Start'].strftime('%Y-%m-%dT%H:%M:%SZ') for e in events]
+    Record('ConvertTimeStringToDatetime.each', Best(
+        lambda: [gs_calendar_base.ConvertTimeStringToDatetime(s) for s in strings], slowRepeat))
+    Record('ConvertTimeStringsToDatetimes.batch', Best(
+        lambda: gs_calendar_base.ConvertTimeStringsToDatetimes(strings), slowRepeat))
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=None, help='write the json here instead of stdout')
+    args = parser.parse_args(argv)
+
+    workDir = tempfile.mkdtemp(prefix='gs_calendar_bench_')
+    try:
+        results = []
+        for size in args.sizes:
+            results.extend(BenchSize(size, args.repeat, workDir))
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sizes': args.sizes,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+'''
+Local stand-ins for extronlib.system (File, ProgramLog, Timer, Wait) and persistent_variables.PersistentVariables,
+    so gs_calendar_base can be imported and timed on a PC.
+
+Call Install() before importing gs_calendar_base. The real modules are used if they can be imported.
+'''
+import json
+import os
+import sys
+import threading
+import time
+import types
+
+
+class File:
+    '''
+    Like extronlib.system.File, a thin wrapper around open()
+    '''
+
+    def __init__(self, Filename, mode='r', encoding=None, newline=None):
+        if 'b' in mode:
+            self._file = open(Filename, mode)
+        else:
+            self._file = open(Filename, mode, encoding=encoding, newline=newline)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+
+    @classmethod
+    def Exists(cls, path):
+        return os.path.exists(path)
+
+    @classmethod
+    def DeleteFile(cls, path):
+        os.remove(path)
+
+    @classmethod
+    def MakeDir(cls, path):
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def ListDir(cls, path='.'):
+        return os.listdir(path)
+
+
+def ProgramLog(Entry, Severity='error'):
+    print('ProgramLog({}): {}'.format(Severity, Entry), file=sys.stderr)
+
+
+class Timer:
+    '''
+    Like extronlib.system.Timer, starts running when created and calls Function(timer, count) every Interval seconds
+    '''
+
+    def __init__(self, Interval, Function):
+        self.Interval = Interval
+        self.Function = Function
+        self.Count = 0
+        self.State = 'Stopped'
+        self._generation = 0
+        self.Restart()
+
+    def _Run(self, generation):
+        while True:
+            time.sleep(self.Interval)
+            if generation != self._generation:
+                return
+            self.Count += 1
+            try:
+                self.Function(self, self.Count)
+            except Exception as e:
+                ProgramLog('Timer function raised {}'.format(e))
+
+    def Change(self, Interval):
+        self.Interval = Interval
+
+    def Restart(self):
+        self._generation += 1
+        self.Count = 0
+        self.State = 'Running'
+        threading.Thread(target=self._Run, args=(self._generation,), daemon=True).start()
+
+    def Resume(self):
+        if self.State != 'Running':
+            self._generation += 1
+            self.State = 'Running'
+            threading.Thread(target=self._Run, args=(self._generation,), daemon=True).start()
+
+    def Pause(self):
+        self.Stop()
+        self.State = 'Paused'
+
+    def Stop(self):
+        self._generation += 1
+        self.State = 'Stopped'
+
+
+class Wait:
+    '''
+    Like extronlib.system.Wait, calls Function() once after Time seconds
+    '''
+
+    def __init__(self, Time, Function):
+        self.Time = Time
+        self.Function = Function
+        self._timer = None
+        self.Restart()
+
+    def Cancel(self):
+        if self._timer:
+            self._timer.cancel()
+
+    def Change(self, Time):
+        self.Time = Time
+
+    def Restart(self):
+        self.Cancel()
+        self._timer = threading.Timer(self.Time, self.Function)
+        self._timer.daemon = True
+        self._timer.start()
+
+
+class PersistentVariables:
+    '''
+    Like persistent_variables.PersistentVariables, a json file of {name: value}
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def Get(self, varName=None, default=None):
+        data = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as file:
+                data = json.load(file)
+
+        if varName is None:
+            return data
+        return data.get(varName, default)
+
+    def Set(self, varName, varValue):
+        data = self.Get()
+        data[varName] = varValue
+        with open(self.filename, 'w') as file:
+            json.dump(data, file)
+
+
+def Install():
+    '''
+    Puts the stand-ins in sys.modules for any of the real modules that can't be imported
+    '''
+    try:
+        import extronlib.system
+    except ImportError:
+        extronlib = types.ModuleType('extronlib')
+        system = types.ModuleType('extronlib.system')
+        for obj in (File, ProgramLog, Timer, Wait):
+            setattr(system, obj.__name__, obj)
+        extronlib.system = system
+        sys.modules['extronlib'] = extronlib
+        sys.modules['extronlib.system'] = system
+
+    try:
+        import persistent_variables
+    except ImportError:
+        module = types.ModuleType('persistent_variables')
+        module.PersistentVariables = PersistentVariables
+        sys.modules['persistent_variables'] = module
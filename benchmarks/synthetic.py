@@ -0,0 +1,79 @@
+'''
+Deterministic synthetic calendars. The same seed always gives the same events.
+'''
+import datetime
+import random
+
+SUBJECTS = [
+    'Daily Standup',
+    'Sprint Planning',
+    'Design Review',
+    'Customer Call',
+    '1:1',
+    'All Hands',
+    'Interview',
+    'Lunch and Learn',
+    'Budget Review',
+    'Vendor Demo',
+]
+ORGANIZERS = ['Alex Smith', 'Sam Jones', 'Pat Lee', 'Chris Wong', 'Jordan Diaz', 'Taylor Kim']
+DURATIONS = [15, 30, 30, 30, 45, 60, 60, 90, 120]  # minutes, weighted towards the common ones
+
+
+def GenerateEvents(count, seed=0, startDT=None, roomName='Room 1', allDayEvery=200):
+    '''
+    Meetings on a 15 minute grid spread over enough days that each day has ~10 meetings.
+
+    :param count: int
+    :param seed: int
+    :param startDT: datetime, the first day, None means midnight today
+    :param roomName: str
+    :param allDayEvery: int, every Nth event is a multi-day event, 0 for none
+    :return: list of dicts like {'Start': datetime, 'End': datetime, 'ItemId': str, 'Subject': str, ...}
+    '''
+    rand = random.Random(seed)
+    if startDT is None:
+        startDT = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    days = max(1, count // 10)
+    events = []
+    for i in range(count):
+        dayDT = startDT + datetime.timedelta(days=rand.randrange(days))
+        eventStartDT = dayDT + datetime.timedelta(hours=7, minutes=15 * rand.randrange(44))
+
+        if allDayEvery and i % allDayEvery == allDayEvery - 1:
+            eventStartDT = dayDT
+            eventEndDT = dayDT + datetime.timedelta(days=rand.randint(2, 5))
+        else:
+            eventEndDT = eventStartDT + datetime.timedelta(minutes=rand.choice(DURATIONS))
+
+        events.append({
+            'Start': eventStartDT,
+            'End': eventEndDT,
+            'ItemId': 'AAMkAG{:08d}{:016x}'.format(i, rand.getrandbits(64)),
+            'Subject': rand.choice(SUBJECTS),
+            'OrganizerName': rand.choice(ORGANIZERS),
+            'RoomName': roomName,
+            'LocationId': roomName.lower().replace(' ', '-'),
+            'HasAttachments': rand.random() < 0.05,
+        })
+    return events
+
+
+def Mutate(events, fraction, seed=0):
+    '''
+    :param events: list from GenerateEvents
+    :param fraction: float, about this fraction of the events get a new subject, and the same fraction are removed
+    :param seed: int
+    :return: new list, the originals are not changed
+    '''
+    rand = random.Random(seed)
+    ret = []
+    for event in events:
+        roll = rand.random()
+        if roll < fraction:
+            continue  # deleted
+        elif roll < fraction * 2:
+            event = dict(event, Subject=event['Subject'] + ' (moved)')
+        ret.append(event)
+    return ret
@@ -0,0 +1,208 @@
+import asyncio
+import datetime
+import random
+
+from gs_calendar_base import _BaseCalendar
+
+try:
+    from extronlib_pro import ProgramLog
+except:
+    from extronlib.system import ProgramLog
+
+
+class _AsyncBaseCalendar(_BaseCalendar):
+    '''
+    The asyncio counterpart of _BaseCalendar.
+    The override points are coroutines, so one event loop can talk to the servers of many rooms at the same time
+        instead of needing a thread per room.
+
+    The in memory queries (GetNowCalItems, GetNextCalItems, GetEventAtTime, GetCalendarItemByID...),
+        RegisterCalendarItems, the callbacks and the persistence are the same as _BaseCalendar.
+    The queries that may need the server (GetEventsInRange, GetCalendarItemsBySubject) must be awaited.
+    The Queue* methods must be called from the event loop, and WaitForWrites must be awaited.
+
+    Example:
+    class ExchangeCalendar(_AsyncBaseCalendar):
+        async def UpdateCalendar(self, calendar=None, startDT=None, endDT=None):
+            calItems = await self._FetchItems(startDT, endDT)  # using an async http client
+            self.RegisterCalendarItems(calItems, startDT, endDT)
+            self._NewConnectionStatus('Connected')
+
+    loop.run_until_complete(PollCalendars(calendars, interval=60, concurrency=20))
+    '''
+
+    async def UpdateCalendar(self, calendar=None, startDT=None, endDT=None):
+        '''
+        Subclasses should override this
+
+        :param calendar: a particular calendar ( None means use the default calendar)
+        :param startDT: only search for events after this date
+        :param endDT: only search for events before this date
+        :return:
+        '''
+        raise NotImplementedError
+
+    async def CreateCalendarEvent(self, subject, body, startDT, endDT):
+        '''
+        Subclasses should override this
+
+        Create a new calendar item with the above info
+
+        :param subject:
+        :param body:
+        :param startDT:
+        :param endDT:
+        :return:
+        '''
+        raise NotImplementedError
+
+    async def ChangeEventTime(self, calItem, newStartDT, newEndDT):
+        '''
+        Subclasses should override this
+
+        Changes the time of a current event
+
+        :param calItem:
+        :param newStartDT:
+        :param newEndDT:
+        :return:
+        '''
+        raise NotImplementedError
+
+    async def DeleteEvent(self, calItem):
+        '''
+        Subclasses should override this
+
+        Deletes an event from the server
+
+        :param calItem:
+        :return:
+        '''
+        raise NotImplementedError
+
+    # Dont override these below (unless you dare) #########################
+
+    async def GetCalendarItemsBySubject(self, exactMatch=None, partialMatch=None):
+        with self._metrics.Measure('query.GetCalendarItemsBySubject'):
+            ret = self._index.BySubject(exactMatch, partialMatch)
+        if ret:
+            ret = await self._UpdateItemsFromServer(ret)
+        return ret
+
+    async def _UpdateItemsFromServer(self, calItems):
+        '''
+        Subclasses can override this to refresh several items with one request to the server
+
+        :param calItems: list of CalendarItem objects
+        :return: list of the refreshed CalendarItem objects
+        '''
+        if hasattr(self, '_UpdateItemFromServer'):
+            # subclasses that only know how to refresh one item at a time, refresh them all at once
+            return list(await asyncio.gather(*(self._UpdateItemFromServer(calItem) for calItem in calItems)))
+        return calItems
+
+    # The Queue* methods work as in _BaseCalendar, call them from the event loop (a coroutine or a callback).
+    # The writes are still sent one at a time by the write thread, it runs the overrides on that event loop.
+
+    def _QueueWrite(self, kind, itemId, original, current, local):
+        self._writeEventLoop = asyncio.get_running_loop()  # RuntimeError if not called from the event loop
+        _BaseCalendar._QueueWrite(self, kind, itemId, original, current, local)
+
+    def _SendWrite(self, write):
+        # on the write thread, _BaseCalendar._SendWrite returns the coroutine of the override
+        coroutine = _BaseCalendar._SendWrite(self, write)
+        return asyncio.run_coroutine_threadsafe(coroutine, self._writeEventLoop).result()
+
+    async def WaitForWrites(self, timeout=None):
+        '''
+        Waits until every queued write has been sent (or given up on), including the retries.
+
+        :param timeout: float seconds, None waits forever
+        :return: bool, False if it timed out
+        '''
+        # the writes need the event loop, so wait on another thread
+        return await asyncio.get_running_loop().run_in_executor(None, _BaseCalendar.WaitForWrites, self, timeout)
+
+    async def GetEventsInRange(self, startDT, endDT, update=True):
+        '''
+
+        :param startDT:
+        :param endDT:
+        :param update: bool, False returns what is already in memory without asking the server
+        :return: list of CalendarItem objects, maybe be empty
+        '''
+        if update:
+            # the missing parts of the window are fetched at the same time
+            await asyncio.gather(*(
+                self.UpdateCalendar(startDT=missingStartDT, endDT=missingEndDT)
+                for missingStartDT, missingEndDT in self._MissingRanges(startDT, endDT)
+            ))
+
+        with self._metrics.Measure('query.GetEventsInRange'):
+            return self._index.Range(startDT, endDT)
+
+
+async def UpdateCalendars(calendars, concurrency=20, startDT=None, endDT=None):
+    '''
+    Update many _AsyncBaseCalendar at once, with at most concurrency requests in flight.
+
+    :param calendars: list of _AsyncBaseCalendar
+    :param concurrency: int
+    :param startDT: passed to UpdateCalendar
+    :param endDT: passed to UpdateCalendar
+    :return: list of the same length as calendars, None if that calendar updated or the Exception it raised
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def Update(calendar):
+        async with semaphore:
+            try:
+                await calendar.UpdateCalendar(startDT=startDT, endDT=endDT)
+            except asyncio.CancelledError:
+                raise  # an Exception before python 3.8
+            except Exception as e:
+                ProgramLog('UpdateCalendars: Error updating {}: {}'.format(calendar, e), 'error')
+                return e
+
+    return list(await asyncio.gather(*(Update(calendar) for calendar in calendars)))
+
+
+async def PollCalendars(calendars, interval=60, concurrency=20, jitter=0.1, window=None):
+    '''
+    Keep many _AsyncBaseCalendar up to date forever, the asyncio version of gs_calendar_pool.CalendarPool.
+    Cancel the task to stop polling.
+
+    :param calendars: list of _AsyncBaseCalendar
+    :param interval: float, seconds between polls of each calendar
+    :param concurrency: int, the most UpdateCalendar calls in flight at the same time
+    :param jitter: float, each interval is randomly changed by up to this fraction so the polls don't line up
+    :param window: None or tuple of (timedelta before now, timedelta after now)
+        None calls UpdateCalendar() with no arguments
+        else calls UpdateCalendar(startDT=now - before, endDT=now + after)
+    :return:
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def Poll(calendar):
+        # the first poll of each calendar is spread randomly over one interval so they don't all happen at once
+        await asyncio.sleep(random.uniform(0, interval))
+        while True:
+            async with semaphore:
+                try:
+                    if window is None:
+                        await calendar.UpdateCalendar()
+                    else:
+                        before, after = window
+                        nowDT = datetime.datetime.now()
+                        await calendar.UpdateCalendar(
+                            startDT=nowDT - before,
+                            endDT=nowDT + after,
+                        )
+                except asyncio.CancelledError:
+                    raise  # an Exception before python 3.8
+                except Exception as e:
+                    ProgramLog('PollCalendars: Error updating {}: {}'.format(calendar, e), 'error')
+
+            await asyncio.sleep(interval * (1 + random.uniform(-jitter, jitter)))
+
+    await asyncio.gather(*(Poll(calendar) for calendar in calendars))
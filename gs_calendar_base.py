@@ -1,6 +1,18 @@
+import atexit
+from array import array
 import datetime
-from collections import defaultdict
+import hashlib
+from collections import OrderedDict, defaultdict
+from collections.abc import ItemsView, KeysView, MutableMapping, ValuesView
+from bisect import bisect_left, bisect_right
+import itertools
+import json
+import queue
+import struct
+import sys
+import threading
 import time
+import weakref
 
 try:
     from extronlib_pro import File, ProgramLog, Timer
@@ -17,6 +29,20 @@ class _CalendarItem:
     '''
     An object to represent an event on the calendar
     '''
+    # thousands of these are kept in memory, __slots__ drops the per-instance __dict__
+    __slots__ = (
+        'debug',
+        '_schema',  # the data keys, shared with every item that has the same keys, see _Schema
+        '_values',  # tuple of the data values, in the order of _schema.keys
+        '_startDT',
+        '_endDT',
+        '_duration',
+        '_hasAttachments',
+        '_parentExchange',
+        '_fingerprint',
+        '_dataCache',
+        '_dictCache',
+    )
 
     def __init__(self, startDT, endDT, data, parentCalendar, debug=False):
         '''
@@ -31,30 +57,93 @@ class _CalendarItem:
 
         if data is None:
             data = {}
-        self.print('_CalendarItem data=', data)
-        self._data = data.copy()  # dict like {'ItemId': 'jasfsd', 'Subject': 'SuperMeeting', ...}
+        if debug:
+            print('_CalendarItem data=', data)
+        data = data.copy()  # dict like {'ItemId': 'jasfsd', 'Subject': 'SuperMeeting', ...}
 
+        # the start/end are never reassigned, so the duration only needs to be calculated once
         self._startDT = startDT
         self._endDT = endDT
-
-        if 'Duration' not in self._data:
-            self._CalculateDuration()
+        self._duration = (endDT - startDT).total_seconds()  # float in seconds
+        data['Duration'] = self._duration
+        self._SetData(data)
 
         self._hasAttachments = data.get('HasAttachments', False)
         self._parentExchange = parentCalendar
 
+        self._dataCache = None  # .Data and .dict() are built on first use
+        self._dictCache = None
+        self._fingerprint = None  # calculated the first time it is compared, most items never are
+
     def print(self, *a, **k):
         if self.debug:
             print(*a, **k)
 
+    def _SetData(self, data):
+        # the keys become a shared _Schema and the values a tuple, repeated strings are interned
+        self._schema = _SchemaFor(tuple(data))
+        self._values = tuple(_Intern(value) for value in data.values())
+
+    def _DataDict(self):
+        return dict(zip(self._schema.keys, self._values))
+
+    def _ExportData(self):
+        # a new dict of the data, without filling the .Data/.dict() caches. see _BaseCalendar.ExportNDJSON
+        return self._DataDict()
+
+    def _FrozenData(self):
+        # (sorted keys, values in that order), so items with the same data in a different key order are equal.
+        # The sorted keys are shared with the _Schema, so this is a fraction of the size of _Freeze(dict)
+        schema = self._schema
+        if schema.order is None:
+            return _Freeze(self._DataDict())  # keys that can't be sorted
+        values = self._values
+        return schema.sortedKeys, tuple(
+            values[i] if type(values[i]) in _SCALARS else _Freeze(values[i]) for i in schema.order
+        )
+
+    @property
+    def Recurrence(self):
+        # the rule dict if this item is the master of a recurring series, see _Recurrence. else None
+        return self.Get('Recurrence')
+
     def AddData(self, key, value):
-        self._data[key] = value
+        i = self._schema.positions.get(key, None)
+        if i is None:
+            self._schema = self._schema.With(key)
+            self._values = self._values + (_Intern(value),)
+        elif self._values[i] == value:
+            return  # nothing changed, keep the fingerprint
+        else:
+            self._values = self._values[:i] + (_Intern(value),) + self._values[i + 1:]
+
+        self._fingerprint = None  # recalculated the next time it is needed
+        self._dataCache = None
+        self._dictCache = None
+
+    def _CalculateFingerprint(self):
+        # A summary of everything that self.Data depends on, calculated once instead of on every comparison.
+        # Two items have the same fingerprint exactly when their .Data is equal.
+        # The utcoffset is included because .Data holds the isoformat() which shows the offset.
+        # Start_ISO/End_ISO are never kept as data (see _DERIVED_KEYS), so the data can be used as it is.
+        frozen = (
+            self._startDT,
+            self._startDT.utcoffset() if self._startDT else None,
+            self._endDT,
+            self._endDT.utcoffset() if self._endDT else None,
+            self._FrozenData(),
+        )
+        return hash(frozen), frozen
+
+    @property
+    def Fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = self._CalculateFingerprint()
+        return self._fingerprint
 
     def _CalculateDuration(self):
         # Returns float in seconds
-        delta = self.Get('End') - self.Get('Start')
-        duration = delta.total_seconds()
-        self.AddData('Duration', duration)
+        self.AddData('Duration', self._duration)
 
     def Get(self, key):
         if key == 'Start':
@@ -62,10 +151,10 @@ class _CalendarItem:
         elif key == 'End':
             return self._endDT
         elif key == 'Duration':
-            self._CalculateDuration()
-            return self._data.get(key, None)
+            return self._duration
         else:
-            return self._data.get(key, None)
+            i = self._schema.positions.get(key, None)
+            return None if i is None else self._values[i]
 
     def get(self, key):
         return self.Get(key)
@@ -121,23 +210,27 @@ class _CalendarItem:
 
     @property
     def Attachments(self):
-        return self._parentExchange.GetAttachments(self)
+        return self._parentExchange._AttachmentsFor(self)
 
     def HasAttachments(self):
         return self._hasAttachments
 
     @property
     def Data(self):
-        ret = self._data.copy()
-        if self.Get('Start'):
-            ret['Start_ISO'] = self.Get('Start').isoformat()
-        if self.Get('End'):
-            ret['End_ISO'] = self.Get('End').isoformat()
-        self.print('Data=', ret)
-        return ret
+        if self._dataCache is None:
+            ret = self._DataDict()
+            if self.Get('Start'):
+                ret['Start_ISO'] = self.Get('Start').isoformat()
+            if self.Get('End'):
+                ret['End_ISO'] = self.Get('End').isoformat()
+            if self.debug:
+                print('Data=', ret)
+            self._dataCache = ret
+
+        return self._dataCache.copy()  # a copy, so the caller can't change the memoized one
 
     def __iter__(self):
-        for k, v in self._data.items():
+        for k, v in zip(self._schema.keys, self._values):
             yield k, v
 
         for key in ['Start', 'End', 'Duration']:
@@ -145,17 +238,18 @@ class _CalendarItem:
 
     def dict(self):
         # a json safe dict()
-        ret = {}
-        for k, v in self.Data.items():
-            ret[k] = v
+        if self._dictCache is None:
+            ret = self.Data
 
-        for key in ['Duration']:
-            ret[key] = self.Get(key)
+            for key in ['Duration']:
+                ret[key] = self.Get(key)
 
-        for key in ['Start', 'End']:
-            ret[key] = self.Get(key).timestamp()
+            for key in ['Start', 'End']:
+                ret[key] = self.Get(key).timestamp()
 
-        return ret
+            self._dictCache = ret
+
+        return self._dictCache.copy()
 
     def __str__(self):
         return '<CalendarItem: Start={}, End={}, Duration={}, Subject={}, HasAttachements={}, OrganizerName={}, ItemId[:10]={}, RoomName={}, LocationId={}>'.format(
@@ -174,9 +268,12 @@ class _CalendarItem:
         return str(self)
 
     def __eq__(self, other):
-        # print('188 __eq__ \nself.Data =', self.Data, ',\nother.Data=', other.Data)
+        if not isinstance(other, _CalendarItem):
+            return NotImplemented
+
+        # the hash is compared first so different items are usually told apart without comparing the data
         return self.Get('ItemId') == other.Get('ItemId') and \
-               self.Data == other.Data
+               self.Fingerprint == other.Fingerprint
 
     def __lt__(self, other):
         # print('214 __gt__', self, other)
@@ -224,23 +321,1699 @@ class _CalendarItem:
         elif isinstance(other, _CalendarItem):
             return self._endDT > other._endDT
 
-        else:
-            raise TypeError('unorderable types: {} < {}'.format(self, other))
+        else:
+            raise TypeError('unorderable types: {} < {}'.format(self, other))
+
+    def __ge__(self, other):
+        # print('223 __ge__', self, other)
+
+        if isinstance(other, datetime.datetime):
+            # if other.tzinfo is None and self._endDT.tzinfo is not None:
+            #     # other is naive, assume its in local system timezone
+            #     other = other.astimezone()
+
+            return self._endDT >= other
+        elif isinstance(other, _CalendarItem):
+            return self._endDT >= other._endDT
+
+        else:
+            raise TypeError('unorderable types: {} < {}'.format(self, other))
+
+
+class _LazyCalendarItem(_CalendarItem):
+    '''
+    A _CalendarItem loaded from a binary snapshot.
+    The start/end/ItemId are known right away, the rest of the data is decoded the first time it is needed.
+    '''
+    __slots__ = ('_payload',)
+
+    def __init__(self, startDT, endDT, itemId, payload, parentCalendar):
+        '''
+        :param startDT:
+        :param endDT:
+        :param itemId:
+        :param payload: bytes-like, the json encoded data (without Start/End/ItemId)
+        :param parentCalendar:
+        '''
+        self.debug = False
+        self._startDT = startDT
+        self._endDT = endDT
+        self._duration = (endDT - startDT).total_seconds()
+        self._schema = _LAZY_SCHEMA
+        self._values = (itemId, self._duration)
+        self._payload = payload
+        self._hasAttachments = False
+        self._parentExchange = parentCalendar
+        self._dataCache = None
+        self._dictCache = None
+        self._fingerprint = None
+
+    def _Decode(self):
+        if self._payload is not None:
+            data = json.loads(bytes(self._payload).decode('utf-8'))
+            for key in _DERIVED_KEYS:
+                data.pop(key, None)  # older snapshots have them
+            data.update(zip(self._schema.keys, self._values))
+            self._SetData(data)
+            self._hasAttachments = data.get('HasAttachments', False)
+            self._payload = None
+
+    def AddData(self, key, value):
+        self._Decode()
+        _CalendarItem.AddData(self, key, value)
+
+    def _CalculateFingerprint(self):
+        self._Decode()
+        return _CalendarItem._CalculateFingerprint(self)
+
+    def Get(self, key):
+        if self._payload is not None and key not in self._schema.positions and key not in ('Start', 'End'):
+            self._Decode()
+        return _CalendarItem.Get(self, key)
+
+    def HasAttachments(self):
+        self._Decode()
+        return self._hasAttachments
+
+    @property
+    def Recurrence(self):
+        return None  # series masters are never stored lazily, see _DumpSnapshot
+
+    def _ExportData(self):
+        if self._payload is None:
+            return _CalendarItem._ExportData(self)
+        # decoded just for the caller, the item stays undecoded
+        data = json.loads(bytes(self._payload).decode('utf-8'))
+        for key in _DERIVED_KEYS:
+            data.pop(key, None)
+        data.update(zip(self._schema.keys, self._values))
+        return data
+
+    @property
+    def Data(self):
+        self._Decode()
+        return _CalendarItem.Data.fget(self)
+
+    def __iter__(self):
+        self._Decode()
+        return _CalendarItem.__iter__(self)
+
+
+class _Schema:
+    '''
+    The data keys of a _CalendarItem.
+    Items with the same keys share one _Schema and keep only a tuple of values,
+        instead of each having a dict with its own copy of every key.
+    '''
+    __slots__ = ('keys', 'positions', 'order', 'sortedKeys', '_extended')
+
+    def __init__(self, keys):
+        self.keys = keys  # tuple
+        self.positions = {key: i for i, key in enumerate(keys)}
+        try:
+            # for _CalendarItem._FrozenData
+            self.order = tuple(sorted(range(len(keys)), key=keys.__getitem__))
+            self.sortedKeys = tuple(keys[i] for i in self.order)
+        except TypeError:
+            self.order = None
+            self.sortedKeys = None
+        self._extended = {}  # {key: _Schema} the schemas with one more key, for AddData()
+
+    def With(self, key):
+        # the schema with key added at the end
+        schema = self._extended.get(key, None)
+        if schema is None:
+            schema = self._extended[key] = _SchemaFor(self.keys + (key,))
+        return schema
+
+
+_schemas = {}  # {keys tuple: _Schema}
+_MAX_SCHEMAS = 1000  # items with unusual keys still work after this, they just don't share a _Schema
+_MAX_INTERN_LENGTH = 200  # longer strings (like a Body) are rarely repeated, they are not interned
+
+
+def _SchemaFor(keys):
+    schema = _schemas.get(keys, None)
+    if schema is None:
+        schema = _Schema(tuple(_Intern(key) for key in keys))
+        if len(_schemas) < _MAX_SCHEMAS:
+            _schemas[schema.keys] = schema
+    return schema
+
+
+def _Intern(value):
+    # Room names, organizers, the subject of a series... are repeated in thousands of items,
+    #   interned they are one str in memory. Interned strings are freed when no item uses them.
+    if type(value) is str and len(value) <= _MAX_INTERN_LENGTH:
+        return sys.intern(value)
+    return value
+
+
+_LAZY_SCHEMA = _SchemaFor(('ItemId', 'Duration'))
+_SCALARS = frozenset([str, int, float, bool, type(None)])  # hashable as is, no need to _Freeze
+
+# keys of _CalendarItem.dict() that are made from the start/end, they are not saved/loaded as data.
+# (kept as data they would take up room in every item, and the fingerprint would have to skip them)
+_DERIVED_KEYS = ('Start', 'End', 'Start_ISO', 'End_ISO')
+
+
+def _Freeze(value):
+    # returns a hashable copy of value that is == to another frozen value when the originals are ==
+    if isinstance(value, dict):
+        return frozenset((k, _Freeze(v)) for k, v in value.items())
+    elif isinstance(value, list):
+        return list, tuple(_Freeze(v) for v in value)
+    elif isinstance(value, tuple):
+        return tuple, tuple(_Freeze(v) for v in value)
+    elif isinstance(value, (set, frozenset)):
+        return frozenset, frozenset(_Freeze(v) for v in value)
+
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+
+class _CalendarIndex:
+    '''
+    Keeps the items of a calendar sorted by start and by end so the time queries can bisect
+    instead of testing every item.
+
+    Events longer than LONG_EVENT are also kept in a small side table,
+        that way a point/range query only has to look back LONG_EVENT from its start
+        and the cost stays O(log n + k) even with thousands of cached events.
+    '''
+    LONG_EVENT = datetime.timedelta(days=1)
+
+    def __init__(self):
+        self._seq = 0
+        self._order = _LayeredDict()  # {itemId: seq} , seq is the order the item was first registered in
+        self._items = _LayeredDict()  # {itemId: calItem} the item as it was indexed
+        self._starts = _SortedEntries()  # (startDT, seq, calItem) sorted
+        self._ends = _SortedEntries()  # (endDT, seq, calItem) sorted
+        self._long = {}  # {seq: calItem} for items longer than LONG_EVENT
+        self._series = {}  # {seq: _Recurrence} for the masters of recurring series, they are not in _starts/_ends
+        # _SubjectIndex, built the first time someone searches by subject. Shared by the copies and never changed,
+        #   each copy keeps the subjects that changed since in _subjectChanges, see _SubjectChanged
+        self._subjects = None
+        self._subjectChanges = {}  # {itemId: subject or _REMOVED}, always empty while _subjects is None
+
+    def __len__(self):
+        return len(self._order)
+
+    def Add(self, calItem):
+        # also used to replace an item that has changed, the item keeps its original position
+        itemId = calItem.Get('ItemId')
+        if itemId in self._order:
+            seq = self._order[itemId]
+            self._Unindex(itemId, seq)
+        else:
+            self._seq += 1
+            seq = self._seq
+            self._order[itemId] = seq
+
+        startDT = calItem.Get('Start')
+        endDT = calItem.Get('End')
+        self._items[itemId] = calItem
+
+        if calItem.Recurrence:
+            self._series[seq] = _Recurrence(calItem)
+        else:
+            self._starts.Insert((startDT, seq, calItem))
+            self._ends.Insert((endDT, seq, calItem))
+            if endDT - startDT > self.LONG_EVENT:
+                self._long[seq] = calItem
+
+        self._SubjectChanged(itemId, calItem)
+
+    def AddMany(self, calItems):
+        # same as calling Add() for each item, but sorts once at the end. Used when loading from disk.
+        self.Apply(calItems, ())
+
+    def Apply(self, upserts, deleteIds):
+        '''
+        Add/replace the upserts and remove the deleteIds.
+        A few changes are inserted one at a time, lots of changes are appended and sorted once.
+
+        :param upserts: list of CalendarItem objs, with unique ItemIds
+        :param deleteIds: iterable of ItemIds
+        :return:
+        '''
+        deleteIds = set(deleteIds)
+        if deleteIds:
+            # a delete wins over an upsert of the same id, like _CalendarSnapshot.Apply, whichever path is taken
+            upserts = [calItem for calItem in upserts if calItem.Get('ItemId') not in deleteIds]
+
+        if len(upserts) + len(deleteIds) < 32 + len(self._starts) // 16:
+            for calItem in upserts:
+                self.Add(calItem)
+            for itemId in deleteIds:
+                self.Remove(itemId)
+            return
+
+        dropped = set()  # seqs whose old entries must be removed from the sorted lists
+        for itemId in deleteIds:
+            seq = self._order.pop(itemId, None)
+            if seq is not None:
+                dropped.add(seq)
+                self._items.pop(itemId)
+                self._long.pop(seq, None)
+                self._series.pop(seq, None)
+                self._SubjectChanged(itemId, None)
+
+        newStarts = []
+        newEnds = []
+        for calItem in upserts:
+            itemId = calItem.Get('ItemId')
+            if itemId in self._order:
+                seq = self._order[itemId]  # a changed item keeps its position
+                dropped.add(seq)
+                self._long.pop(seq, None)
+                self._series.pop(seq, None)
+            else:
+                self._seq += 1
+                seq = self._seq
+                self._order[itemId] = seq
+
+            startDT = calItem.Get('Start')
+            endDT = calItem.Get('End')
+            self._items[itemId] = calItem
+            if calItem.Recurrence:
+                self._series[seq] = _Recurrence(calItem)
+            else:
+                newStarts.append((startDT, seq, calItem))
+                newEnds.append((endDT, seq, calItem))
+                if endDT - startDT > self.LONG_EVENT:
+                    self._long[seq] = calItem
+            self._SubjectChanged(itemId, calItem)
+
+        # seq is unique so the calItems are never compared
+        starts = [entry for entry in self._starts if entry[1] not in dropped]
+        starts.extend(newStarts)
+        starts.sort(key=_EntryKey)
+        self._starts = _SortedEntries(starts)
+        ends = [entry for entry in self._ends if entry[1] not in dropped]
+        ends.extend(newEnds)
+        ends.sort(key=_EntryKey)
+        self._ends = _SortedEntries(ends)
+
+    def Copy(self):
+        # A copy that can be changed without affecting this one.
+        # The subject index is shared, only the changes made since it was built are copied.
+        ret = _CalendarIndex.__new__(_CalendarIndex)
+        ret._seq = self._seq
+        ret._order = self._order.Copy()
+        ret._items = self._items.Copy()
+        ret._starts = self._starts.Copy()
+        ret._ends = self._ends.Copy()
+        ret._long = self._long.copy()
+        ret._series = self._series.copy()  # the _Recurrence objs never change, they can be shared
+        ret._subjects = self._subjects
+        ret._subjectChanges = self._subjectChanges.copy()
+        return ret
+
+    def Remove(self, itemId):
+        seq = self._order.pop(itemId, None)
+        if seq is not None:
+            self._Unindex(itemId, seq)
+
+    def _Unindex(self, itemId, seq):
+        calItem = self._items.pop(itemId)
+        self._starts.Remove(calItem.Get('Start'), seq)
+        self._ends.Remove(calItem.Get('End'), seq)
+        self._long.pop(seq, None)
+        self._series.pop(seq, None)
+        self._SubjectChanged(itemId, None)
+
+    def _SubjectChanged(self, itemId, calItem):
+        # calItem is None when it was removed
+        if self._subjects is None:
+            return  # not built yet, it will be built from the items
+
+        self._subjectChanges[itemId] = calItem.Get('Subject') if calItem is not None else _REMOVED
+        if len(self._subjectChanges) > 64 + len(self._subjects) // 64:
+            # fold the changes into a new shared index, the old one may still be used by older copies
+            subjects = self._subjects.Copy()
+            for thisItemId, subject in self._subjectChanges.items():
+                if subject is _REMOVED:
+                    subjects.Remove(thisItemId)
+                else:
+                    subjects.Add(thisItemId, subject)
+            self._subjects = subjects
+            self._subjectChanges = {}
+
+    def BySubject(self, exactMatch=None, partialMatch=None):
+        '''
+        Same result as [item for item in items if item.Subject == exactMatch or partialMatch in item.Subject]
+
+        :return: list of CalendarItem objs, may be empty
+        '''
+        subjects = self._subjects
+        changes = self._subjectChanges
+        if subjects is None:
+            # built on first use so loading from disk doesn't have to decode every subject.
+            # it matches this index's items, so it can be kept even though this index may already be published
+            subjects = _SubjectIndex()
+            for itemId, calItem in self._items.items():
+                subjects.Add(itemId, calItem.Get('Subject'))
+            self._subjects = subjects
+
+        found = {}
+        for itemId in subjects.Find(exactMatch, partialMatch):
+            if itemId not in changes:
+                found[self._order[itemId]] = self._items[itemId]
+        for itemId, subject in changes.items():
+            if subject is not _REMOVED and _SubjectMatches(subject, exactMatch, partialMatch):
+                found[self._order[itemId]] = self._items[itemId]
+        return self._Sorted(found)
+
+    def _Sorted(self, found):
+        # found is {seq: calItem}, return the items in the same order the dict of items would have them
+        return [found[seq] for seq in sorted(found)]
+
+    def _Overlapping(self, startDT, endDT, expand=True):
+        # returns {seq: calItem} for items where item.End >= startDT and item.Start <= endDT
+        # expand=True returns the occurrences of recurring series, False returns their masters
+        found = {}
+        for thisStartDT, seq, calItem in self._starts.Between((startDT - self.LONG_EVENT,), (endDT, _INFINITY)):
+            if calItem.Get('End') >= startDT:
+                found[seq] = calItem
+
+        for seq, calItem in self._long.items():
+            if calItem.Get('Start') <= endDT and calItem.Get('End') >= startDT:
+                found[seq] = calItem
+
+        for seq, recurrence in self._series.items():
+            if expand:
+                _AddOccurrences(found, seq, recurrence.Occurrences(startDT, endDT))
+            elif recurrence.Overlaps(startDT, endDT):
+                found[seq] = recurrence.master
+
+        return found
+
+    def At(self, dt):
+        '''
+        Same result as [item for item in items if dt in item]
+
+        :param dt: datetime.date or datetime.datetime
+        :return: list of CalendarItem objs, may be empty
+        '''
+        if isinstance(dt, datetime.datetime):
+            found = self._Overlapping(dt, dt)
+
+        else:
+            # a date matches items that start or end on that day.
+            # widen the window by a day on each side so aware datetimes are not clipped, then filter exactly
+            dayStartDT = datetime.datetime(dt.year, dt.month, dt.day, tzinfo=self._TimeZone())
+            lowDT = dayStartDT - datetime.timedelta(days=1)
+            highDT = dayStartDT + datetime.timedelta(days=2)
+
+            found = {}
+            for keys in (self._starts, self._ends):
+                for thisDT, seq, calItem in keys.Between((lowDT,), (highDT,)):
+                    found[seq] = calItem
+            for seq, recurrence in self._series.items():
+                _AddOccurrences(found, seq, recurrence.Occurrences(lowDT, highDT))
+
+        return [calItem for calItem in self._Sorted(found) if dt in calItem]
+
+    def _TimeZone(self):
+        # the tzinfo the items share, None if they are naive or there are none
+        first = self._starts.First()
+        if first is not None:
+            return first[0].tzinfo
+        for recurrence in self._series.values():
+            return recurrence.master.Get('Start').tzinfo
+        return None
+
+    def Range(self, startDT, endDT, expand=True):
+        '''
+        Same result as [item for item in items if startDT <= item <= endDT]
+
+        :param startDT:
+        :param endDT:
+        :param expand: bool, True returns the occurrences of recurring series, False returns their masters
+        :return: list of CalendarItem objs, may be empty
+        '''
+        return self._Sorted(self._Overlapping(startDT, endDT, expand))
+
+    def Next(self, dt):
+        '''
+        The item(s) with the soonest start after dt. Items that start at the same time are returned together.
+
+        :param dt: datetime.datetime
+        :return: list of CalendarItem objs, may be empty
+        '''
+        first = self._starts.First((dt, _INFINITY))
+        nextStartDT = first[0] if first is not None else None
+
+        occurrences = {}  # {seq: calItem} the next occurrence of each series
+        for seq, recurrence in self._series.items():
+            calItem = recurrence.Next(dt)
+            if calItem is not None:
+                occurrences[seq] = calItem
+                if nextStartDT is None or calItem.Get('Start') < nextStartDT:
+                    nextStartDT = calItem.Get('Start')
+
+        if nextStartDT is None:
+            return []  # no events in the future
+
+        found = {
+            seq: calItem for thisDT, seq, calItem in self._starts.Between((dt, _INFINITY), (nextStartDT, _INFINITY))
+        }
+        for seq, calItem in occurrences.items():
+            if calItem.Get('Start') == nextStartDT:
+                found[seq] = calItem
+        return self._Sorted(found)
+
+    def Previous(self, dt):
+        '''
+        The item(s) with the latest end before dt. Items that end at the same time are returned together.
+
+        :param dt: datetime.datetime
+        :return: list of CalendarItem objs, may be empty
+        '''
+        last = self._ends.Last((dt,))
+        previousEndDT = last[0] if last is not None else None
+
+        occurrences = {}  # {seq: calItem} the previous occurrence of each series
+        for seq, recurrence in self._series.items():
+            calItem = recurrence.Previous(dt)
+            if calItem is not None:
+                occurrences[seq] = calItem
+                if previousEndDT is None or calItem.Get('End') > previousEndDT:
+                    previousEndDT = calItem.Get('End')
+
+        if previousEndDT is None:
+            return []  # no events in the past
+
+        found = {seq: calItem for thisDT, seq, calItem in self._ends.Between((previousEndDT,), (dt,))}
+        for seq, calItem in occurrences.items():
+            if calItem.Get('End') == previousEndDT:
+                found[seq] = calItem
+        return self._Sorted(found)
+
+    def Outside(self, lowDT, highDT):
+        '''
+        The items that end before lowDT or start after highDT, everything Range(lowDT, highDT) would not return.
+
+        :param lowDT: datetime.datetime or None for no limit
+        :param highDT: datetime.datetime or None for no limit
+        :return: list of CalendarItem objs, may be empty
+        '''
+        found = {}
+        if lowDT is not None:
+            for thisDT, seq, calItem in self._ends.Between(None, (lowDT,)):
+                found[seq] = calItem
+        if highDT is not None:
+            for thisDT, seq, calItem in self._starts.Between((highDT, _INFINITY), None):
+                found[seq] = calItem
+        for seq, recurrence in self._series.items():
+            if recurrence.Outside(lowDT, highDT):
+                found[seq] = recurrence.master
+        return self._Sorted(found)
+
+
+_INFINITY = float('inf')
+_REMOVED = object()  # marks a removed key in _LayeredDict._changes and _CalendarIndex._subjectChanges
+_NO_DEFAULT = object()
+
+
+def _IsOutside(calItem, lowDT, highDT):
+    # True if calItem ends before lowDT or starts after highDT, None means no limit
+    if calItem.Recurrence:
+        return _Recurrence(calItem).Outside(lowDT, highDT)
+    return (lowDT is not None and calItem.Get('End') < lowDT) or (highDT is not None and calItem.Get('Start') > highDT)
+
+
+def _AddOccurrences(found, seq, occurrences):
+    # the occurrences of a series are sorted where its master would be, seq < key < seq + 1
+    for i, calItem in enumerate(occurrences):
+        found[seq + (i + 1) / (len(occurrences) + 1)] = calItem
+
+
+class _Recurrence:
+    '''
+    The occurrences of a recurring series, made only for the window a query asks for,
+        so a daily meeting for a year is one item in memory, in each sync and on disk, not 365.
+
+    The series is one calItem (the master) with the Start/End of the first occurrence and data['Recurrence'] like {
+        'Freq': 'DAILY', 'WEEKLY', 'MONTHLY' or 'YEARLY',
+        'Interval': 1,  # every Interval days/weeks/months/years
+        'ByDay': [0, 2],  # WEEKLY only, weekdays (0 is Monday). Default is the weekday of the first occurrence
+        'Count': 10,  # optional, number of occurrences
+        'Until': timestamp,  # optional, no occurrence starts after this
+        'Exceptions': [timestamp, ...],  # optional, the starts of cancelled occurrences
+        }
+    An occurrence that was moved/changed should be registered as a normal item and its original start added to Exceptions.
+
+    The occurrences are _CalendarItems with the master's data,
+        data['SeriesId'] is the master's ItemId and data['ItemId'] is '<SeriesId>_<start timestamp>'
+    '''
+    _PERIOD_DAYS = {'DAILY': 1, 'WEEKLY': 7, 'MONTHLY': 31, 'YEARLY': 366}
+    _CACHE_SIZE = 256  # occurrences kept so repeated queries return the same objs
+
+    def __init__(self, master):
+        rule = master.Recurrence
+        self.master = master
+        self._first = master.Get('Start')
+        self._length = master.Get('End') - self._first
+        self._freq = str(rule.get('Freq', 'DAILY')).upper()
+        count = rule.get('Count', None)
+        if self._freq not in self._PERIOD_DAYS:
+            ProgramLog('Error 680: unknown recurrence Freq {} in {}, using the first occurrence only'.format(
+                self._freq, master.Get('ItemId')), 'error')
+            self._freq = 'DAILY'
+            count = 1
+        self._interval = max(1, int(rule.get('Interval', None) or 1))
+        self._byDay = sorted(set(rule.get('ByDay', None) or [self._first.weekday()]))
+        self._exceptions = {round(timestamp) for timestamp in rule.get('Exceptions', None) or ()}
+        self._occurrences = {}  # {startDT: calItem}
+
+        until = rule.get('Until', None)
+        self._until = datetime.datetime.fromtimestamp(until, self._first.tzinfo) if until is not None else None
+        if count:
+            # the start of the last counted occurrence works the same as an Until
+            for i, startDT in zip(range(count), self._Starts(self._first)):
+                lastDT = startDT
+            self._until = lastDT if self._until is None else min(self._until, lastDT)
+
+    def _Starts(self, fromDT):
+        # the occurrence starts in order, from the period that has fromDT. Ignores Until and Exceptions
+        first = self._first
+        if self._freq == 'DAILY':
+            step = datetime.timedelta(days=self._interval)
+            n = max(0, (fromDT - first) // step)
+            while True:
+                yield first + n * step
+                n += 1
+
+        elif self._freq == 'WEEKLY':
+            weekStart = first - datetime.timedelta(days=first.weekday())
+            step = datetime.timedelta(weeks=self._interval)
+            n = max(0, (fromDT - weekStart) // step)
+            while True:
+                for day in self._byDay:
+                    startDT = weekStart + n * step + datetime.timedelta(days=day)
+                    if startDT >= first:
+                        yield startDT
+                n += 1
+
+        else:
+            months = self._interval * (12 if self._freq == 'YEARLY' else 1)
+            n = max(0, ((fromDT.year - first.year) * 12 + fromDT.month - first.month) // months - 1)
+            while True:
+                month = first.month - 1 + n * months
+                try:
+                    yield first.replace(year=first.year + month // 12, month=month % 12 + 1)
+                except ValueError:
+                    pass  # that month has no such day (the 31st, Feb 29), it is skipped
+                n += 1
+
+    def _Included(self, startDT):
+        return round(startDT.timestamp()) not in self._exceptions
+
+    def _Ended(self, startDT):
+        return self._until is not None and startDT > self._until
+
+    def _Occurrence(self, startDT):
+        calItem = self._occurrences.get(startDT, None)
+        if calItem is None:
+            data = self.master._DataDict()  # not .Data, that has the master's Start_ISO/End_ISO
+            data.pop('Recurrence', None)
+            data['SeriesId'] = data['ItemId']
+            data['ItemId'] = '{}_{}'.format(data['ItemId'], round(startDT.timestamp()))
+            calItem = _CalendarItem(startDT, startDT + self._length, data, self.master._parentExchange)
+            if len(self._occurrences) >= self._CACHE_SIZE:
+                self._occurrences.clear()
+            self._occurrences[startDT] = calItem
+        return calItem
+
+    def Overlaps(self, startDT, endDT):
+        # True if the series (first start to last end) overlaps the window
+        return self._first <= endDT and (self._until is None or self._until + self._length >= startDT)
+
+    def Outside(self, lowDT, highDT):
+        # True if the whole series ends before lowDT or starts after highDT, None means no limit
+        return (lowDT is not None and self._until is not None and self._until + self._length < lowDT) or \
+            (highDT is not None and self._first > highDT)
+
+    def Occurrences(self, startDT, endDT):
+        # the occurrences with End >= startDT and Start <= endDT, in order
+        ret = []
+        for occurrenceDT in self._Starts(startDT - self._length):
+            if occurrenceDT > endDT or self._Ended(occurrenceDT):
+                break
+            if occurrenceDT + self._length >= startDT and self._Included(occurrenceDT):
+                ret.append(self._Occurrence(occurrenceDT))
+        return ret
+
+    def Next(self, dt):
+        # the first occurrence that starts after dt, or None
+        for occurrenceDT in self._Starts(dt):
+            if self._Ended(occurrenceDT):
+                return None
+            if occurrenceDT > dt and self._Included(occurrenceDT):
+                return self._Occurrence(occurrenceDT)
+
+    def Previous(self, dt):
+        # the last occurrence that ends before dt, or None
+        lookBack = datetime.timedelta(days=self._PERIOD_DAYS[self._freq] * self._interval)
+        while True:
+            lowDT = dt - self._length - lookBack
+            found = None
+            for occurrenceDT in self._Starts(lowDT):
+                if occurrenceDT + self._length >= dt or self._Ended(occurrenceDT):
+                    break
+                if self._Included(occurrenceDT):
+                    found = occurrenceDT
+
+            if found is not None:
+                return self._Occurrence(found)
+            if lowDT <= self._first:
+                return None
+            lookBack *= 2
+
+
+_TRANSITION_MARGIN = 0.05  # seconds, see _BaseCalendar._CheckTransitions
+_TRANSITION_MAX_WAIT = 15 * 60
+
+
+class _SubjectIndex:
+    '''
+    Maps subjects to ItemIds so GetCalendarItemsBySubject doesn't have to test every item.
+    Partial matches are looked up by the 3 letter sequences (and single letters) in the subject,
+        then the few candidates are confirmed with a normal substring test.
+    '''
+
+    def __init__(self):
+        self._subjects = {}  # {itemId: subject}
+        self._exact = defaultdict(set)  # {subject: {itemId, ...}}
+        self._grams = defaultdict(set)  # {'abc': {itemId, ...}}
+
+    def __len__(self):
+        return len(self._subjects)
+
+    def Copy(self):
+        ret = _SubjectIndex()
+        ret._subjects = self._subjects.copy()
+        ret._exact.update((subject, set(itemIds)) for subject, itemIds in self._exact.items())
+        ret._grams.update((gram, set(itemIds)) for gram, itemIds in self._grams.items())
+        return ret
+
+    def Add(self, itemId, subject):
+        self.Remove(itemId)
+        self._subjects[itemId] = subject
+        self._exact[subject].add(itemId)
+        if isinstance(subject, str):
+            for gram in _Grams(subject):
+                self._grams[gram].add(itemId)
+
+    def Remove(self, itemId):
+        if itemId not in self._subjects:
+            return
+
+        subject = self._subjects.pop(itemId)
+        _Discard(self._exact, subject, itemId)
+        if isinstance(subject, str):
+            for gram in _Grams(subject):
+                _Discard(self._grams, gram, itemId)
+
+    def Find(self, exactMatch=None, partialMatch=None):
+        '''
+        :return: set of ItemIds
+        '''
+        ret = set(self._exact.get(exactMatch, ()))
+        if partialMatch:
+            if len(partialMatch) >= 3:
+                grams = {partialMatch[i:i + 3] for i in range(len(partialMatch) - 2)}
+            else:
+                grams = set(partialMatch)
+
+            postings = sorted((self._grams.get(gram, set()) for gram in grams), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+            for itemId in candidates:
+                if _SubjectMatches(self._subjects.get(itemId, None), None, partialMatch):
+                    ret.add(itemId)
+
+        return ret
+
+
+def _SubjectMatches(subject, exactMatch, partialMatch):
+    if subject == exactMatch:
+        return True
+    return bool(partialMatch) and isinstance(subject, str) and partialMatch in subject
+
+
+def _Grams(text):
+    # all the single letters and 3 letter sequences in text
+    grams = set(text)
+    grams.update(text[i:i + 3] for i in range(len(text) - 2))
+    return grams
+
+
+def _Discard(postings, key, itemId):
+    itemIds = postings.get(key, None)
+    if itemIds is not None:
+        itemIds.discard(itemId)
+        if not itemIds:
+            del postings[key]
+
+
+def _EntryKey(entry):
+    return entry[:2]
+
+
+class _SortedEntries:
+    '''
+    A sorted list of (datetime, seq, calItem) entries for _CalendarIndex, kept in chunks
+        so Copy() only copies the list of chunks and a change only copies the chunk it touches.
+
+    Entries are looked up with a probe tuple, the same way bisect is used on a plain list:
+        (dt,) sorts before every entry at dt and (dt, _INFINITY) after them.
+        seq is unique so the calItems are never compared.
+    '''
+    _CHUNK = 512  # entries per chunk, a chunk that grows to twice this is split in two
+
+    def __init__(self, entries=()):
+        # entries must already be sorted
+        entries = list(entries)
+        self._chunks = [entries[i:i + self._CHUNK] for i in range(0, len(entries), self._CHUNK)]
+        self._lasts = [chunk[-1] for chunk in self._chunks]  # the last entry of each chunk
+        self._owned = [True] * len(self._chunks)  # False for chunks shared with a copy, they are copied before a change
+        self._len = len(entries)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            yield from chunk
+
+    def Copy(self):
+        self._owned = [False] * len(self._chunks)
+        ret = _SortedEntries.__new__(_SortedEntries)
+        ret._chunks = list(self._chunks)
+        ret._lasts = list(self._lasts)
+        ret._owned = [False] * len(self._chunks)
+        ret._len = self._len
+        return ret
+
+    def _Own(self, i):
+        if not self._owned[i]:
+            self._chunks[i] = list(self._chunks[i])
+            self._owned[i] = True
+        return self._chunks[i]
+
+    def _Position(self, probe):
+        # (chunk, index in the chunk) of the first entry >= probe
+        i = bisect_left(self._lasts, probe)
+        if i == len(self._chunks):
+            return i, 0
+        return i, bisect_left(self._chunks[i], probe)
+
+    def Insert(self, entry):
+        if not self._chunks:
+            self._chunks.append([entry])
+            self._lasts.append(entry)
+            self._owned.append(True)
+        else:
+            key = entry[:2]
+            i = min(bisect_left(self._lasts, key), len(self._chunks) - 1)
+            chunk = self._Own(i)
+            chunk.insert(bisect_left(chunk, key), entry)
+            if len(chunk) < 2 * self._CHUNK:
+                self._lasts[i] = chunk[-1]
+            else:
+                self._chunks[i:i + 1] = [chunk[:self._CHUNK], chunk[self._CHUNK:]]
+                self._lasts[i:i + 1] = [chunk[self._CHUNK - 1], chunk[-1]]
+                self._owned[i:i + 1] = [True, True]
+        self._len += 1
+
+    def Remove(self, dt, seq):
+        i, j = self._Position((dt, seq))
+        if i == len(self._chunks) or self._chunks[i][j][1] != seq:
+            return
+        chunk = self._Own(i)
+        del chunk[j]
+        self._len -= 1
+        if chunk:
+            self._lasts[i] = chunk[-1]
+        else:
+            del self._chunks[i], self._lasts[i], self._owned[i]
+
+    def Between(self, low=None, high=None):
+        # list of the entries >= low and < high, None means no limit
+        i, j = self._Position(low) if low is not None else (0, 0)
+        k, m = self._Position(high) if high is not None else (len(self._chunks), 0)
+        if (i, j) >= (k, m):
+            return []
+        if i == k:
+            return self._chunks[i][j:m]
+        ret = self._chunks[i][j:]
+        for n in range(i + 1, k):
+            ret.extend(self._chunks[n])
+        if m:
+            ret.extend(self._chunks[k][:m])
+        return ret
+
+    def First(self, low=None):
+        # the first entry >= low, or None
+        i, j = self._Position(low) if low is not None else (0, 0)
+        return self._chunks[i][j] if i < len(self._chunks) else None
+
+    def Last(self, high):
+        # the last entry < high, or None
+        i, j = self._Position(high)
+        if j:
+            return self._chunks[i][j - 1]
+        return self._lasts[i - 1] if i else None
+
+
+# Binary snapshot layout, all little endian:
+#   header: magic, number of items, length of the meta json
+#   meta json: {'lastUpdateTime': float, 'syncToken': str or None, ...}
+#   index: one fixed width record per item sorted by start,
+#       (start timestamp, end timestamp, id offset, id length, payload offset, payload length)
+#   blob: the json encoded ItemIds and payloads, offsets above are relative to the start of the blob
+# The index can be read without touching the blob, so now/next queries work before any payload is decoded.
+_SNAPSHOT_MAGIC = b'GSCAL\x00\x01\x00'
+_SNAPSHOT_HEADER = struct.Struct('<8sII')
+_SNAPSHOT_RECORD = struct.Struct('<ddIIII')
+
+
+def _DumpSnapshot(calItems, meta):
+    '''
+    :param calItems: iterable of CalendarItem objs
+    :param meta: json safe dict
+    :return: bytes
+    '''
+    records = []
+    blob = bytearray()
+    meta = dict(meta, series=[])
+    for item in sorted(calItems, key=_StartKey):
+        if item.Recurrence:
+            # kept in the meta json, the records are decoded lazily and a series must be known when it is indexed
+            meta['series'].append(item.dict())
+            continue
+
+        idBytes = json.dumps(item.Get('ItemId')).encode('utf-8')
+        if isinstance(item, _LazyCalendarItem) and item._payload is not None:
+            payload = item._payload  # never decoded, no need to encode it again
+        else:
+            data = item.dict()
+            for key in ('ItemId',) + _DERIVED_KEYS:
+                data.pop(key, None)
+            payload = json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+        records.append(_SNAPSHOT_RECORD.pack(
+            item.Get('Start').timestamp(),
+            item.Get('End').timestamp(),
+            len(blob),
+            len(idBytes),
+            len(blob) + len(idBytes),
+            len(payload),
+        ))
+        blob += idBytes
+        blob += payload
+
+    metaBytes = json.dumps(meta).encode('utf-8')
+    return b''.join([
+        _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, len(records), len(metaBytes)),
+        metaBytes,
+        b''.join(records),
+        bytes(blob),
+    ])
+
+
+def _LoadSnapshot(raw, parentCalendar):
+    '''
+    :param raw: bytes from _DumpSnapshot
+    :param parentCalendar:
+    :return: tuple of (meta dict, list of _LazyCalendarItem sorted by start, then the series masters)
+    '''
+    view = memoryview(raw)
+    magic, count, metaLength = _SNAPSHOT_HEADER.unpack_from(view, 0)
+    if magic != _SNAPSHOT_MAGIC:
+        raise ValueError('not a calendar snapshot')
+
+    offset = _SNAPSHOT_HEADER.size
+    meta = json.loads(bytes(view[offset:offset + metaLength]).decode('utf-8'))
+    offset += metaLength
+
+    blobOffset = offset + count * _SNAPSHOT_RECORD.size
+    blob = view[blobOffset:]
+    records = list(_SNAPSHOT_RECORD.iter_unpack(view[offset:blobOffset]))
+    if len(records) != count or (records and records[-1][4] + records[-1][5] != len(blob)):
+        # the payloads are decoded later, check now that they are all there
+        raise ValueError('the calendar snapshot is cut off')
+    fromtimestamp = datetime.datetime.fromtimestamp
+
+    calItems = []
+    for start, end, idOffset, idLength, payloadOffset, payloadLength in records:
+        calItems.append(_LazyCalendarItem(
+            startDT=fromtimestamp(start),
+            endDT=fromtimestamp(end),
+            itemId=json.loads(bytes(blob[idOffset:idOffset + idLength]).decode('utf-8')),
+            payload=blob[payloadOffset:payloadOffset + payloadLength],
+            parentCalendar=parentCalendar,
+        ))
+
+    for data in meta.pop('series', []):
+        startDT = fromtimestamp(data['Start'])
+        endDT = fromtimestamp(data['End'])
+        for key in _DERIVED_KEYS:
+            data.pop(key, None)
+        calItems.append(_CalendarItem(startDT, endDT, data, parentCalendar))
+    return meta, calItems
+
+
+def _StartKey(calItem):
+    return calItem.Get('Start')
+
+
+class _LayeredDict(MutableMapping):
+    '''
+    A dict that can be copied without copying every entry, for the dicts in the snapshots.
+    Copies share the base dict and keep what changed since in their own small dict,
+        once that has more than about √n entries it is merged into a new base.
+        So copying and changing cost about √n instead of n, and a merge (n) happens once every √n changes.
+    Looking up a missing key calls __missing__, which raises KeyError like a dict.
+    The keys are in the same order a dict would have them, a key that is removed and added again goes last.
+    '''
+    __slots__ = ('_base', '_changes', '_moved', '_shared', '_len')
+
+    def __init__(self, other=()):
+        self._base = dict(other)
+        self._changes = {}  # {key: value or _REMOVED}, only used while the base is shared
+        self._moved = set()  # keys of the base that were removed and added again, they come after the base
+        self._shared = False
+        self._len = len(self._base)
+
+    def Copy(self):
+        self._shared = True
+        ret = self.__class__.__new__(self.__class__)
+        ret._base = self._base
+        ret._changes = self._changes.copy()
+        ret._moved = self._moved.copy()
+        ret._shared = True
+        ret._len = self._len
+        return ret
+
+    def __missing__(self, key):
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        changes = self._changes
+        if changes and key in changes:
+            value = changes[key]
+        else:
+            value = self._base.get(key, _REMOVED)
+        if value is _REMOVED:
+            return self.__missing__(key)
+        return value
+
+    def get(self, key, default=None):
+        changes = self._changes
+        if changes and key in changes:
+            value = changes[key]
+            return default if value is _REMOVED else value
+        return self._base.get(key, default)
+
+    def __contains__(self, key):
+        changes = self._changes
+        if changes and key in changes:
+            return changes[key] is not _REMOVED
+        return key in self._base
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        changes = self._changes
+        if not changes:
+            yield from self._base
+            return
+        moved = self._moved
+        for key in self._base:
+            if changes.get(key, None) is not _REMOVED and key not in moved:
+                yield key
+        for key, value in changes.items():
+            if value is not _REMOVED and (key in moved or key not in self._base):
+                yield key
+
+    def keys(self):
+        return self._base.keys() if not self._changes else KeysView(self)
+
+    def values(self):
+        return self._base.values() if not self._changes else ValuesView(self)
+
+    def items(self):
+        return self._base.items() if not self._changes else ItemsView(self)
+
+    def __setitem__(self, key, value):
+        if not self._shared:
+            if key not in self._base:
+                self._len += 1
+            self._base[key] = value
+            return
+        if key not in self:
+            self._len += 1
+            if key in self._base:
+                del self._changes[key]  # it was removed, added again it goes last
+                self._moved.add(key)
+        self._changes[key] = value
+        self._Merge()
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._len -= 1
+        if not self._shared:
+            del self._base[key]
+        elif key in self._base:
+            self._changes[key] = _REMOVED
+            self._moved.discard(key)
+            self._Merge()
+        else:
+            del self._changes[key]
+
+    def pop(self, key, default=_NO_DEFAULT):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default is _NO_DEFAULT:
+            raise KeyError(key)
+        return default
+
+    def _Merge(self):
+        if len(self._changes) > 64 + int(len(self._base) ** 0.5):
+            base = self._base.copy()  # the old base may still be used by other copies
+            for key, value in self._changes.items():
+                if value is _REMOVED or key in self._moved:
+                    del base[key]
+                if value is not _REMOVED:
+                    base[key] = value
+            self._base = base
+            self._changes = {}
+            self._moved = set()
+            self._shared = False
+
+
+class _ItemDict(_LayeredDict):
+    # {itemId: calItem}, like the old defaultdict(lambda: None) but looking up a missing id doesn't add it
+    __slots__ = ()
+
+    def __missing__(self, key):
+        return None
+
+
+class _CalendarItems(MutableMapping):
+    '''
+    What _BaseCalendar._calendarItems returns, for subclasses written against the old {str(id): calItemObj} dict.
+    Reads come from the current snapshot. Writes are committed like any other change (journaled, no callbacks),
+        the key must be the item's ItemId.
+    '''
+
+    def __init__(self, calendar):
+        self._calendar = calendar
+
+    def __getitem__(self, itemId):
+        return self._calendar._snapshot.items[itemId]  # None if it's missing, like the old defaultdict
+
+    def get(self, itemId, default=None):
+        return self._calendar._snapshot.items.get(itemId, default)
+
+    def __contains__(self, itemId):
+        return itemId in self._calendar._snapshot.items
+
+    def __iter__(self):
+        return iter(self._calendar._snapshot.items)
+
+    def __len__(self):
+        return len(self._calendar._snapshot.items)
+
+    def keys(self):
+        return self._calendar._snapshot.items.keys()
+
+    def values(self):
+        return self._calendar._snapshot.items.values()
+
+    def items(self):
+        return self._calendar._snapshot.items.items()
+
+    def copy(self):
+        return _ItemDict(self._calendar._snapshot.items)
+
+    def __setitem__(self, itemId, calItem):
+        if calItem.Get('ItemId') != itemId:
+            raise KeyError('{} is not the ItemId of {}'.format(itemId, calItem))
+        with self._calendar._writeLock:
+            self._calendar._Commit([calItem], [])
+
+    def __delitem__(self, itemId):
+        with self._calendar._writeLock:
+            if itemId not in self._calendar._snapshot.items:
+                raise KeyError(itemId)
+            self._calendar._Commit([], [itemId])
+
+    def pop(self, itemId, default=_NO_DEFAULT):
+        with self._calendar._writeLock:
+            calItem = self._calendar._snapshot.items.get(itemId, None)
+            if calItem is None:
+                if default is _NO_DEFAULT:
+                    raise KeyError(itemId)
+                return default
+            self._calendar._Commit([], [itemId])
+            return calItem
+
+    def clear(self):
+        with self._calendar._writeLock:
+            self._calendar._Commit([], list(self._calendar._snapshot.items))
+
+
+class _CalendarSnapshot:
+    '''
+    The items of a calendar and their index, as of one moment.
+    A snapshot is never changed once it is published, writers change a Copy() and swap it in.
+    Readers just grab _BaseCalendar._snapshot and use it, no locks and no copies.
+    A copy shares what it doesn't change (see _LayeredDict and _SortedEntries), so committing a few items
+        costs about √n instead of n. The long events and the recurring series are still copied whole, there are few of them.
+    '''
+    __slots__ = ('items', 'index')
+
+    def __init__(self, items=None, index=None):
+        self.items = items if items is not None else _ItemDict()  # {itemId: calItem}
+        self.index = index if index is not None else _CalendarIndex()
+
+    def Copy(self):
+        return _CalendarSnapshot(self.items.Copy(), self.index.Copy())
+
+    def Apply(self, upserts, deleteIds):
+        for calItem in upserts:
+            self.items[calItem.Get('ItemId')] = calItem
+        for itemId in deleteIds:
+            self.items.pop(itemId, None)
+        self.index.Apply(upserts, deleteIds)
+
+
+class _Instrumentation:
+    '''
+    Debug logging, counters and timers for a calendar.
+
+    Log() only formats its message when debug is on.
+    Count() and Measure() do nothing unless enabled, Measure() then returns a shared do-nothing context manager,
+        so leaving the calls in the hot paths costs next to nothing.
+
+    Example:
+    with self._metrics.Measure('save'):
+        ...
+    self._metrics.Count('reconcile.items', len(calItems))
+    self._metrics.Log('saved {} items to {}', len(items), path)
+    '''
+
+    def __init__(self, enabled=False, debug=False):
+        self.enabled = enabled
+        self.debug = debug
+        self._counters = defaultdict(int)
+        self._timers = {}  # {name: [count, totalSeconds, maxSeconds, lastSeconds]}
+        self._lock = threading.Lock()
+
+    def Log(self, message, *args):
+        if self.debug:
+            print(message.format(*args) if args else message)
+
+    def Count(self, name, amount=1):
+        if self.enabled:
+            with self._lock:
+                self._counters[name] += amount
+
+    def Measure(self, name):
+        if self.enabled:
+            return _Measurement(self, name)
+        return _NOT_MEASURED
+
+    def _Record(self, name, elapsed):
+        with self._lock:
+            timer = self._timers.get(name, None)
+            if timer is None:
+                self._timers[name] = [1, elapsed, elapsed, elapsed]
+            else:
+                timer[0] += 1
+                timer[1] += elapsed
+                timer[2] = max(timer[2], elapsed)
+                timer[3] = elapsed
+
+    def Reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    @property
+    def Metrics(self):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'timers': {
+                    name: {'count': count, 'total': total, 'max': maxTime, 'last': last}
+                    for name, (count, total, maxTime, last) in self._timers.items()
+                },
+            }
+
+
+class _Measurement:
+    __slots__ = ('_instrumentation', '_name', '_startTime')
+
+    def __init__(self, instrumentation, name):
+        self._instrumentation = instrumentation
+        self._name = name
+        self._startTime = None
+
+    def __enter__(self):
+        self._startTime = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._instrumentation._Record(self._name, time.perf_counter() - self._startTime)
+
+
+class _NotMeasured:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NOT_MEASURED = _NotMeasured()
+
+
+class _CoverageCache:
+    '''
+    Remembers which time windows have been synced from the server, and when.
+    Kept as a sorted list of non-overlapping (startDT, endDT, fetchedTime) windows,
+        a newer sync of a window replaces whatever part of an older one it overlaps.
+    '''
+
+    def __init__(self, ttl):
+        self._ttl = ttl  # seconds a window stays fresh
+        self._windows = []
+
+    def Add(self, startDT, endDT, fetchedTime=None):
+        if fetchedTime is None:
+            fetchedTime = time.monotonic()
+
+        windows = []
+        for thisStartDT, thisEndDT, thisTime in self._windows:
+            if fetchedTime - thisTime > self._ttl:
+                continue  # expired, drop it so the list stays short
+
+            if thisEndDT <= startDT or thisStartDT >= endDT:
+                windows.append((thisStartDT, thisEndDT, thisTime))
+            else:
+                # keep the parts of the old window that are outside the new one
+                if thisStartDT < startDT:
+                    windows.append((thisStartDT, startDT, thisTime))
+                if thisEndDT > endDT:
+                    windows.append((endDT, thisEndDT, thisTime))
+
+        windows.append((startDT, endDT, fetchedTime))
+        windows.sort(key=_EntryKey)
+        self._windows = windows
+
+    def Missing(self, startDT, endDT, nowTime=None):
+        '''
+        :return: list of (startDT, endDT) parts of the window that have not been synced in the last ttl seconds
+        '''
+        if nowTime is None:
+            nowTime = time.monotonic()
+
+        missing = []
+        cursorDT = startDT
+        for thisStartDT, thisEndDT, thisTime in self._windows:
+            if thisEndDT < cursorDT or nowTime - thisTime > self._ttl:
+                continue
+            if thisStartDT > endDT:
+                break
+
+            if thisStartDT > cursorDT:
+                missing.append((cursorDT, thisStartDT))
+            cursorDT = max(cursorDT, thisEndDT)
+            if cursorDT >= endDT:
+                break
+
+        if cursorDT < endDT:
+            missing.append((cursorDT, endDT))
+        return missing
+
+    def Clear(self):
+        self._windows = []
+
+
+class _AttachmentCache:
+    '''
+    Remembers each item's attachments (the list from GetAttachments) and their contents (from attachment.Read()),
+        so showing the same attachment again doesn't download it again. See _CalendarItem.Attachments.
+
+    The contents are kept least recently used first, within maxBytes.
+    The ones pushed out are written to files in spillPath (if given), up to spillMaxBytes, else dropped.
+    The file names start with spillPrefix, so several caches can share spillPath.
+    Everything cached for an item is dropped when the item is changed/deleted, see Invalidate.
+    '''
+
+    def __init__(self, maxBytes, spillPath=None, spillMaxBytes=0, spillPrefix=''):
+        self._maxBytes = maxBytes
+        self._spillPath = spillPath
+        self._spillPrefix = spillPrefix
+        self._spillMaxBytes = spillMaxBytes
+        self._lists = {}  # {itemId: [_CachedAttachment, ...]}
+        self._contents = OrderedDict()  # {(itemId, attachmentId): bytes or str}, least recently used first
+        self._bytes = 0
+        self._spilled = OrderedDict()  # {(itemId, attachmentId): (filepath, size, isText)}, least recently used first
+        self._spilledBytes = 0
+        self._invalidations = 0  # a list/content loaded while an Invalidate happened may be stale, it is not kept
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'diskHits': 0, 'evicted': 0, 'invalidated': 0}
+
+        if spillPath and not File.Exists(spillPath):
+            File.MakeDir(spillPath)
+        elif spillPath:
+            # this cache's files from before a restart, nothing refers to them anymore
+            self._DeleteFiles(
+                '{}/{}'.format(spillPath, filename) for filename in File.ListDir(spillPath)
+                if filename.startswith(spillPrefix) and filename.endswith('.attachment')
+            )
+
+    def Attachments(self, calItem, load):
+        '''
+        :param calItem: CalendarItem
+        :param load: function like load(calItem) that returns the item's attachments from the server
+        :return: list of _CachedAttachment
+        '''
+        # the occurrences of a recurring series have the attachments of the series
+        itemId = calItem.Get('SeriesId') or calItem.Get('ItemId')
+        with self._lock:
+            ret = self._lists.get(itemId, None)
+            if ret is not None:
+                self._stats['hits'] += 1
+                return list(ret)
+            self._stats['misses'] += 1
+            invalidations = self._invalidations
+
+        ret = [
+            _CachedAttachment(self, itemId, _AttachmentId(attachment, i), attachment)
+            for i, attachment in enumerate(load(calItem) or [])
+        ]
+        with self._lock:
+            if invalidations == self._invalidations:
+                self._lists[itemId] = ret
+        return list(ret)
+
+    def Read(self, key, read):
+        '''
+        :param key: tuple of (itemId, attachmentId)
+        :param read: function that downloads the content
+        :return: the content
+        '''
+        with self._lock:
+            content = self._contents.get(key, None)
+            if content is not None:
+                self._contents.move_to_end(key)
+                self._stats['hits'] += 1
+                return content
+            spilled = self._spilled.pop(key, None)
+            if spilled:
+                self._spilledBytes -= spilled[1]
+            invalidations = self._invalidations
+
+        if spilled:
+            filepath, size, isText = spilled
+            try:
+                with File(filepath, 'r' if isText else 'rb') as file:
+                    content = file.read()
+                File.DeleteFile(filepath)  # it is back in memory
+                with self._lock:
+                    self._stats['diskHits'] += 1
+            except Exception as e:
+                ProgramLog('Error 691: reading cached attachment {}: {}'.format(filepath, e), 'warning')
+
+        if content is None:
+            with self._lock:
+                self._stats['misses'] += 1
+            content = read()
+
+        self._Store(key, content, invalidations)
+        return content
+
+    def _Store(self, key, content, invalidations):
+        try:
+            size = len(content)
+        except TypeError:
+            return  # can't tell how big it is, so it is not cached
+
+        with self._lock:
+            if invalidations != self._invalidations or key in self._contents:
+                return
+            if size > self._maxBytes:
+                evicted = [(key, content)]
+            else:
+                self._contents[key] = content
+                self._bytes += size
+                evicted = []
+                while self._bytes > self._maxBytes:
+                    oldKey, oldContent = self._contents.popitem(last=False)
+                    self._bytes -= len(oldContent)
+                    evicted.append((oldKey, oldContent))
+            self._stats['evicted'] += len(evicted)
+
+        if self._spillPath:
+            for oldKey, oldContent in evicted:
+                self._Spill(oldKey, oldContent)
+
+    def _Spill(self, key, content):
+        if len(content) > self._spillMaxBytes:
+            return
+        isText = isinstance(content, str)
+        filepath = '{}/{}{}.attachment'.format(
+            self._spillPath, self._spillPrefix, hashlib.sha1(repr(key).encode()).hexdigest())
+        try:
+            with File(filepath, 'w' if isText else 'wb') as file:
+                file.write(content)
+        except Exception as e:
+            ProgramLog('Error 692: writing cached attachment {}: {}'.format(filepath, e), 'warning')
+            return
+
+        with self._lock:
+            old = self._spilled.pop(key, None)
+            if old:
+                self._spilledBytes -= old[1]
+            self._spilled[key] = (filepath, len(content), isText)
+            self._spilledBytes += len(content)
+            dropped = []
+            while self._spilledBytes > self._spillMaxBytes:
+                oldKey, (oldFilepath, oldSize, oldIsText) = self._spilled.popitem(last=False)
+                self._spilledBytes -= oldSize
+                dropped.append(oldFilepath)
+        self._DeleteFiles(dropped)
+
+    def _DeleteFiles(self, filepaths):
+        for filepath in filepaths:
+            try:
+                File.DeleteFile(filepath)
+            except Exception:
+                pass  # already gone
+
+    def Invalidate(self, itemIds):
+        # drop everything cached for these items
+        itemIds = set(itemIds)
+        if not itemIds:
+            return
+
+        with self._lock:
+            self._invalidations += 1
+            for itemId in itemIds:
+                if self._lists.pop(itemId, None) is not None:
+                    self._stats['invalidated'] += 1
+            for key in [key for key in self._contents if key[0] in itemIds]:
+                self._bytes -= len(self._contents.pop(key))
+            filepaths = []
+            for key in [key for key in self._spilled if key[0] in itemIds]:
+                filepath, size, isText = self._spilled.pop(key)
+                self._spilledBytes -= size
+                filepaths.append(filepath)
+        self._DeleteFiles(filepaths)
+
+    def Clear(self):
+        with self._lock:
+            self._invalidations += 1
+            self._lists.clear()
+            self._contents.clear()
+            self._bytes = 0
+            filepaths = [filepath for filepath, size, isText in self._spilled.values()]
+            self._spilled.clear()
+            self._spilledBytes = 0
+        self._DeleteFiles(filepaths)
+
+    @property
+    def Stats(self):
+        with self._lock:
+            ret = self._stats.copy()
+            ret['items'] = len(self._lists)
+            ret['bytes'] = self._bytes
+            ret['diskBytes'] = self._spilledBytes
+        return ret
+
+
+class _CachedAttachment:
+    '''
+    An attachment from GetAttachments, .Read() is answered by the _AttachmentCache after the first time.
+    Everything else is passed through to the attachment.
+    '''
+
+    def __init__(self, cache, itemId, attachmentId, attachment):
+        self._cache = cache
+        self._key = (itemId, attachmentId)
+        self._attachment = attachment
+
+    def Read(self):
+        return self._cache.Read(self._key, self._attachment.Read)
+
+    def __getattr__(self, name):
+        return getattr(self._attachment, name)
+
+    def __str__(self):
+        return str(self._attachment)
+
+    def __repr__(self):
+        return repr(self._attachment)
+
+
+def _AttachmentId(attachment, i):
+    # the attachment's own id if it has one, else its position in the list
+    for name in ('ID', 'Id', 'AttachmentId'):
+        value = getattr(attachment, name, None)
+        if value is not None:
+            return value
+    return i
+
+
+class _CallbackDispatcher:
+    '''
+    Calls the calendar's user callbacks.
+
+    mode='sync' calls them right away on the caller's thread (the original behavior).
+    mode='async' puts them in a queue that a worker thread empties,
+        so a slow handler can't stall RegisterCalendarItems.
+        If the queue is full the callback is dropped and counted.
+
+    Handlers that take longer than budget seconds are counted as slow and logged.
+    '''
+
+    def __init__(self, mode='sync', budget=None, maxQueue=1000):
+        self._mode = mode
+        self._budget = budget
+        self._queue = queue.Queue(maxQueue)
+        self._worker = None
+        self._stats = {}  # {name: {'calls': int, 'dropped': int, 'slow': int, 'errors': int, 'totalTime': float, 'maxTime': float}}
+        self._statsLock = threading.Lock()
+
+    def Dispatch(self, name, func, *args):
+        if not callable(func):
+            return
+
+        if self._mode == 'sync':
+            self._Run(name, func, args)
+            return
+
+        try:
+            self._queue.put_nowait((name, func, args))
+        except queue.Full:
+            self._Count(name, 'dropped')
+            ProgramLog('Error 660: callback queue is full, dropped {}'.format(name), 'warning')
+            return
+
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._Work, daemon=True)
+            self._worker.start()
+
+    def _Work(self):
+        while True:
+            name, func, args = self._queue.get()
+            try:
+                self._Run(name, func, args)
+            except Exception as e:
+                self._Count(name, 'errors')
+                ProgramLog('Error 661: {} callback raised {}'.format(name, e), 'error')
+            finally:
+                self._queue.task_done()
+
+    def _Run(self, name, func, args):
+        startTime = time.monotonic()
+        try:
+            func(*args)
+        finally:
+            elapsed = time.monotonic() - startTime
+            with self._statsLock:
+                stats = self._StatsFor(name)
+                stats['calls'] += 1
+                stats['totalTime'] += elapsed
+                stats['maxTime'] = max(stats['maxTime'], elapsed)
+                if self._budget is not None and elapsed > self._budget:
+                    stats['slow'] += 1
+                    slow = True
+                else:
+                    slow = False
+
+            if slow:
+                ProgramLog('{} callback took {:.3f}s, budget is {}s'.format(name, elapsed, self._budget), 'warning')
+
+    def _StatsFor(self, name):
+        if name not in self._stats:
+            self._stats[name] = {'calls': 0, 'dropped': 0, 'slow': 0, 'errors': 0, 'totalTime': 0.0, 'maxTime': 0.0}
+        return self._stats[name]
+
+    def _Count(self, name, key):
+        with self._statsLock:
+            self._StatsFor(name)[key] += 1
+
+    def Join(self):
+        # blocks until every queued callback has been called
+        self._queue.join()
+
+    @property
+    def Stats(self):
+        with self._statsLock:
+            ret = {name: stats.copy() for name, stats in self._stats.items()}
+        ret['queued'] = self._queue.qsize()
+        return ret
+
 
-    def __ge__(self, other):
-        # print('223 __ge__', self, other)
+class WriteRejected(Exception):
+    '''
+    Raise this from CreateCalendarEvent/ChangeEventTime/DeleteEvent when the server refuses the change.
+    A queued write (see _BaseCalendar.QueueChangeEventTime) is then rolled back right away instead of retried.
+    '''
 
-        if isinstance(other, datetime.datetime):
-            # if other.tzinfo is None and self._endDT.tzinfo is not None:
-            #     # other is naive, assume its in local system timezone
-            #     other = other.astimezone()
 
-            return self._endDT >= other
-        elif isinstance(other, _CalendarItem):
-            return self._endDT >= other._endDT
+class _PendingWrite:
+    '''
+    One change waiting to be sent to the server, see _BaseCalendar._QueueWrite
+    '''
+    __slots__ = ('kind', 'itemId', 'original', 'current', 'local', 'attempts', 'dueTime', 'lastError')
 
-        else:
-            raise TypeError('unorderable types: {} < {}'.format(self, other))
+    def __init__(self, kind, itemId, original, current, local):
+        self.kind = kind  # 'Create', 'Change' or 'Delete'
+        self.itemId = itemId
+        self.original = original  # the item as the server has it, restored if the write fails. None for 'Create'
+        self.current = current  # the item as it was applied locally, None for 'Delete'
+        self.local = local  # False if the item is not in memory (an occurrence of a recurring series), so it is only sent
+        self.attempts = 0
+        self.dueTime = 0  # time.monotonic() of the next attempt
+        self.lastError = None
 
 
 class _BaseCalendar:
@@ -255,8 +2028,11 @@ class _BaseCalendar:
             self._debug = k['debug']
         else:
             self._debug = False
+        # instrument=True turns on the counters/timers in .Metrics, see _Instrumentation
+        self._metrics = _Instrumentation(enabled=k.get('instrument', False), debug=self._debug)
         ###########
         self._lastUpdateTime = 0
+        self._syncToken = None  # see RegisterCalendarChanges
 
         self._connectionStatus = None
         self._Connected = None
@@ -265,25 +2041,181 @@ class _BaseCalendar:
         self._CalendarItemDeleted = None  # callback for when an item is deleted
         self._CalendarItemChanged = None  # callback for when an item is changed
         self._NewCalendarItem = None  # callback for when an item is created
-
-        self._calendarItems = defaultdict(lambda: None)  # dict of _CalendarItem object {str(id): calItemObj}
+        self._CalendarItemsBatch = None  # callback for all the changes from one RegisterCalendarItems
+
+        # callbackMode='async' runs the callbacks on a worker thread instead of inside RegisterCalendarItems
+        # batchCallbacks=True calls CalendarItemsBatch once per sync instead of once per item
+        self._dispatcher = _CallbackDispatcher(
+            mode=k.get('callbackMode', 'sync'),
+            budget=k.get('callbackBudget', None),  # seconds, slower handlers are counted and logged
+            maxQueue=k.get('callbackQueueSize', 1000),
+        )
+        self._batchCallbacks = k.get('batchCallbacks', False)
+
+        # The items and their index, replaced as a whole by _Commit() after every change.
+        # Changes are serialized by _writeLock, readers don't need a lock.
+        self._snapshot = _CalendarSnapshot()
+        self._writeLock = threading.RLock()
+
+        # _timerTransition is armed for the next start/end of an item, see _CheckTransitions
+        self._EventStarted = None
+        self._EventEnded = None
+        self._RoomStateChanged = None
+        self._nowItems = None  # {itemId: calItem} in progress at the last _CheckTransitions, None while not watching
+        self._roomState = None
+        self._transitionLock = threading.Lock()
+        self._timerTransition = Timer(1, self._TransitionTimerTick)
+        self._timerTransition.Stop()
+
+        # The Queue* methods change the items in memory right away and send the change to the server on _writeThread.
+        # A failed write is retried after writeBackoff seconds, doubled each time up to writeMaxBackoff,
+        #   and rolled back after writeMaxAttempts tries.
+        self._writeMaxAttempts = k.get('writeMaxAttempts', 5)
+        self._writeBackoff = k.get('writeBackoff', 2)
+        self._writeMaxBackoff = k.get('writeMaxBackoff', 60)
+        self._writes = {}  # {itemId: _PendingWrite} not sent yet, in the order they were queued
+        self._writing = None  # the _PendingWrite being sent
+        self._writeCondition = threading.Condition()
+        self._writeThread = None
+        self._writeIds = itertools.count(1)  # for the temporary ItemIds of queued creates
+        self._writeStats = {'queued': 0, 'coalesced': 0, 'sent': 0, 'retries': 0, 'failed': 0}
+        self._WriteFailed = None
+
+        # rangeCacheTTL > 0 lets GetEventsInRange skip the server for windows synced in the last rangeCacheTTL seconds
+        self._rangeCacheTTL = k.get('rangeCacheTTL', 0)
+        self._coverage = _CoverageCache(self._rangeCacheTTL)
+        self._rangeCacheStats = {'hits': 0, 'misses': 0, 'fetches': 0}
+
+        # attachmentCacheBytes > 0 caches the attachments of each item and their contents, see _AttachmentCache.
+        #   Off by default, it is per calendar so a system with many rooms should keep it small.
+        # attachmentSpillPath is a directory, the contents that don't fit in memory are kept there, up to attachmentSpillBytes.
+        #   The files are named after persistentStorage (or attachmentSpillPrefix), so calendars can share the directory.
+        #   This calendar's files from before a restart are deleted at startup.
+        attachmentCacheBytes = k.get('attachmentCacheBytes', 0)
+        spillPrefix = k.get('attachmentSpillPrefix', None)
+        if spillPrefix is None and k.get('persistentStorage', None):
+            spillPrefix = hashlib.sha1(k['persistentStorage'].encode()).hexdigest()[:12] + '-'
+        elif spillPrefix is None:
+            # no name that lasts across restarts, files left behind by a crash are not cleaned up
+            spillPrefix = '{:x}-'.format(id(self))
+        self._attachmentCache = _AttachmentCache(
+            attachmentCacheBytes,
+            spillPath=k.get('attachmentSpillPath', None),
+            spillMaxBytes=k.get('attachmentSpillBytes', 64 * 1024 * 1024),
+            spillPrefix=spillPrefix,
+        ) if attachmentCacheBytes else None
+
+        # Items that ended more than retainPast ago or start more than retainFuture from now are dropped
+        #   from memory and from the saved file, during each sync and save. None keeps them forever.
+        # archiveFile is a filepath, the dropped items are appended to it as json lines. None just drops them.
+        self._retainPast = k.get('retainPast', None)  # datetime.timedelta or None
+        self._retainFuture = k.get('retainFuture', None)  # datetime.timedelta or None
+        self._archiveFile = k.get('archiveFile', None)
 
         self._persistentStorage = k.get('persistentStorage', None)  # filepath or None
         self._pv = PV(self._persistentStorage) if self._persistentStorage else None
 
+        # 'full' rewrites every item on each save,
+        # 'journal' appends only the new/changed/deleted items and compacts into a snapshot now and then
+        self._persistenceMode = k.get('persistenceMode', 'full')
+        self._snapshotFormat = k.get('snapshotFormat', 'json')  # 'json' or 'binary', see _DumpSnapshot
+        self._journalMaxBytes = k.get('journalMaxBytes', 256 * 1024)  # compact the journal when it gets bigger than this
+        self._journalPending = {}  # {itemId: calItem or None if deleted} changes not yet written to the journal
+        self._journalGeneration = 0  # the journal file currently being appended to
+        self._journalBytes = 0
+        self._snapshotGeneration = 0  # the oldest journal file that may still exist on disk
+        self._snapshotNumber = 0  # counts the snapshots written, see _WriteSnapshot
+        self._journalSyncToken = None  # the syncToken in the journal, see _AppendToJournal
+        self._compactingJournal = False
+        self._compactThread = None
+        self._journalLock = threading.Lock()  # guards swapping _journalPending
+
         # init
 
+        # Saves are written behind by _timerSaveToFile, a burst of RegisterCalendarItems calls becomes one save.
+        # The save happens once nothing has changed for saveDelay seconds,
+        #   but never more than saveMaxDelay seconds after the first unsaved change.
+        self._saveDelay = k.get('saveDelay', 10)
+        self._saveMaxDelay = k.get('saveMaxDelay', 60)
+        self._firstUnsavedTime = None
+        self._lastChangeTime = 0
+        self._saveScheduled = False
+        self._saveLock = threading.RLock()  # only one save at a time, the timer thread or Flush()
+        self._saveTimerLock = threading.Lock()  # starting/stopping _timerSaveToFile, never held during a save
+
         self._shouldSave = False
-        self._timerSaveToFile = Timer(10, self.SaveCalendarItemsToFile)
+        self._timerSaveToFile = Timer(1, self._SaveTimerTick)
         self._timerSaveToFile.Stop()
+        if self._persistentStorage:
+            atexit.register(_FlushOnExit, weakref.ref(self))
 
         self.LoadCalendarItemsFromFile()
-        self.print('_BaseCalendar.__init__(', a, k)
+        self._metrics.Log('_BaseCalendar.__init__({}, {})', a, k)
 
     def print(self, *a, **k):
         if self._debug:
             print(*a, **k)
 
+    @property
+    def _calendarItems(self):
+        # {str(id): calItemObj} backed by the current snapshot, looking up a missing id returns None.
+        # Kept for subclasses, the library itself reads self._snapshot.
+        return _CalendarItems(self)
+
+    @_calendarItems.setter
+    def _calendarItems(self, calItems):
+        # replaces every item, e.g. self._calendarItems = {}
+        with self._writeLock:
+            calItems = dict(calItems)
+            self._Commit(
+                list(calItems.values()),
+                [itemId for itemId in self._snapshot.items if itemId not in calItems],
+            )
+
+    @property
+    def _index(self):
+        # the _CalendarIndex of the current snapshot
+        return self._snapshot.index
+
+    def _Commit(self, upserts, deleteIds):
+        '''
+        Publish a new snapshot with the upserts added/replaced and the deleteIds removed.
+        Caller must hold self._writeLock.
+
+        :param upserts: list of CalendarItem objs with unique ItemIds
+        :param deleteIds: list of ItemIds
+        :return:
+        '''
+        snapshot = self._snapshot.Copy()
+        snapshot.Apply(upserts, deleteIds)
+        self._snapshot = snapshot  # readers see the old or the new snapshot, never something in between
+        for calItem in upserts:
+            self._JournalChange(calItem.Get('ItemId'), calItem)
+        for itemId in deleteIds:
+            self._JournalChange(itemId, None)
+
+    @property
+    def Metrics(self):
+        '''
+        Counters and timers for sync, reconcile size, callbacks, save/load and queries.
+        Empty unless the calendar was created with instrument=True (or EnableMetrics(True) was called).
+
+        :return: dict like {
+            'counters': {'reconcile.items': 5200, 'reconcile.new': 12, ...},
+            'timers': {'sync': {'count': 52, 'total': 0.81, 'max': 0.05, 'last': 0.012}, ...},
+            'callbacks': {'New': {'calls': 12, ...}, 'queued': 0},
+            }
+        '''
+        ret = self._metrics.Metrics
+        ret['callbacks'] = self._dispatcher.Stats
+        return ret
+
+    def EnableMetrics(self, enabled=True):
+        self._metrics.enabled = enabled
+
+    def ResetMetrics(self):
+        self._metrics.Reset()
+
     @property
     def NewCalendarItem(self):
         return self._NewCalendarItem
@@ -310,6 +2242,83 @@ class _BaseCalendar:
     def CalendarItemDeleted(self, func):
         self._CalendarItemDeleted = func
 
+    ############
+    @property
+    def CalendarItemsBatch(self):
+        '''
+        Used instead of NewCalendarItem/CalendarItemChanged/CalendarItemDeleted when batchCallbacks=True.
+        Called like func(calendar, {'New': [calItem, ...], 'Changed': [...], 'Deleted': [...]})
+        '''
+        return self._CalendarItemsBatch
+
+    @CalendarItemsBatch.setter
+    def CalendarItemsBatch(self, func):
+        self._CalendarItemsBatch = func
+
+    ############
+    @property
+    def EventStarted(self):
+        '''
+        Called like func(calendar, calItem) when an item's start time is reached.
+        Setting any of EventStarted/EventEnded/RoomStateChanged arms a Timer for the next start/end,
+            so there is no need to poll GetNowCalItems.
+        '''
+        return self._EventStarted
+
+    @EventStarted.setter
+    def EventStarted(self, func):
+        self._EventStarted = func
+        self._WatchTransitions()
+
+    @property
+    def EventEnded(self):
+        # Called like func(calendar, calItem) when an item's end time has passed, or it was deleted/moved while in progress
+        return self._EventEnded
+
+    @EventEnded.setter
+    def EventEnded(self, func):
+        self._EventEnded = func
+        self._WatchTransitions()
+
+    @property
+    def RoomStateChanged(self):
+        # Called like func(calendar, state), state is 'Occupied' when any item is in progress, else 'Vacant'
+        return self._RoomStateChanged
+
+    @RoomStateChanged.setter
+    def RoomStateChanged(self, func):
+        self._RoomStateChanged = func
+        self._WatchTransitions()
+
+    @property
+    def RoomState(self):
+        # 'Occupied', 'Vacant', or None until one of the transition callbacks is set
+        return self._roomState
+
+    ############
+    @property
+    def WriteFailed(self):
+        '''
+        Called like func(calendar, kind, calItem, exception) when a queued write is given up on and rolled back.
+        kind is 'Create', 'Change' or 'Delete', calItem is the item as it was queued (the original for 'Delete').
+        '''
+        return self._WriteFailed
+
+    @WriteFailed.setter
+    def WriteFailed(self, func):
+        self._WriteFailed = func
+
+    @property
+    def CallbackStats(self):
+        '''
+        :return: dict like {'New': {'calls': 3, 'dropped': 0, 'slow': 0, 'errors': 0, 'totalTime': 0.01, 'maxTime': 0.004}, ..., 'queued': 0}
+        '''
+        return self._dispatcher.Stats
+
+    def WaitForCallbacks(self):
+        # blocks until every queued callback has been called, only useful with callbackMode='async'
+        self._dispatcher.Join()
+
     ############
     @property
     def Connected(self):
@@ -329,11 +2338,11 @@ class _BaseCalendar:
         self._Disconnected = func
 
     def _NewConnectionStatus(self, state):
-        self.print('_NewConnectionStatus(', state)
+        self._metrics.Log('_NewConnectionStatus({})', state)
 
         self._lastUpdateTime = time.time()
-        self.print('lastUpdateTime=', self._lastUpdateTime)
-        self._shouldSave = True
+        self._metrics.Log('lastUpdateTime={}', self._lastUpdateTime)
+        self._ScheduleSave()
 
         if state != self._connectionStatus:
             # the connection status has changed
@@ -407,27 +2416,288 @@ class _BaseCalendar:
 
     # Dont override these below (unless you dare) #########################
 
-    def GetCalendarItemsBySubject(self, exactMatch=None, partialMatch=None):
-        ret = []
-        for calItem in self._calendarItems.values():
-            # self.print('426 searching for exactMatch={}, partialMatch={}'.format(exactMatch, partialMatch))
-            if calItem.Get('Subject') == exactMatch:
-                calItem = self._UpdateItemFromServer(calItem)
-                ret.append(calItem)
+    def QueueCreateCalendarEvent(self, subject, body, startDT, endDT):
+        '''
+        Like CreateCalendarEvent, but returns right away.
+        The item is added in memory with a temporary ItemId and NewCalendarItem is called,
+            then CreateCalendarEvent is called on a background thread.
+        If CreateCalendarEvent returns the new CalendarItem it replaces the temporary one,
+            else the temporary one is replaced by the server's item on the next sync.
+        If the server rejects it the temporary item is deleted again and WriteFailed is called.
+
+        :param subject:
+        :param body:
+        :param startDT:
+        :param endDT:
+        :return: the temporary CalendarItem
+        '''
+        itemId = 'pending-{:x}-{}'.format(int(time.time()), next(self._writeIds))
+        calItem = _CalendarItem(startDT, endDT, {'ItemId': itemId, 'Subject': subject, 'Body': body}, self)
+        self._QueueWrite('Create', itemId, None, calItem, True)
+        return calItem
+
+    def QueueChangeEventTime(self, calItem, newStartDT, newEndDT):
+        '''
+        Like ChangeEventTime, but returns right away.
+        The item is moved in memory and CalendarItemChanged is called, then ChangeEventTime is called on a background thread.
+        Moving the same item again before it was sent makes one ChangeEventTime call, with the last time.
+        If the server rejects it the item is moved back, CalendarItemChanged is called again and then WriteFailed.
+
+        :param calItem:
+        :param newStartDT:
+        :param newEndDT:
+        :return: the moved CalendarItem
+        '''
+        itemId = calItem.Get('ItemId')
+        original = self._snapshot.items.get(itemId, None)
+        # the occurrences of a recurring series are not items in memory, they are only sent
+        local = original is not None
+        original = original or calItem
+        moved = _CalendarItem(newStartDT, newEndDT, original._ExportData(), self)
+        self._QueueWrite('Change', itemId, original, moved, local)
+        return moved
+
+    def QueueDeleteEvent(self, calItem):
+        '''
+        Like DeleteEvent, but returns right away.
+        The item is removed from memory and CalendarItemDeleted is called, then DeleteEvent is called on a background thread.
+        If the server rejects it the item is put back, NewCalendarItem is called and then WriteFailed.
+
+        :param calItem:
+        :return:
+        '''
+        itemId = calItem.Get('ItemId')
+        original = self._snapshot.items.get(itemId, None)
+        local = original is not None
+        self._QueueWrite('Delete', itemId, original or calItem, None, local)
+
+    def WaitForWrites(self, timeout=None):
+        '''
+        Blocks until every queued write has been sent (or given up on), including the retries.
+
+        :param timeout: float seconds, None waits forever
+        :return: bool, False if it timed out
+        '''
+        with self._writeCondition:
+            return self._writeCondition.wait_for(lambda: not self._writes and self._writing is None, timeout)
+
+    @property
+    def WriteStats(self):
+        '''
+        :return: dict like {'queued': 12, 'coalesced': 4, 'sent': 7, 'retries': 2, 'failed': 1, 'pending': 1}
+            queued counts the Queue* calls, coalesced the ones that were merged into a write that was not sent yet
+        '''
+        with self._writeCondition:
+            ret = self._writeStats.copy()
+            ret['pending'] = len(self._writes) + (self._writing is not None)
+        return ret
+
+    def _QueueWrite(self, kind, itemId, original, current, local):
+        # Applies the write in memory with the usual callbacks, then queues it for _WriteLoop, merged with the one
+        #   already waiting for the same item. current is None for 'Delete'
+        with self._writeCondition:
+            # before _WriteLoop can see it, so a rollback of a quick rejection always comes after this
+            if local:
+                self._ApplyLocally(itemId, current)
+
+            self._writeStats['queued'] += 1
+            write = self._writes.get(itemId, None)
+            if write is None:
+                self._writes[itemId] = _PendingWrite(kind, itemId, original, current, local)
+            else:
+                self._writeStats['coalesced'] += 1
+                if write.kind == 'Create' and kind == 'Delete':
+                    del self._writes[itemId]  # never sent, so there is nothing to delete on the server
+                elif write.kind == 'Create':
+                    write.current = current  # create it with the new time
+                else:
+                    # write.original is kept, so a rollback undoes all of the merged changes
+                    write.kind = kind
+                    write.current = current
+
+            if self._writeThread is None:
+                self._writeThread = threading.Thread(target=self._WriteLoop, daemon=True)
+                self._writeThread.start()
+            self._writeCondition.notify_all()
+
+    def _ApplyLocally(self, itemId, calItem):
+        # calItem None deletes itemId. Goes through _Reconcile like a delta sync, so the callbacks/transitions/save happen
+        if calItem is None:
+            self._Reconcile([], None, None, deletedIds=[itemId])
+        else:
+            self._Reconcile([calItem], None, None, deletedIds=())
+
+    def _PendingWriteIds(self):
+        # the ItemIds with a write queued or being sent, a sync must not overwrite/delete them meanwhile
+        if not self._writes and self._writing is None:
+            return ()
+        with self._writeCondition:
+            ret = set(self._writes)
+            if self._writing is not None:
+                ret.add(self._writing.itemId)
+        return ret
+
+    def _WriteLoop(self):
+        # Sends the queued writes one at a time, oldest first. Exits when there is nothing left to send.
+        while True:
+            with self._writeCondition:
+                while True:
+                    nowTime = time.monotonic()
+                    write = None
+                    for thisWrite in self._writes.values():
+                        if thisWrite.dueTime <= nowTime:
+                            write = thisWrite
+                            break
+                    if write is not None or not self._writes:
+                        break
+                    # everything left is waiting to be retried
+                    self._writeCondition.wait(min(w.dueTime for w in self._writes.values()) - nowTime)
+
+                if write is None:
+                    self._writeThread = None
+                    self._writeCondition.notify_all()
+                    return
+
+                del self._writes[write.itemId]
+                self._writing = write
+
+            try:
+                result = self._SendWrite(write)
+                error = None
+            except Exception as e:
+                result = None
+                error = e
+
+            self._WriteDone(write, result, error)
+
+    def _SendWrite(self, write):
+        current = write.current
+        if write.kind == 'Create':
+            return self.CreateCalendarEvent(current.Get('Subject'), current.Get('Body'), current.Get('Start'), current.Get('End'))
+        elif write.kind == 'Change':
+            return self.ChangeEventTime(write.original, current.Get('Start'), current.Get('End'))
+        else:
+            return self.DeleteEvent(write.original)
+
+    def _WriteDone(self, write, result, error):
+        replace = None  # (tempId, calItem) when a created item replaces its temporary one
+        rollback = False
+        with self._writeCondition:
+            newer = self._writes.get(write.itemId, None)  # queued for the same item while this one was being sent
+
+            if error is None:
+                self._writeStats['sent'] += 1
+                if write.kind == 'Create' and isinstance(result, _CalendarItem):
+                    realId = result.Get('ItemId')
+                    if newer is None:
+                        replace = (write.itemId, result)
+                    else:
+                        # newer was queued against the temporary item, send it for the real one
+                        del self._writes[write.itemId]
+                        newer.itemId = realId
+                        newer.original = result
+                        if newer.current is not None:
+                            newer.current = _CalendarItem(
+                                newer.current.Get('Start'), newer.current.Get('End'), result._ExportData(), self)
+                            replace = (write.itemId, newer.current)
+                        self._writes[realId] = newer
+
+            elif not isinstance(error, WriteRejected) and write.attempts + 1 < self._writeMaxAttempts:
+                self._writeStats['retries'] += 1
+                write.attempts += 1
+                write.lastError = error
+                write.dueTime = time.monotonic() + min(
+                    self._writeBackoff * 2 ** (write.attempts - 1), self._writeMaxBackoff)
+                if newer is None:
+                    self._writes[write.itemId] = write
+                else:
+                    self._Supersede(write, newer)
+                    newer.attempts = write.attempts
+                    newer.dueTime = write.dueTime
 
-            elif partialMatch and partialMatch in calItem.Get('Subject'):
-                calItem = self._UpdateItemFromServer(calItem)
-                ret.append(calItem)
+            else:
+                self._writeStats['failed'] += 1
+                if newer is None:
+                    rollback = True
+                else:
+                    self._Supersede(write, newer)  # the newer change is still wanted, it is sent instead
+
+        if replace:
+            tempId, calItem = replace
+            self._Reconcile([calItem], None, None, deletedIds=[tempId])
+
+        if rollback:
+            ProgramLog('Error 690: {} {} of {} failed: {}'.format(self, write.kind, write.itemId, error), 'warning')
+            if write.local:
+                if write.kind == 'Create':
+                    self._ApplyLocally(write.itemId, None)
+                else:
+                    self._ApplyLocally(write.itemId, write.original)
+            self._dispatcher.Dispatch(
+                'WriteFailed', self._WriteFailed, self, write.kind, write.current or write.original, error)
+
+        # only now, so WaitForWrites returns after the item in memory is updated
+        with self._writeCondition:
+            self._writing = None
+            self._writeCondition.notify_all()
+
+    def _Supersede(self, write, newer):
+        # write failed and newer was queued for the same item meanwhile, the server still has write.original
+        # caller must hold self._writeCondition
+        if write.kind != 'Create':
+            newer.original = write.original
+        elif newer.kind == 'Delete':
+            del self._writes[newer.itemId]  # it was never created, and it is already deleted in memory
+        else:
+            newer.kind = 'Create'
+            newer.original = None
 
+    def GetCalendarItemsBySubject(self, exactMatch=None, partialMatch=None):
+        with self._metrics.Measure('query.GetCalendarItemsBySubject'):
+            ret = self._index.BySubject(exactMatch, partialMatch)
+        if ret:
+            ret = self._UpdateItemsFromServer(ret)
         return ret
 
+    def _UpdateItemsFromServer(self, calItems):
+        '''
+        Subclasses can override this to refresh several items with one request to the server
+
+        :param calItems: list of CalendarItem objects
+        :return: list of the refreshed CalendarItem objects
+        '''
+        if hasattr(self, '_UpdateItemFromServer'):
+            # subclasses that only know how to refresh one item at a time
+            return [self._UpdateItemFromServer(calItem) for calItem in calItems]
+        return calItems
+
+    def _AttachmentsFor(self, calItem):
+        # see _CalendarItem.Attachments
+        if self._attachmentCache is None:
+            return self.GetAttachments(calItem)
+        return self._attachmentCache.Attachments(calItem, self.GetAttachments)
+
+    @property
+    def AttachmentCacheStats(self):
+        '''
+        :return: dict like {'hits': 40, 'misses': 3, 'diskHits': 1, 'evicted': 2, 'invalidated': 1, 'items': 3, 'bytes': 81920, 'diskBytes': 0}
+            hits/misses count both the attachment lists and the contents, only misses ask the server
+        '''
+        if self._attachmentCache is None:
+            return {}
+        return self._attachmentCache.Stats
+
+    def ClearAttachmentCache(self):
+        if self._attachmentCache is not None:
+            self._attachmentCache.Clear()
+
     def GetCalendarItemByID(self, itemId):
         '''
 
         :param itemId: hashable
         :return: CalendarItem obj or None
         '''
-        ret = self._calendarItems[itemId]
+        ret = self._snapshot.items.get(itemId, None)
         return ret
 
     def GetAllEvents(self):
@@ -435,7 +2705,82 @@ class _BaseCalendar:
 
         :return: iterable of CalendarItem objects
         '''
-        return self._calendarItems.copy().values()
+        return self._snapshot.items.values()  # the snapshot is never changed, no need to copy it
+
+    def ExportNDJSON(self, startDT=None, endDT=None, keys=None, expand=True):
+        '''
+        Yields one json line (no newline) per item, the same fields as item.dict().
+        Only one item is formatted at a time and the items' .Data/.dict() caches are not filled,
+            so exporting every item of a big calendar doesn't hold them all in memory.
+
+        Example:
+        with open('export.ndjson', 'w') as file:
+            for line in calendar.ExportNDJSON():
+                file.write(line + '\n')
+
+        :param startDT: None exports every item, else only items overlapping startDT to endDT
+        :param endDT:
+        :param keys: None for all fields, else an iterable of the keys to include, like ('ItemId', 'Start', 'Subject')
+        :param expand: bool, with a window, True exports the occurrences of recurring series, False their masters
+        :return: generator of str
+        '''
+        snapshot = self._snapshot  # a consistent view for the whole export, even if a sync happens meanwhile
+        if startDT is None:
+            calItems = snapshot.items.values()
+        else:
+            calItems = snapshot.index.Range(startDT, endDT, expand)
+
+        keys = set(keys) if keys is not None else None
+        for calItem in calItems:
+            data = calItem._ExportData()
+            itemStartDT = calItem.Get('Start')
+            itemEndDT = calItem.Get('End')
+            data['Start'] = itemStartDT.timestamp()
+            data['End'] = itemEndDT.timestamp()
+            data['Start_ISO'] = itemStartDT.isoformat()
+            data['End_ISO'] = itemEndDT.isoformat()
+            if keys is not None:
+                data = {key: value for key, value in data.items() if key in keys}
+            yield json.dumps(data)
+
+    def ExportColumns(self, startDT, endDT, keys=('ItemId', 'Subject'), expand=True):
+        '''
+        The items overlapping startDT to endDT as parallel columns, sorted by start.
+
+        Example:
+        columns = calendar.ExportColumns(nowDT, nowDT + datetime.timedelta(days=7))
+        columns['Start'][0], columns['End'][0], columns['Subject'][0]
+        numpy.frombuffer(columns['Start'])  # no copy
+
+        :param startDT:
+        :param endDT:
+        :param keys: the data keys to include as list columns
+        :param expand: bool, True exports the occurrences of recurring series, False their masters
+        :return: dict like {
+            'Start': array('d', [timestamp, ...]),
+            'End': array('d', [timestamp, ...]),
+            'ItemId': ['AAMkAG...', ...],
+            'Subject': ['Meeting', ...],
+            }
+        '''
+        calItems = sorted(self._snapshot.index.Range(startDT, endDT, expand), key=_StartKey)
+        columns = {
+            'Start': array('d', [calItem.Get('Start').timestamp() for calItem in calItems]),
+            'End': array('d', [calItem.Get('End').timestamp() for calItem in calItems]),
+        }
+        for key in keys:
+            columns[key] = []
+
+        for calItem in calItems:
+            if isinstance(calItem, _LazyCalendarItem) and calItem._payload is not None and \
+                    any(key not in calItem._schema.positions for key in keys):
+                data = calItem._ExportData()
+                for key in keys:
+                    columns[key].append(data.get(key, None))
+            else:
+                for key in keys:
+                    columns[key].append(calItem.Get(key))
+        return columns
 
     def GetEventAtTime(self, dt=None):
         '''
@@ -449,44 +2794,57 @@ class _BaseCalendar:
         if dt is None:
             dt = datetime.datetime.now()
 
-        events = []
-
-        for calItem in self._calendarItems.copy().values():
-            if dt in calItem:
-                events.append(calItem)
-
-        return events
+        with self._metrics.Measure('query.GetEventAtTime'):
+            return self._index.At(dt)
 
-    def GetEventsInRange(self, startDT, endDT):
+    def GetEventsInRange(self, startDT, endDT, update=True):
         '''
 
         :param startDT:
         :param endDT:
+        :param update: bool, False returns what is already in memory without asking the server
         :return: list of CalendarItem objects, maybe be empty
         '''
-        self.UpdateCalendar(
-            startDT=startDT,
-            endDT=endDT,
-        )
-        ret = []
-        for item in self._calendarItems.values():
-            if startDT <= item <= endDT:
-                ret.append(item)
+        if update:
+            for missingStartDT, missingEndDT in self._MissingRanges(startDT, endDT):
+                self.UpdateCalendar(
+                    startDT=missingStartDT,
+                    endDT=missingEndDT,
+                )
 
-        return ret
+        with self._metrics.Measure('query.GetEventsInRange'):
+            return self._index.Range(startDT, endDT)
+
+    def _MissingRanges(self, startDT, endDT):
+        # the parts of the window that have to be fetched from the server, counted in RangeCacheStats
+        if self._rangeCacheTTL:
+            # only ask the server for the parts of the window that are not already fresh in memory
+            missing = self._coverage.Missing(startDT, endDT)
+        else:
+            missing = [(startDT, endDT)]
+
+        if missing:
+            self._rangeCacheStats['misses'] += 1
+        else:
+            self._rangeCacheStats['hits'] += 1
+        self._rangeCacheStats['fetches'] += len(missing)
+        return missing
+
+    @property
+    def RangeCacheStats(self):
+        '''
+        :return: dict like {'hits': 10, 'misses': 2, 'fetches': 3}
+            hits were answered from memory, misses needed at least one of the fetches from the server
+        '''
+        return self._rangeCacheStats.copy()
 
     def GetNowCalItems(self):
         # returns list of calendar nowItems happening now
 
-        returnCalItems = []
-
         nowDT = datetime.datetime.now()
 
-        for calItem in self._calendarItems.copy().values():
-            if nowDT in calItem:
-                returnCalItems.append(calItem)
-
-        return returnCalItems
+        with self._metrics.Measure('query.GetNowCalItems'):
+            return self._index.At(nowDT)
 
     def GetNextCalItems(self):
         # return a list CalendarItems
@@ -495,21 +2853,8 @@ class _BaseCalendar:
 
         nowDT = datetime.datetime.now()
 
-        nextStartDT = None
-        for calItem in self._calendarItems.copy().values():
-            startDT = calItem.Get('Start')
-            if startDT > nowDT:  # its in the future
-                if nextStartDT is None or startDT < nextStartDT:  # its sooner than the previous soonest one. (Wha!?)
-                    nextStartDT = startDT
-
-        if nextStartDT is None:
-            return []  # no events in the future
-        else:
-            returnCalItems = []
-            for calItem in self._calendarItems.copy().values():
-                if nextStartDT == calItem.Get('Start'):
-                    returnCalItems.append(calItem)
-            return returnCalItems
+        with self._metrics.Measure('query.GetNextCalItems'):
+            return self._index.Next(nowDT)
 
     def GetPreviousCalItems(self):
         # return a list CalendarItems
@@ -518,21 +2863,8 @@ class _BaseCalendar:
 
         nowDT = datetime.datetime.now()
 
-        previousEndDT = None
-        for calItem in self._calendarItems.copy().values():
-            thisEndDT = calItem.Get('End')
-            if thisEndDT < nowDT:  # its in the past
-                if previousEndDT is None or thisEndDT > previousEndDT:
-                    previousEndDT = thisEndDT
-
-        if previousEndDT is None:
-            return []  # no events in the future
-        else:
-            returnCalItems = []
-            for calItem in self._calendarItems.copy().values():
-                if previousEndDT == calItem.Get('End'):
-                    returnCalItems.append(calItem)
-            return returnCalItems
+        with self._metrics.Measure('query.GetPreviousCalItems'):
+            return self._index.Previous(nowDT)
 
     def RegisterCalendarItems(self, calItems, startDT, endDT, doCallbacks=True):
         '''
@@ -544,117 +2876,609 @@ class _BaseCalendar:
         :param endDT:
         :return:
         '''
-        # Check for new and changed items
-        for thisItem in calItems:
-            itemInMemory = self.GetCalendarItemByID(thisItem.get('ItemId'))
-
-            if itemInMemory is None:
-                # this is a new item
-                self._calendarItems[thisItem.Get('ItemId')] = thisItem
-                if callable(self._NewCalendarItem) and doCallbacks:
-                    self._NewCalendarItem(self, thisItem)
-
-            elif itemInMemory != thisItem:
-                self.print('465')
-                self.print('itemInMemory=', itemInMemory)
-                self.print('thisItem    =', thisItem)
-                self.print('this item exist in memory but has somehow changed')
-
-                self._calendarItems[thisItem.Get('ItemId')] = thisItem  # overwrite the current value
-                if callable(self._CalendarItemChanged) and doCallbacks:
-                    self._CalendarItemChanged(self, thisItem)
-
-        # check for deleted items
-        for itemInMemory in self._calendarItems.copy().values():
-            if startDT <= itemInMemory <= endDT:
-                if itemInMemory not in calItems:
+        with self._metrics.Measure('sync'):
+            self._Reconcile(calItems, startDT, endDT, doCallbacks, keepIds=self._PendingWriteIds())
+        if self._rangeCacheTTL:
+            self._coverage.Add(startDT, endDT)
+
+    def RegisterCalendarChanges(self, calItems, deletedIds=(), syncToken=None, doCallbacks=True):
+        '''
+        For servers that can return only what changed since the last sync (Exchange SyncFolderItems, Google syncToken).
+        Unlike RegisterCalendarItems, items that are not passed are left alone.
+        The same New/Changed/Deleted callbacks are called.
+
+        Example:
+        def UpdateCalendar(self, calendar=None, startDT=None, endDT=None):
+            calItems, deletedIds, newToken = self._GetChangesSince(self.SyncToken)  # SyncToken is None the first time
+            self.RegisterCalendarChanges(calItems, deletedIds, newToken)
+
+        :param calItems: list of the new and changed CalendarItems
+        :param deletedIds: iterable of the ItemIds deleted from the server, ids that are not in memory are ignored
+        :param syncToken: the server's token for this state, saved with the items and returned by .SyncToken
+        :param doCallbacks: bool
+        :return:
+        '''
+        with self._metrics.Measure('sync'):
+            self._Reconcile(calItems, None, None, doCallbacks, deletedIds=deletedIds, keepIds=self._PendingWriteIds())
+        # set after the items are committed, so a save never has a token newer than its items
+        self._syncToken = syncToken
+        self._ScheduleSave()
+
+    @property
+    def SyncToken(self):
+        # the syncToken from the last RegisterCalendarChanges (also restored from disk), or None
+        return self._syncToken
+
+    def ResetSyncToken(self):
+        # call this when the server rejects the token, the next sync should be a full sync
+        self._syncToken = None
+        self._ScheduleSave()
+
+    def _Reconcile(self, calItems, startDT, endDT, doCallbacks=True, deletedIds=None, keepIds=()):
+        # With startDT/endDT, items in memory in that window that are not in calItems were deleted.
+        # With deletedIds instead (startDT/endDT None), only those were deleted.
+        # The items in keepIds are left as they are in memory, see _PendingWriteIds
+        if deletedIds is not None:
+            deletedIds = set(deletedIds)
+            calItems = [calItem for calItem in calItems if calItem.Get('ItemId') not in deletedIds]  # a delete wins
+
+        with self._writeLock:
+            snapshot = self._snapshot
+            lowDT, highDT = self._RetentionWindow()
+            evicted = snapshot.index.Outside(lowDT, highDT) if lowDT or highDT else []
+            evictedIds = {calItem.Get('ItemId') for calItem in evicted}
+
+            # Check for new and changed items
+            incomingIds = set()
+            accepted = {}  # {itemId: calItem} the items that will go into the new snapshot
+            changes = []  # [(kind, calItem), ...] for the callbacks, in order
+            for thisItem in calItems:
+                itemId = thisItem.Get('ItemId')
+                incomingIds.add(itemId)
+                if itemId in keepIds:
+                    continue
+                if (lowDT or highDT) and _IsOutside(thisItem, lowDT, highDT):
+                    # outside the retention window, not kept. If it moved there, the copy in memory is evicted
+                    if itemId in snapshot.items and itemId not in evictedIds:
+                        evicted.append(thisItem)
+                        evictedIds.add(itemId)
+                    continue
+
+                itemInMemory = accepted.get(itemId, None)
+                if itemInMemory is None:
+                    itemInMemory = snapshot.items.get(itemId, None)
+
+                if itemInMemory is None:
+                    # this is a new item
+                    accepted[itemId] = thisItem
+                    changes.append(('New', thisItem))
+
+                elif itemInMemory.Fingerprint != thisItem.Fingerprint:
+                    self._metrics.Log(
+                        'this item exist in memory but has somehow changed\nitemInMemory={}\nthisItem    ={}',
+                        itemInMemory,
+                        thisItem,
+                    )
+                    accepted[itemId] = thisItem  # overwrite the current value
+                    changes.append(('Changed', thisItem))
+
+            if evictedIds & accepted.keys():
+                # moved back into the retention window, the new version replaces the one that would be evicted
+                evictedIds -= accepted.keys()
+                evicted = [calItem for calItem in evicted if calItem.Get('ItemId') in evictedIds]
+
+            # check for deleted items
+            if deletedIds is None:
+                candidates = snapshot.index.Range(startDT, endDT, expand=False)
+            else:
+                candidates = [snapshot.items.get(itemId, None) for itemId in deletedIds]
+            removeIds = []
+            for itemInMemory in candidates:
+                if itemInMemory is None:
+                    continue
+                itemId = itemInMemory.Get('ItemId')
+                if itemId not in incomingIds and itemId not in evictedIds and itemId not in keepIds:
                     # a event was deleted from the exchange server
-                    self._calendarItems.pop(itemInMemory.Get('ItemId'), None)
-                    if callable(self._CalendarItemDeleted) and doCallbacks:
-                        self._CalendarItemDeleted(self, itemInMemory)
-        self.print('552 len(self._calendarItems)=', len(self._calendarItems))
+                    removeIds.append(itemId)
+                    changes.append(('Deleted', itemInMemory))
+
+            if accepted or removeIds or evictedIds:
+                self._Commit(list(accepted.values()), removeIds + list(evictedIds))
+
+        if changes and self._attachmentCache is not None:
+            # the attachments may have changed too, the next .Attachments asks the server again
+            self._attachmentCache.Invalidate(calItem.Get('ItemId') for kind, calItem in changes)
+
+        if evicted:
+            self._Evicted(evicted)
+
+        # the callbacks are called after the new snapshot is published, and without holding the lock
+        batch = {'New': [], 'Changed': [], 'Deleted': []} if doCallbacks else None
+        if doCallbacks:
+            for kind, calItem in changes:
+                self._Notify(batch, kind, calItem)
+
+        if batch and (batch['New'] or batch['Changed'] or batch['Deleted']):
+            self._dispatcher.Dispatch('Batch', self._CalendarItemsBatch, self, batch)
+
+        if accepted or removeIds or evictedIds:
+            self._CheckTransitions()  # the schedule changed, the next transition may be different
+
+        self._metrics.Count('reconcile.calls')
+        self._metrics.Count('reconcile.items', len(calItems))
+        self._metrics.Log('len(self._calendarItems)={}', len(self._snapshot.items))
+        self._ScheduleSave()
+
+    def _RetentionWindow(self):
+        # returns (lowDT, highDT), the items to keep end at/after lowDT and start at/before highDT. None means no limit
+        if self._retainPast is None and self._retainFuture is None:
+            return None, None
+        nowDT = datetime.datetime.now()
+        return (
+            nowDT - self._retainPast if self._retainPast is not None else None,
+            nowDT + self._retainFuture if self._retainFuture is not None else None,
+        )
+
+    def _EnforceRetention(self):
+        # drop the items that have moved outside the retention window since the last sync
+        lowDT, highDT = self._RetentionWindow()
+        if lowDT is None and highDT is None:
+            return
+
+        with self._writeLock:
+            evicted = self._snapshot.index.Outside(lowDT, highDT)
+            if evicted:
+                self._Commit([], [calItem.Get('ItemId') for calItem in evicted])
+
+        if evicted:
+            self._Evicted(evicted)
+            self._shouldSave = True
+            self._CheckTransitions()
+
+    def _Evicted(self, calItems):
+        # these items were dropped by the retention policy, they were not deleted from the server so no callbacks
+        self._metrics.Count('retention.evicted', len(calItems))
+        if self._attachmentCache is not None:
+            self._attachmentCache.Invalidate(calItem.Get('ItemId') for calItem in calItems)
+        self._metrics.Log('retention dropped {} items', len(calItems))
+        if self._archiveFile:
+            try:
+                text = ''.join(json.dumps(calItem.dict()) + '\n' for calItem in calItems)
+                with File(self._archiveFile, 'a') as file:
+                    file.write(text)
+            except Exception as e:
+                ProgramLog('Error 670: {} archiving calendar items: {}'.format(self, e), 'error')
+
+    def _WatchTransitions(self):
+        if self._nowItems is None:
+            # the items already in progress are reported as started
+            self._nowItems = {}
+            self._CheckTransitions()
+
+    def _TransitionTimerTick(self, timer, count):
+        timer.Stop()
+        self._CheckTransitions()
+
+    def _CheckTransitions(self):
+        # Compares what is in progress now with the last check, calls the callbacks,
+        #   then arms _timerTransition for the soonest start/end after now.
+        if self._nowItems is None:
+            return  # no transition callbacks
+
+        with self._transitionLock:
+            nowDT = datetime.datetime.now()
+            index = self._index
+            nowItems = {calItem.Get('ItemId'): calItem for calItem in index.At(nowDT)}
+            ended = [calItem for itemId, calItem in self._nowItems.items() if itemId not in nowItems]
+            started = [calItem for itemId, calItem in nowItems.items() if itemId not in self._nowItems]
+            self._nowItems = nowItems
+
+            state = 'Occupied' if nowItems else 'Vacant'
+            stateChanged = state != self._roomState
+            self._roomState = state
+
+            nextDT = None
+            for calItem in nowItems.values():
+                if nextDT is None or calItem.Get('End') < nextDT:
+                    nextDT = calItem.Get('End')
+            nextItems = index.Next(nowDT)
+            if nextItems and (nextDT is None or nextItems[0].Get('Start') < nextDT):
+                nextDT = nextItems[0].Get('Start')
+
+            if nextDT is None:
+                self._timerTransition.Stop()
+            else:
+                # an item is still in progress at its End, so wake up just after it.
+                # never wait too long, in case the system clock is changed
+                seconds = (nextDT - nowDT).total_seconds() + _TRANSITION_MARGIN
+                self._timerTransition.Change(min(max(seconds, _TRANSITION_MARGIN), _TRANSITION_MAX_WAIT))
+                self._timerTransition.Restart()
+
+        self._metrics.Log('_CheckTransitions started={} ended={} next={}', started, ended, nextDT)
+        for calItem in ended:
+            self._dispatcher.Dispatch('EventEnded', self._EventEnded, self, calItem)
+        for calItem in started:
+            self._dispatcher.Dispatch('EventStarted', self._EventStarted, self, calItem)
+        if stateChanged:
+            self._dispatcher.Dispatch('RoomStateChanged', self._RoomStateChanged, self, state)
+
+    def _Notify(self, batch, kind, calItem):
+        # kind is 'New', 'Changed' or 'Deleted'
+        self._metrics.Count('reconcile.' + kind)
+        if self._batchCallbacks:
+            batch[kind].append(calItem)
+        elif kind == 'New':
+            self._dispatcher.Dispatch(kind, self._NewCalendarItem, self, calItem)
+        elif kind == 'Changed':
+            self._dispatcher.Dispatch(kind, self._CalendarItemChanged, self, calItem)
+        elif kind == 'Deleted':
+            self._dispatcher.Dispatch(kind, self._CalendarItemDeleted, self, calItem)
+
+    def _ScheduleSave(self):
+        # cheap, no disk access. The save itself happens on the timer thread, see _SaveTimerTick
         self._shouldSave = True
+        if not self._persistentStorage:
+            return
+
+        self._lastChangeTime = time.time()
+        if self._firstUnsavedTime is None:
+            self._firstUnsavedTime = self._lastChangeTime
+
+        with self._saveTimerLock:
+            if not self._saveScheduled:
+                self._saveScheduled = True
+                self._timerSaveToFile.Restart()
+
+    def _SaveTimerTick(self, *args):
+        with self._saveTimerLock:
+            # checked under the lock, so a _ScheduleSave can't slip in between the check and the Stop()
+            if not self._shouldSave:
+                self._saveScheduled = False
+                self._timerSaveToFile.Stop()
+                return
+
+        nowTime = time.time()
+        if nowTime - self._lastChangeTime >= self._saveDelay or \
+                nowTime - (self._firstUnsavedTime or nowTime) >= self._saveMaxDelay:
+            try:
+                self.SaveCalendarItemsToFile()
+            except Exception as e:
+                ProgramLog('Error 650: {} saving calendar items: {}'.format(self, e), 'error')
+
+    def Flush(self):
+        '''
+        Write any unsaved changes to disk now, and wait for a journal compaction to finish.
+        Called automatically when the calendar is deleted or the program exits.
+        '''
+        with self._saveTimerLock:
+            self._timerSaveToFile.Stop()
+            self._saveScheduled = False
+        self.SaveCalendarItemsToFile()
+        compactThread = self._compactThread
+        if compactThread:
+            compactThread.join()
 
     def SaveCalendarItemsToFile(self):
-        self.print('SaveCalendarItemsToFile() self=', self)
-        if self._persistentStorage and self._shouldSave:
-            self._shouldSave = False
-            self._pv.Set('lastUpdateTime', self._lastUpdateTime)
-            self._pv.Set('lastUpdateTime_ISO', datetime.datetime.fromtimestamp(self._lastUpdateTime).isoformat())
-            items = []
-            for item in self._calendarItems.values():
-                if item:
-                    items.append(item.dict())
-            self._pv.Set('items', items)
+        self._metrics.Log('SaveCalendarItemsToFile() self={}', self)
+        with self._saveLock:
+            if self._persistentStorage and self._shouldSave:
+                self._EnforceRetention()
+                self._shouldSave = False
+                self._firstUnsavedTime = None
+                with self._metrics.Measure('save'):
+                    if self._persistenceMode == 'journal':
+                        self._AppendToJournal()
+                    else:
+                        syncToken = self._syncToken  # read before the items, see RegisterCalendarChanges
+                        self._WriteSnapshot(list(self._snapshot.items.values()), syncToken=syncToken)
+
+    def _WriteSnapshot(self, calItems, journalGeneration=None, syncToken=None):
+        # one write of the whole snapshot, see _ReplaceSnapshot
+        number = self._snapshotNumber + 1
+        if self._snapshotFormat == 'binary':
+            meta = {'snapshotNumber': number, 'lastUpdateTime': self._lastUpdateTime, 'syncToken': syncToken}
+            if journalGeneration is not None:
+                meta['journalGeneration'] = journalGeneration
+            self._ReplaceSnapshot(number, _DumpSnapshot([item for item in calItems if item], meta), 'wb')
+            return
+
+        items = []
+        for item in calItems:
+            if item:
+                items.append(item.dict())
+        data = {
+            'snapshotNumber': number,
+            'lastUpdateTime': self._lastUpdateTime,
+            'lastUpdateTime_ISO': datetime.datetime.fromtimestamp(self._lastUpdateTime).isoformat(),
+            'items': items,
+            'syncToken': syncToken,  # after the items, so a token is never newer than the items next to it
+        }
+        if journalGeneration is not None:
+            data['journalGeneration'] = journalGeneration
+        self._ReplaceSnapshot(number, json.dumps(data), 'w')
+
+    def _ReplaceSnapshot(self, number, raw, mode):
+        # The snapshots take turns between two files, so the one being written is never the only copy.
+        #   The older file is deleted once the new one is complete.
+        #   If we lose power during the write, the new file can't be read and the older one is loaded instead.
+        with File(self._SnapshotPath(number), mode) as file:
+            file.write(raw)
+
+        for path in (self._SnapshotPath(number - 1), self._LegacySnapshotPath()):
+            if File.Exists(path):
+                File.DeleteFile(path)
+        self._snapshotNumber = number
+
+    def _SnapshotPath(self, number):
+        return '{}.snapshot{}.{}'.format(
+            self._persistentStorage, number % 2, 'bin' if self._snapshotFormat == 'binary' else 'json')
+
+    def _LegacySnapshotPath(self):
+        # the file the snapshot was kept in before they were numbered
+        if self._snapshotFormat == 'binary':
+            return '{}.bin'.format(self._persistentStorage)
+        return self._persistentStorage
+
+    def _ReadSnapshot(self):
+        '''
+        The newest snapshot that can be read, see _ReplaceSnapshot.
 
-    def LoadCalendarItemsFromFile(self):
-        self.print('LoadCalendarItemsFromFile() self=', self)
-        if self._persistentStorage:
+        :return: tuple of (dict of the meta data, {itemId: item dict or CalendarItem obj})
+        '''
+        newest = None
+        for slot in (0, 1):
+            path = self._SnapshotPath(slot)
+            if not File.Exists(path):
+                continue
             try:
-
+                found = self._ParseSnapshot(path)
+            except Exception as e:
+                ProgramLog('Error 613: {} could not read {}, it was probably cut off: {}'.format(
+                    self, path, e), 'warning')
+                continue
+            if newest is None or found[0]['snapshotNumber'] > newest[0]['snapshotNumber']:
+                newest = found
+
+        if newest is None:
+            # from before the snapshots were numbered
+            if self._snapshotFormat == 'binary' and File.Exists(self._LegacySnapshotPath()):
+                newest = self._ParseSnapshot(self._LegacySnapshotPath())
+            else:
                 data = self._pv.Get()
-
-                t = data.get('lastUpdateTime', 0)
-                self._lastUpdateTime = t
-                self.print('LoadCalendarItemsFromFile LastUpdate=', self._lastUpdateTime)
-
-                startDT = None
-                endDT = None
-                calItems = []
-                for item in data.get('items', []):
-                    itemData = {}
-                    for k, v, in item.items():
-                        if k not in ['Start', 'End']:
-                            itemData[k] = v
-
-                    thisStartDT = datetime.datetime.fromtimestamp(item['Start'])
-                    thisEndDT = datetime.datetime.fromtimestamp(item['End'])
-
-                    if startDT is None or thisStartDT < startDT:  # used below in RegisterCalendarItems
-                        startDT = thisStartDT
-
-                    if endDT is None or thisEndDT > endDT:
-                        endDT = thisEndDT
-
-                    calItem = _CalendarItem(
-                        startDT=thisStartDT,
-                        endDT=thisEndDT,
-                        data=itemData,
-                        parentCalendar=self,
-                    )
-                    calItems.append(calItem)
-
-                if calItems:
-                    self.RegisterCalendarItems(
-                        calItems,
-                        startDT=startDT or datetime.datetime.now(),
-                        endDT=endDT or datetime.datetime.now(),
-                        doCallbacks=False,
-                    )
+                newest = data, {item['ItemId']: item for item in data.get('items', [])}
+
+        self._snapshotNumber = newest[0].get('snapshotNumber', 0)
+        return newest
+
+    def _ParseSnapshot(self, path):
+        if self._snapshotFormat == 'binary':
+            with File(path, 'rb') as file:
+                data, lazyItems = _LoadSnapshot(file.read(), self)
+            return data, {item.Get('ItemId'): item for item in lazyItems}
+
+        with File(path, 'r') as file:
+            data = json.loads(file.read())
+        return data, {item['ItemId']: item for item in data.get('items', [])}
+
+    def _JournalChange(self, itemId, calItem):
+        # calItem is None when the item was deleted
+        if self._persistenceMode == 'journal':
+            with self._journalLock:
+                self._journalPending[itemId] = calItem
+
+    def _JournalPath(self, generation):
+        return '{}.journal.{}'.format(self._persistentStorage, generation)
+
+    def _AppendToJournal(self):
+        syncToken = self._syncToken  # read before the changes, see RegisterCalendarChanges
+        with self._journalLock:
+            pending, self._journalPending = self._journalPending, {}
+
+        if not pending and syncToken == self._journalSyncToken:
+            # only lastUpdateTime changed, which happens on every poll. Not worth a write to flash,
+            #   it is written with the next change or snapshot
+            return
+
+        try:
+            lines = []
+            for itemId, item in pending.items():
+                if item is None:
+                    lines.append(json.dumps({'op': 'del', 'ItemId': itemId}))
+                else:
+                    lines.append(json.dumps({'op': 'put', 'item': item.dict()}))
+            # last, so if we lose power partway through, the token on disk is never newer than the changes
+            lines.append(json.dumps({'op': 'meta', 'lastUpdateTime': self._lastUpdateTime, 'syncToken': syncToken}))
+            text = '\n'.join(lines) + '\n'
+
+            with File(self._JournalPath(self._journalGeneration), 'a') as file:
+                file.write(text)
+        except Exception:
+            # put the changes back so the next save writes them, anything changed since then is newer
+            with self._journalLock:
+                pending.update(self._journalPending)
+                self._journalPending = pending
+            self._shouldSave = True
+            raise
+
+        self._journalSyncToken = syncToken
+        self._journalBytes += len(text)
+        self._metrics.Count('save.journalRecords', len(pending))
+        self._metrics.Log('_AppendToJournal wrote {} changes, journal is {} bytes', len(pending), self._journalBytes)
+
+        if self._journalBytes > self._journalMaxBytes and not self._compactingJournal:
+            self._CompactJournal()
+
+    def _CompactJournal(self):
+        # New changes go to the next journal file,
+        #   a snapshot of the current items is written in the background,
+        #   then the old journal files are deleted.
+        self._compactingJournal = True
+        syncToken = self._syncToken
+        calItems = list(self._snapshot.items.values())
+        self._journalGeneration += 1
+        self._journalBytes = 0
+        newGeneration = self._journalGeneration
+
+        def Compact():
+            try:
+                self._WriteSnapshot(calItems, journalGeneration=newGeneration, syncToken=syncToken)
+                for generation in range(self._snapshotGeneration, newGeneration):
+                    if File.Exists(self._JournalPath(generation)):
+                        File.DeleteFile(self._JournalPath(generation))
+                self._snapshotGeneration = newGeneration
             except Exception as e:
-                msg = 'Error 612: {} loading calendar items from disk: {}'.format(
-                    self,
-                    e,
+                ProgramLog('Error 640: {} compacting the calendar journal: {}'.format(self, e), 'error')
+            finally:
+                self._compactingJournal = False
+
+        self._compactThread = threading.Thread(target=Compact, daemon=True)
+        self._compactThread.start()
+
+    def _ReplayJournal(self, items):
+        # items is {itemId: itemDict} from the snapshot, updated in place
+        generation = self._snapshotGeneration
+        while File.Exists(self._JournalPath(generation)):
+            with File(self._JournalPath(generation), 'r') as file:
+                text = file.read()
+
+            self._journalGeneration = generation
+            self._journalBytes = len(text)
+            for line in text.splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a partly written line, from losing power during a write
+
+                if record['op'] == 'put':
+                    items[record['item']['ItemId']] = record['item']
+                elif record['op'] == 'del':
+                    items.pop(record['ItemId'], None)
+                elif record['op'] == 'meta':
+                    self._lastUpdateTime = record['lastUpdateTime']
+                    self._syncToken = record.get('syncToken', None)
+
+            generation += 1
+
+        if self._journalGeneration > self._snapshotGeneration:
+            # there is more than one journal file, we must have lost power during a compaction
+            self._journalBytes = self._journalMaxBytes + 1
+
+    def LoadCalendarItemsFromFile(self):
+        self._metrics.Log('LoadCalendarItemsFromFile() self={}', self)
+        if self._persistentStorage:
+            with self._metrics.Measure('load'):
+                self._LoadCalendarItemsFromFile()
+
+    def _LoadCalendarItemsFromFile(self):
+        try:
+
+            data, storedItems = self._ReadSnapshot()
+
+            t = data.get('lastUpdateTime', 0)
+            self._lastUpdateTime = t
+            self._syncToken = data.get('syncToken', None)
+
+            if self._persistenceMode == 'journal':
+                self._snapshotGeneration = data.get('journalGeneration', 0)
+                self._journalGeneration = self._snapshotGeneration
+                self._ReplayJournal(storedItems)
+                self._journalSyncToken = self._syncToken
+
+            self._metrics.Log('LoadCalendarItemsFromFile LastUpdate={}', self._lastUpdateTime)
+
+            startDT = None
+            endDT = None
+            calItems = []
+            for item in storedItems.values():
+                if isinstance(item, _CalendarItem):
+                    calItems.append(item)  # from a binary snapshot
+                    continue
+
+                itemData = {}
+                for k, v, in item.items():
+                    if k not in _DERIVED_KEYS:
+                        itemData[k] = v
+
+                thisStartDT = datetime.datetime.fromtimestamp(item['Start'])
+                thisEndDT = datetime.datetime.fromtimestamp(item['End'])
+
+                calItem = _CalendarItem(
+                    startDT=thisStartDT,
+                    endDT=thisEndDT,
+                    data=itemData,
+                    parentCalendar=self,
+                )
+                calItems.append(calItem)
+
+            if calItems and not self._snapshot.items:
+                # nothing to reconcile against, add them directly without decoding any payloads
+                with self._writeLock:
+                    snapshot = _CalendarSnapshot()
+                    snapshot.Apply(calItems, ())
+                    self._snapshot = snapshot
+
+            elif calItems:
+                for calItem in calItems:
+                    if startDT is None or calItem.Get('Start') < startDT:  # used below in RegisterCalendarItems
+                        startDT = calItem.Get('Start')
+
+                    if endDT is None or calItem.Get('End') > endDT:
+                        endDT = calItem.Get('End')
+
+                self._Reconcile(
+                    calItems,
+                    startDT=startDT or datetime.datetime.now(),
+                    endDT=endDT or datetime.datetime.now(),
+                    doCallbacks=False,
                 )
-                ProgramLog(msg, 'error')
-                if self._debug:
-                    raise e
+            self._journalPending.clear()  # these items are already on disk
+            self._shouldSave = False
+            self._EnforceRetention()  # the file may have items that are now too old
+            if self._shouldSave:
+                self._ScheduleSave()
+        except Exception as e:
+            msg = 'Error 612: {} loading calendar items from disk: {}'.format(
+                self,
+                e,
+            )
+            ProgramLog(msg, 'error')
+            if self._debug:
+                raise e
 
     def __del__(self):
         if self._persistentStorage:
             try:
-                self._timerSaveToFile.Stop()
-                self._timerSaveToFile.Function()
+                self.Flush()
             except Exception as e:
                 ProgramLog('Error 621: {}'.format(e))
 
 
+def _FlushOnExit(calendarRef):
+    # registered with atexit, holds a weakref so it doesn't keep the calendar alive
+    calendar = calendarRef()
+    if calendar is not None:
+        try:
+            calendar.Flush()
+        except Exception as e:
+            ProgramLog('Error 622: {}'.format(e))
+
+
 def ConvertDatetimeToTimeString(dt):
     # converts to UTC time string
     dt = AdjustDatetimeForTimezone(dt, fromZone='Mine')
     return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
 
 
+def ConvertDatetimesToTimeStrings(dts):
+    '''
+    Same as [ConvertDatetimeToTimeString(dt) for dt in dts], but checks the current DST state only once.
+
+    :param dts: iterable of datetime.datetime
+    :return: list of str
+    '''
+    return [dt.strftime('%Y-%m-%dT%H:%M:%SZ') for dt in AdjustDatetimesForTimezone(dts, fromZone='Mine')]
+
+
 def ConvertTimeStringToDatetime(string):
     '''
     Global Scripter blocks the user of 'strptime' for some reason.
@@ -664,11 +3488,39 @@ def ConvertTimeStringToDatetime(string):
     # converts from UTC time string to datetime with my timezone
 
     # dt = datetime.datetime.strptime(string, '%Y-%m-%dT%H:%M:%SZ')
+    dt = _ParseTimeString(string)
+    dt = AdjustDatetimeForTimezone(dt, fromZone='Exchange')
+    return dt
+
+
+def ConvertTimeStringsToDatetimes(strings):
+    '''
+    Same as [ConvertTimeStringToDatetime(string) for string in strings], but checks the current DST state only once.
+
+    :param strings: iterable of str like '2020-01-31T15:00:00Z'
+    :return: list of datetime.datetime
+    '''
+    return AdjustDatetimesForTimezone([_ParseTimeString(string) for string in strings], fromZone='Exchange')
+
+
+def _ParseTimeString(string):
+    if len(string) == 20 and string[4] == '-' and string[7] == '-' and string[10] == 'T' and \
+            string[13] == ':' and string[16] == ':':
+        # the usual 'YYYY-MM-DDTHH:MM:SSZ', slice it instead of splitting
+        return datetime.datetime(
+            int(string[0:4]),
+            int(string[5:7]),
+            int(string[8:10]),
+            int(string[11:13]),
+            int(string[14:16]),
+            int(string[17:19]),
+        )
+
     year, month, etc = string.split('-')
     day, etc = etc.split('T')
     hour, minute, etc = etc.split(':')
     second = etc[:-1]
-    dt = datetime.datetime(
+    return datetime.datetime(
         year=int(year),
         month=int(month),
         day=int(day),
@@ -676,34 +3528,118 @@ def ConvertTimeStringToDatetime(string):
         minute=int(minute),
         second=int(second),
     )
-    dt = AdjustDatetimeForTimezone(dt, fromZone='Exchange')
-    return dt
 
 
 def AdjustDatetimeForTimezone(dt, fromZone):
-    delta = datetime.timedelta(hours=abs(MY_TIME_ZONE))
+    return _timezoneConverter.Adjust(dt, fromZone, _NowIsDST())
 
-    ts = time.mktime(dt.timetuple())
-    lt = time.localtime(ts)
-    dtIsDST = lt.tm_isdst > 0
 
-    nowIsDST = time.localtime().tm_isdst > 0
+def AdjustDatetimesForTimezone(dts, fromZone):
+    '''
+    Same as [AdjustDatetimeForTimezone(dt, fromZone) for dt in dts], but checks the current DST state only once.
+
+    :param dts: iterable of datetime.datetime
+    :param fromZone: 'Mine' or 'Exchange'
+    :return: list of datetime.datetime
+    '''
+    nowIsDST = _NowIsDST()
+    return [_timezoneConverter.Adjust(dt, fromZone, nowIsDST) for dt in dts]
 
-    # print('nowIsDST=', nowIsDST)
-    # print('dtIsDST=', dtIsDST)
 
-    if fromZone == 'Mine':
-        dt = dt + delta
-        if dtIsDST and not nowIsDST:
-            dt -= datetime.timedelta(hours=1)
-        elif nowIsDST and not dtIsDST:
-            dt += datetime.timedelta(hours=1)
+def _NowIsDST():
+    return time.localtime().tm_isdst > 0
 
-    elif fromZone == 'Exchange':
-        dt = dt - delta
-        if dtIsDST and not nowIsDST:
-            dt += datetime.timedelta(hours=1)
-        elif nowIsDST and not dtIsDST:
-            dt -= datetime.timedelta(hours=1)
 
-    return dt
+class _TimezoneConverter:
+    '''
+    Answers "is this local datetime in DST?" without calling time.mktime/time.localtime for every datetime.
+    The first time a year is seen, the moments that year switches in/out of DST are found and cached,
+        after that it is a bisect.
+    '''
+
+    def __init__(self):
+        self._years = {}  # {year: (isDSTAtStartOfYear, [transitionDT, ...], [isDSTAfterTransition, ...])}
+
+    def Adjust(self, dt, fromZone, nowIsDST):
+        delta = datetime.timedelta(hours=abs(MY_TIME_ZONE))
+        dtIsDST = self.IsDST(dt)
+
+        if fromZone == 'Mine':
+            dt = dt + delta
+            if dtIsDST and not nowIsDST:
+                dt -= datetime.timedelta(hours=1)
+            elif nowIsDST and not dtIsDST:
+                dt += datetime.timedelta(hours=1)
+
+        elif fromZone == 'Exchange':
+            dt = dt - delta
+            if dtIsDST and not nowIsDST:
+                dt += datetime.timedelta(hours=1)
+            elif nowIsDST and not dtIsDST:
+                dt -= datetime.timedelta(hours=1)
+
+        return dt
+
+    def IsDST(self, dt):
+        if dt.tzinfo is not None:
+            return _IsDST(dt)  # timetuple() of an aware datetime carries its own dst flag, don't guess
+
+        year = self._years.get(dt.year, None)
+        if year is None:
+            try:
+                year = self._FindTransitions(dt.year)
+            except (OverflowError, ValueError):
+                return _IsDST(dt)  # outside what mktime can handle, let it raise like it always did
+            self._years[dt.year] = year
+
+        isDST, transitions, states = year
+        i = bisect_right(transitions, dt.replace(microsecond=0))  # mktime ignores microseconds
+
+        # Around a transition some local times happen twice (or never),
+        #   what mktime says for those depends on the platform, so ask it directly.
+        if i and dt - transitions[i - 1] < _NEAR_TRANSITION:
+            return _IsDST(dt)
+        if i < len(transitions) and transitions[i] - dt < _NEAR_TRANSITION:
+            return _IsDST(dt)
+
+        return states[i - 1] if i else isDST
+
+    def _FindTransitions(self, year):
+        dayDT = datetime.datetime(year, 1, 1)
+        isDST = _IsDST(dayDT)
+        startIsDST = isDST
+
+        transitions = []
+        states = []
+        oneDay = datetime.timedelta(days=1)
+        while dayDT.year == year:
+            nextDayDT = dayDT + oneDay
+            nextIsDST = _IsDST(nextDayDT)
+            if nextIsDST != isDST:
+                # binary search for the first second of the day that has the new state
+                lowDT, highDT = dayDT, nextDayDT
+                while highDT - lowDT > datetime.timedelta(seconds=1):
+                    middleDT = lowDT + (highDT - lowDT) // 2
+                    middleDT = middleDT.replace(microsecond=0)
+                    if _IsDST(middleDT) == nextIsDST:
+                        highDT = middleDT
+                    else:
+                        lowDT = middleDT
+                transitions.append(highDT)
+                states.append(nextIsDST)
+                isDST = nextIsDST
+            dayDT = nextDayDT
+
+        return startIsDST, transitions, states
+
+
+_NEAR_TRANSITION = datetime.timedelta(hours=3)
+
+
+def _IsDST(dt):
+    ts = time.mktime(dt.timetuple())
+    lt = time.localtime(ts)
+    return lt.tm_isdst > 0
+
+
+_timezoneConverter = _TimezoneConverter()
@@ -0,0 +1,260 @@
+import asyncio
+import datetime
+import math
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # not available on the control processors, the pure python version below is used instead
+
+
+class FreeBusy:
+    '''
+    Free/busy queries across many room calendars, answered from the items each calendar already has in memory.
+
+    The busy time of every room is merged into sorted (start, end) epoch second arrays,
+        and the rooms are laid end to end on one timeline so a query over all rooms is one vectorized pass.
+    Uses numpy if it is installed.
+
+    Example:
+    fb = FreeBusy({'Room A': calA, 'Room B': calB})
+    nowDT = datetime.datetime.now()
+    fb.Refresh(nowDT, nowDT + datetime.timedelta(hours=4))
+    fb.FindFreeSlots(datetime.timedelta(minutes=30))
+    >>> {'Room A': [(datetime(...), datetime(...))], 'Room B': []}
+    '''
+
+    def __init__(self, calendars, update=False):
+        '''
+        :param calendars: dict like {roomName: calendar} or a list of calendars (the calendar is used as the room name)
+            _BaseCalendar or _AsyncBaseCalendar subclass instances
+        :param update: bool, True makes Refresh() ask each calendar's server for the window first,
+            use RefreshAsync() if any of them are _AsyncBaseCalendar
+        '''
+        if isinstance(calendars, dict):
+            self._rooms = list(calendars.keys())
+            self._calendars = list(calendars.values())
+        else:
+            self._rooms = list(calendars)
+            self._calendars = list(calendars)
+        self._update = update
+
+        self._windowStart = None  # epoch seconds
+        self._windowEnd = None
+        self._band = None  # each room gets its own band of this many seconds on the combined timeline
+        self._starts = None  # combined timeline, sorted busy starts
+        self._ends = None  # combined timeline, sorted busy ends
+        self._roomOf = None  # room index of each busy interval
+
+    @property
+    def Rooms(self):
+        return list(self._rooms)
+
+    def Refresh(self, startDT, endDT):
+        '''
+        Rebuild the busy arrays for the window.
+        Must be called before the other methods, and again whenever the calendars change.
+
+        :param startDT:
+        :param endDT:
+        :return:
+        '''
+        calItemLists = []
+        for calendar in self._calendars:
+            if not self._update:
+                # what GetEventsInRange(update=False) returns, without awaiting it for an _AsyncBaseCalendar
+                calItemLists.append(calendar._index.Range(startDT, endDT))
+            elif asyncio.iscoroutinefunction(calendar.GetEventsInRange):
+                raise TypeError('{} is async, use "await FreeBusy.RefreshAsync()" to update it'.format(calendar))
+            else:
+                calItemLists.append(calendar.GetEventsInRange(startDT, endDT, update=True))
+
+        self._Build(startDT, endDT, calItemLists)
+
+    async def RefreshAsync(self, startDT, endDT):
+        '''
+        Same as Refresh() but awaits the _AsyncBaseCalendar ones, their servers are asked at the same time.
+
+        :param startDT:
+        :param endDT:
+        :return:
+        '''
+        async def CalItems(calendar):
+            if not self._update:
+                return calendar._index.Range(startDT, endDT)
+            elif asyncio.iscoroutinefunction(calendar.GetEventsInRange):
+                return await calendar.GetEventsInRange(startDT, endDT, update=True)
+            else:
+                return calendar.GetEventsInRange(startDT, endDT, update=True)
+
+        calItemLists = await asyncio.gather(*(CalItems(calendar) for calendar in self._calendars))
+        self._Build(startDT, endDT, calItemLists)
+
+    def _Build(self, startDT, endDT, calItemLists):
+        # calItemLists has the items of each calendar in the window, in the same order as self._calendars
+        windowStart = math.floor(startDT.timestamp())
+        windowEnd = math.ceil(endDT.timestamp())
+        length = windowEnd - windowStart
+        band = length + 1  # the +1 keeps the end of one room's band from touching the start of the next
+
+        starts = []
+        ends = []
+        roomOf = []
+        for roomIndex, calItems in enumerate(calItemLists):
+            offset = roomIndex * band - windowStart
+            # a zero length interval at both edges of the band, so the gaps at the edges are found too
+            starts.append(roomIndex * band)
+            ends.append(roomIndex * band)
+            roomOf.append(roomIndex)
+
+            for busyStart, busyEnd in _Merge(calItems):
+                busyStart = max(busyStart, windowStart)
+                busyEnd = min(busyEnd, windowEnd)
+                if busyEnd > busyStart:
+                    starts.append(busyStart + offset)
+                    ends.append(busyEnd + offset)
+                    roomOf.append(roomIndex)
+
+            starts.append(roomIndex * band + length)
+            ends.append(roomIndex * band + length)
+            roomOf.append(roomIndex)
+
+        self._windowStart = windowStart
+        self._windowEnd = windowEnd
+        self._band = band
+        if numpy is not None:
+            self._starts = numpy.array(starts, dtype=numpy.int64)
+            self._ends = numpy.array(ends, dtype=numpy.int64)
+            self._roomOf = numpy.array(roomOf, dtype=numpy.int64)
+        else:
+            self._starts = starts
+            self._ends = ends
+            self._roomOf = roomOf
+
+    def BusyIntervals(self, room):
+        '''
+        :param room: a room name (or calendar) that was passed to __init__
+        :return: list of (startDT, endDT) merged busy intervals for that room inside the window
+        '''
+        roomIndex = self._rooms.index(room)
+        offset = roomIndex * self._band - self._windowStart
+        ret = []
+        for start, end, thisRoom in zip(self._starts, self._ends, self._roomOf):
+            if thisRoom == roomIndex and end > start:
+                ret.append((_DT(int(start) - offset), _DT(int(end) - offset)))
+        return ret
+
+    def FindFreeSlots(self, duration, startDT=None, endDT=None):
+        '''
+        The free gaps, at least duration long, in every room.
+
+        :param duration: datetime.timedelta
+        :param startDT: only look at/after this time, None means the start of the window
+        :param endDT: only look at/before this time, None means the end of the window
+        :return: dict like {room: [(startDT, endDT), ...]}, each tuple is a whole free gap
+        '''
+        seconds = duration.total_seconds()
+        low = self._windowStart if startDT is None else max(self._windowStart, math.floor(startDT.timestamp()))
+        high = self._windowEnd if endDT is None else min(self._windowEnd, math.ceil(endDT.timestamp()))
+
+        ret = {room: [] for room in self._rooms}
+        if numpy is not None:
+            roomOf = self._roomOf[:-1]
+            offsets = roomOf * self._band - self._windowStart
+            gapStarts = numpy.maximum(self._ends[:-1] - offsets, low)
+            gapEnds = numpy.minimum(self._starts[1:] - offsets, high)
+            found = numpy.nonzero((roomOf == self._roomOf[1:]) & (gapEnds - gapStarts >= seconds))[0]
+            for i in found.tolist():
+                ret[self._rooms[int(roomOf[i])]].append((_DT(int(gapStarts[i])), _DT(int(gapEnds[i]))))
+
+        else:
+            for i in range(len(self._starts) - 1):
+                roomIndex = self._roomOf[i]
+                if roomIndex != self._roomOf[i + 1]:
+                    continue
+                offset = roomIndex * self._band - self._windowStart
+                gapStart = max(self._ends[i] - offset, low)
+                gapEnd = min(self._starts[i + 1] - offset, high)
+                if gapEnd - gapStart >= seconds:
+                    ret[self._rooms[roomIndex]].append((_DT(gapStart), _DT(gapEnd)))
+
+        return ret
+
+    def FirstFreeSlot(self, duration, startDT=None, endDT=None):
+        '''
+        "Find a free 30 minute slot in any of these rooms"
+
+        :param duration: datetime.timedelta
+        :param startDT: None means the start of the window
+        :param endDT: None means the end of the window
+        :return: list of (room, slotStartDT, slotEndDT) soonest first, one per room that has a free slot
+        '''
+        ret = []
+        for room, gaps in self.FindFreeSlots(duration, startDT, endDT).items():
+            if gaps:
+                ret.append((room, gaps[0][0], gaps[0][0] + duration))
+        ret.sort(key=lambda slot: slot[1])
+        return ret
+
+    def AvailabilityMatrix(self, slotLength, startDT=None, endDT=None):
+        '''
+        Free/busy grid of every room over the window.
+
+        :param slotLength: datetime.timedelta
+        :param startDT: None means the start of the window
+        :param endDT: None means the end of the window
+        :return: tuple of (list of slot start datetimes, list of rooms, matrix)
+            matrix[roomIndex][slotIndex] is True when the room is free for that whole slot
+            matrix is a numpy bool array if numpy is installed, else a list of lists
+        '''
+        seconds = int(slotLength.total_seconds())
+        low = self._windowStart if startDT is None else max(self._windowStart, math.floor(startDT.timestamp()))
+        high = self._windowEnd if endDT is None else min(self._windowEnd, math.ceil(endDT.timestamp()))
+        slotStarts = list(range(low, high, seconds))
+
+        if numpy is not None:
+            rooms = numpy.arange(len(self._rooms), dtype=numpy.int64)
+            slots = numpy.array(slotStarts, dtype=numpy.int64)
+            # every (room, slot) pair on the combined timeline, shape (rooms, slots)
+            queryStarts = (rooms * self._band - self._windowStart)[:, None] + slots[None, :]
+            queryEnds = queryStarts + numpy.minimum(seconds, high - slots)[None, :]
+
+            # the first busy interval that ends after the slot starts, the slot is busy if it starts before the slot ends
+            i = numpy.searchsorted(self._ends, queryStarts, side='right')
+            i = numpy.minimum(i, len(self._starts) - 1)
+            matrix = ~(self._starts[i] < queryEnds)
+
+        else:
+            matrix = []
+            for roomIndex in range(len(self._rooms)):
+                offset = roomIndex * self._band - self._windowStart
+                row = []
+                for slotStart in slotStarts:
+                    queryStart = slotStart + offset
+                    queryEnd = queryStart + min(seconds, high - slotStart)
+                    i = min(bisect_right(self._ends, queryStart), len(self._starts) - 1)
+                    row.append(not self._starts[i] < queryEnd)
+                matrix.append(row)
+
+        return [_DT(slotStart) for slotStart in slotStarts], list(self._rooms), matrix
+
+
+def _Merge(calItems):
+    # returns sorted, non-overlapping [(startEpoch, endEpoch), ...]
+    intervals = sorted(
+        (math.floor(item.Get('Start').timestamp()), math.ceil(item.Get('End').timestamp()))
+        for item in calItems
+    )
+    merged = []
+    for start, end in intervals:
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _DT(epoch):
+    return datetime.datetime.fromtimestamp(epoch)
@@ -0,0 +1,293 @@
+import datetime
+import heapq
+import itertools
+import queue
+import random
+import threading
+import time
+
+try:
+    from extronlib_pro import ProgramLog
+except:
+    from extronlib.system import ProgramLog
+
+
+class _PoolEntry:
+    '''
+    One calendar in the pool and its polling state
+    '''
+
+    def __init__(self, calendar, priority, interval):
+        self.calendar = calendar
+        self.priority = priority  # higher runs first when all the workers are busy
+        self.interval = interval  # seconds between polls
+        self.dueTime = None  # time.monotonic() of the next poll, None while queued/running
+        self.running = False
+        self.again = False  # UpdateNow() was called while it was running
+        self.removed = False
+        self.polls = 0
+        self.errors = 0
+        self.lastError = None
+        self.lastDuration = None
+
+
+class CalendarPool:
+    '''
+    Polls many calendars (one _BaseCalendar subclass per room) using a small, fixed number of threads.
+
+    Example:
+    pool = CalendarPool(maxWorkers=4, interval=60)
+    for room in rooms:
+        pool.Add(room.calendar)
+    pool.Start()
+
+    # the room a panel is looking at, or an occupied room, can jump the queue and poll more often
+    pool.SetPriority(busyRoom.calendar, 10, interval=15)
+    '''
+
+    def __init__(self, maxWorkers=4, interval=60, jitter=0.1, window=None, debug=False):
+        '''
+        :param maxWorkers: int, the most UpdateCalendar calls that can run at the same time
+        :param interval: float, default seconds between polls of each calendar
+        :param jitter: float, each interval is randomly changed by up to this fraction so the polls don't line up
+        :param window: None or tuple of (timedelta before now, timedelta after now)
+            None calls UpdateCalendar() with no arguments
+            else calls UpdateCalendar(startDT=now - before, endDT=now + after)
+        :param debug: bool
+        '''
+        self._maxWorkers = maxWorkers
+        self._interval = interval
+        self._jitter = jitter
+        self._window = window
+        self._debug = debug
+
+        self._entries = {}  # {id(calendar): _PoolEntry}
+        self._schedule = []  # heap of (dueTime, seq, _PoolEntry)
+        self._ready = queue.PriorityQueue()  # (-priority, readyTime, seq, _PoolEntry)
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+
+        self._running = False
+        self._generation = 0  # incremented by each Start(), the threads of an earlier Start() exit
+        self._scheduler = None
+        self._workers = []
+
+    def Log(self, message, *args):
+        # the message is only formatted when debug is on, see _Instrumentation.Log
+        if self._debug:
+            print(message.format(*args) if args else message)
+
+    def Add(self, calendar, priority=0, interval=None):
+        '''
+        The first poll of each calendar is spread randomly over one interval so they don't all happen at once.
+
+        :param calendar: _BaseCalendar subclass instance
+        :param priority: int
+        :param interval: float, seconds between polls, None means use the pool's interval
+        :return:
+        '''
+        with self._condition:
+            if id(calendar) in self._entries:
+                self.SetPriority(calendar, priority, interval)
+                return
+
+            entry = _PoolEntry(calendar, priority, interval or self._interval)
+            self._entries[id(calendar)] = entry
+            self._Schedule(entry, random.uniform(0, entry.interval))
+
+    def Remove(self, calendar):
+        with self._condition:
+            entry = self._entries.pop(id(calendar), None)
+            if entry:
+                entry.removed = True
+
+    def SetPriority(self, calendar, priority, interval=None):
+        '''
+        :param calendar: a calendar that was added with Add()
+        :param priority: int, higher runs first when all the workers are busy
+        :param interval: float, seconds between polls, None leaves it unchanged
+        :return:
+        '''
+        with self._condition:
+            entry = self._entries[id(calendar)]
+            entry.priority = priority
+            if interval is not None and interval != entry.interval:
+                entry.interval = interval
+                if entry.dueTime is not None:
+                    # bring the next poll forward if the new interval is shorter
+                    nextTime = time.monotonic() + self._Jitter(interval)
+                    if nextTime < entry.dueTime:
+                        self._Schedule(entry, nextTime - time.monotonic())
+
+    def UpdateNow(self, calendar=None):
+        '''
+        Poll a calendar as soon as a worker is free, without waiting for its interval.
+
+        :param calendar: a calendar that was added with Add(), None means all of them
+        :return:
+        '''
+        with self._condition:
+            if calendar is None:
+                entries = list(self._entries.values())
+            else:
+                entries = [self._entries[id(calendar)]]
+
+            for entry in entries:
+                if entry.running:
+                    entry.again = True
+                elif entry.dueTime is not None:
+                    self._Schedule(entry, 0)
+
+    def Start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._generation += 1
+            generation = self._generation
+
+        self._scheduler = threading.Thread(target=self._ScheduleLoop, args=(generation,), daemon=True)
+        self._scheduler.start()
+        self._workers = []
+        for i in range(self._maxWorkers):
+            worker = threading.Thread(target=self._WorkLoop, args=(generation,), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def Stop(self):
+        # lets the running UpdateCalendar calls finish, no new ones are started
+        with self._condition:
+            self._running = False
+            generation = self._generation
+            self._condition.notify_all()
+
+        for i in range(len(self._workers)):
+            # wakes up the workers so they can exit, the generation keeps the workers of a later Start() from exiting
+            self._ready.put((float('-inf'), generation, next(self._seq), None))
+
+    def _Jitter(self, interval):
+        return interval * (1 + random.uniform(-self._jitter, self._jitter))
+
+    def _Schedule(self, entry, delay):
+        # caller must hold self._condition
+        # an entry may already be in the heap with an older dueTime, that one is skipped when it comes up
+        entry.dueTime = time.monotonic() + delay
+        heapq.heappush(self._schedule, (entry.dueTime, next(self._seq), entry))
+        self._condition.notify()
+
+    def _ScheduleLoop(self, generation):
+        # moves entries from the time ordered heap to the priority ordered ready queue when they are due
+        with self._condition:
+            while self._running and generation == self._generation:
+                nowTime = time.monotonic()
+                while self._schedule and self._schedule[0][0] <= nowTime:
+                    dueTime, seq, entry = heapq.heappop(self._schedule)
+                    if entry.removed or entry.dueTime != dueTime:
+                        continue  # removed, or rescheduled since this was pushed
+
+                    entry.dueTime = None
+                    self._ready.put((-entry.priority, dueTime, seq, entry))
+
+                timeout = self._schedule[0][0] - nowTime if self._schedule else None
+                self._condition.wait(timeout)
+
+    def _WorkLoop(self, generation):
+        while True:
+            priority, readyTime, seq, entry = self._ready.get()
+            if entry is None:
+                if readyTime == generation:
+                    return
+                continue  # left over from an earlier Stop(), its worker has already exited
+            if entry.removed:
+                continue
+
+            if not self._running or generation != self._generation:
+                # stopped, put it back so it is polled after the next Start()
+                with self._condition:
+                    if not entry.removed:
+                        self._Schedule(entry, 0)
+                return
+
+            with self._condition:
+                entry.running = True
+                entry.again = False
+
+            startTime = time.monotonic()
+            try:
+                self._Update(entry)
+            except Exception as e:
+                entry.errors += 1
+                entry.lastError = e
+                ProgramLog('CalendarPool: Error updating {}: {}'.format(entry.calendar, e), 'error')
+            entry.lastDuration = time.monotonic() - startTime
+            entry.polls += 1
+            self.Log('CalendarPool updated {} in {:.3f}s', entry.calendar, entry.lastDuration)
+
+            with self._condition:
+                entry.running = False
+                if not entry.removed:
+                    self._Schedule(entry, 0 if entry.again else self._Jitter(entry.interval))
+
+    def _Update(self, entry):
+        if self._window is None:
+            entry.calendar.UpdateCalendar()
+        else:
+            before, after = self._window
+            nowDT = datetime.datetime.now()
+            entry.calendar.UpdateCalendar(
+                startDT=nowDT - before,
+                endDT=nowDT + after,
+            )
+
+    @property
+    def Calendars(self):
+        return [entry.calendar for entry in self._entries.values()]
+
+    def GetStale(self, maxAge):
+        '''
+        :param maxAge: float seconds
+        :return: list of calendars whose LastUpdated is older than maxAge seconds (or that never updated)
+        '''
+        nowTime = time.time()
+        return [
+            entry.calendar for entry in list(self._entries.values())
+            if nowTime - entry.calendar.LastUpdated > maxAge
+        ]
+
+    @property
+    def Freshness(self):
+        '''
+        How long ago each calendar was last updated, from their LastUpdated.
+
+        :return: dict like {
+            'count': 200,
+            'neverUpdated': 0,
+            'oldest': 95.2, # seconds
+            'newest': 0.3,
+            'mean': 41.7,
+            'polls': 5120,
+            'errors': 3,
+            }
+        '''
+        nowTime = time.time()
+        ages = []
+        neverUpdated = 0
+        polls = 0
+        errors = 0
+        for entry in list(self._entries.values()):
+            polls += entry.polls
+            errors += entry.errors
+            if entry.calendar.LastUpdated:
+                ages.append(nowTime - entry.calendar.LastUpdated)
+            else:
+                neverUpdated += 1
+
+        return {
+            'count': len(ages) + neverUpdated,
+            'neverUpdated': neverUpdated,
+            'oldest': max(ages) if ages else None,
+            'newest': min(ages) if ages else None,
+            'mean': sum(ages) / len(ages) if ages else None,
+            'polls': polls,
+            'errors': errors,
+        }
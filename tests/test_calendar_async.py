@@ -0,0 +1,95 @@
+'''
+Tests for gs_calendar_async, see test_calendar_base.py
+'''
+import asyncio
+import datetime
+import unittest
+
+from benchmarks import stubs
+
+stubs.Install()
+
+from gs_calendar_base import WriteRejected, _CalendarItem  # noqa: E402
+from gs_calendar_async import _AsyncBaseCalendar  # noqa: E402
+from benchmarks.synthetic import GenerateEvents  # noqa: E402
+
+HOUR = datetime.timedelta(hours=1)
+
+
+class AsyncCalendar(_AsyncBaseCalendar):
+    '''
+    The server is a dict of event dicts, the overrides remember which event loop they ran on
+    '''
+
+    def __init__(self, events=(), *a, **k):
+        self.serverEvents = {event['ItemId']: dict(event) for event in events}
+        self.reject = set()
+        self.loops = set()
+        super().__init__(*a, **k)
+
+    def _MakeItem(self, event):
+        data = {key: value for key, value in event.items() if key not in ('Start', 'End')}
+        return _CalendarItem(event['Start'], event['End'], data, self)
+
+    async def _Server(self, itemId):
+        self.loops.add(asyncio.get_running_loop())
+        await asyncio.sleep(0.01)
+        if itemId in self.reject:
+            raise WriteRejected('rejected {}'.format(itemId))
+
+    async def UpdateCalendar(self, calendar=None, startDT=None, endDT=None):
+        calItems = [self._MakeItem(event) for event in self.serverEvents.values()]
+        self.RegisterCalendarItems(
+            calItems, min(item.Get('Start') for item in calItems), max(item.Get('End') for item in calItems))
+
+    async def CreateCalendarEvent(self, subject, body, startDT, endDT):
+        await self._Server(subject)
+        event = {'ItemId': 'created', 'Subject': subject, 'Body': body, 'Start': startDT, 'End': endDT}
+        self.serverEvents['created'] = event
+        return self._MakeItem(event)
+
+    async def ChangeEventTime(self, calItem, newStartDT, newEndDT):
+        await self._Server(calItem.Get('ItemId'))
+        self.serverEvents[calItem.Get('ItemId')].update(Start=newStartDT, End=newEndDT)
+
+    async def DeleteEvent(self, calItem):
+        await self._Server(calItem.Get('ItemId'))
+        self.serverEvents.pop(calItem.Get('ItemId'))
+
+
+class TestAsyncWriteQueue(unittest.TestCase):
+
+    def test_queued_writes_run_on_the_event_loop(self):
+        events = GenerateEvents(10, seed=1)
+        movedId, deletedId, rejectedId = (event['ItemId'] for event in events[:3])
+        calendar = AsyncCalendar(events, writeBackoff=0.01)
+        calendar.reject.add(rejectedId)
+
+        async def Run():
+            await calendar.UpdateCalendar()
+            moved = calendar.GetCalendarItemByID(movedId)
+            rejected = calendar.GetCalendarItemByID(rejectedId)
+            calendar.QueueChangeEventTime(moved, moved.Get('Start') + HOUR, moved.Get('End') + HOUR)
+            calendar.QueueDeleteEvent(calendar.GetCalendarItemByID(deletedId))
+            temporary = calendar.QueueCreateCalendarEvent('Huddle', '', moved.Get('Start'), moved.Get('End'))
+            calendar.QueueChangeEventTime(rejected, rejected.Get('Start') + HOUR, rejected.Get('End') + HOUR)
+            self.assertTrue(await calendar.WaitForWrites(5))
+
+            self.assertEqual(calendar.loops, {asyncio.get_running_loop()})
+            self.assertEqual(calendar.serverEvents[movedId]['Start'], moved.Get('Start') + HOUR)
+            self.assertNotIn(deletedId, calendar.serverEvents)
+            self.assertIsNotNone(calendar.GetCalendarItemByID('created'))
+            self.assertIsNone(calendar.GetCalendarItemByID(temporary.Get('ItemId')))
+            self.assertEqual(calendar.GetCalendarItemByID(rejectedId).Fingerprint, rejected.Fingerprint)
+
+        asyncio.run(Run())
+        self.assertEqual(calendar.WriteStats['failed'], 1)
+
+    def test_queue_needs_the_event_loop(self):
+        calendar = AsyncCalendar(GenerateEvents(1, seed=1))
+        with self.assertRaises(RuntimeError):
+            calendar.QueueCreateCalendarEvent('Huddle', '', datetime.datetime.now(), datetime.datetime.now() + HOUR)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1285 @@
+'''
+Tests for gs_calendar_base, run on a PC with the stand-ins from benchmarks/:
+
+    python -m unittest discover -s tests -t .
+'''
+import datetime
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+
+from benchmarks import stubs
+
+stubs.Install()
+
+import gs_calendar_base  # noqa: E402
+from gs_calendar_base import (  # noqa: E402
+    WriteRejected,
+    ConvertDatetimeToTimeString,
+    ConvertDatetimesToTimeStrings,
+    ConvertTimeStringToDatetime,
+    ConvertTimeStringsToDatetimes,
+    _AttachmentCache,
+    _CalendarItem,
+    _CoverageCache,
+    _DumpSnapshot,
+    _IsDST,
+    _ItemDict,
+    _TimezoneConverter,
+)
+from benchmarks.mock_calendar import InMemoryCalendar  # noqa: E402
+from benchmarks.synthetic import GenerateEvents, Mutate  # noqa: E402
+
+DAY = datetime.timedelta(days=1)
+HOUR = datetime.timedelta(hours=1)
+
+
+def Window(events):
+    return min(e['Start'] for e in events) - DAY, max(e['End'] for e in events) + DAY
+
+
+def Ids(calItems):
+    return [calItem.Get('ItemId') for calItem in calItems]
+
+
+class Recorder:
+    '''
+    Keeps the New/Changed/Deleted callbacks of a calendar as (kind, ItemId)
+    '''
+
+    def __init__(self, calendar):
+        self.calls = []
+        calendar.NewCalendarItem = lambda cal, item: self.calls.append(('New', item.Get('ItemId')))
+        calendar.CalendarItemChanged = lambda cal, item: self.calls.append(('Changed', item.Get('ItemId')))
+        calendar.CalendarItemDeleted = lambda cal, item: self.calls.append(('Deleted', item.Get('ItemId')))
+
+
+class _CalendarTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._tempDir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tempDir.name, 'calendar.json')
+        self._calendars = []
+
+    def tearDown(self):
+        for calendar in self._calendars:
+            calendar.Flush()
+            calendar._timerSaveToFile.Stop()
+        self._tempDir.cleanup()
+
+    def Calendar(self, events=(), **kwargs):
+        calendar = InMemoryCalendar(events, **kwargs)
+        self._calendars.append(calendar)
+        return calendar
+
+    def Synced(self, events, **kwargs):
+        calendar = self.Calendar(events, **kwargs)
+        calendar.RegisterCalendarItems([calendar._MakeItem(e) for e in events], *Window(events))
+        return calendar
+
+
+class TestTimeQueries(_CalendarTestCase):
+    '''
+    The index has to answer the same as scanning every item.
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.startDT = datetime.datetime(2026, 3, 2)
+        self.events = GenerateEvents(300, seed=1, startDT=self.startDT, allDayEvery=25)
+        self.calendar = self.Synced(self.events)
+
+    def _Times(self):
+        rand = random.Random(1)
+        times = [self.startDT + datetime.timedelta(minutes=rand.randrange(45 * 24 * 60)) for _ in range(100)]
+        times += [e['Start'] for e in self.events[:20]] + [e['End'] for e in self.events[:20]]  # the edges
+        return times
+
+    def _Check(self):
+        calItems = self.calendar.GetAllEvents()
+        rand = random.Random(2)
+        for dt in self._Times():
+            self.assertEqual(Ids(self.calendar.GetEventAtTime(dt)), Ids(c for c in calItems if dt in c))
+            self.assertEqual(
+                Ids(self.calendar.GetEventAtTime(dt.date())),
+                Ids(c for c in calItems if dt.date() in c),
+            )
+            endDT = dt + datetime.timedelta(minutes=rand.choice([0, 15, 90, 24 * 60, 7 * 24 * 60]))
+            self.assertEqual(
+                Ids(self.calendar.GetEventsInRange(dt, endDT, update=False)),
+                Ids(c for c in calItems if dt <= c <= endDT),
+            )
+
+    def test_matches_a_scan(self):
+        self._Check()
+
+    def test_matches_a_scan_after_changes(self):
+        events = Mutate(self.events, 0.1, seed=3)
+        events.append({'ItemId': 'late', 'Subject': 'Late', 'Start': self.startDT + 3 * HOUR, 'End': self.startDT + 40 * DAY})
+        self.calendar.RegisterCalendarItems([self.calendar._MakeItem(e) for e in events], *Window(self.events))
+        self.assertEqual(len(self.calendar.GetAllEvents()), len(events))
+        self._Check()
+
+
+class TestCalendarItem(unittest.TestCase):
+
+    def setUp(self):
+        self.startDT = datetime.datetime(2026, 3, 2, 9, 0)
+        self.endDT = self.startDT + HOUR * 1.5
+        self.calItem = _CalendarItem(self.startDT, self.endDT, {'ItemId': 'A', 'Subject': 'Review'}, None)
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(self.calItem, '__dict__'))
+
+    def test_get(self):
+        self.assertEqual(self.calItem.Get('Start'), self.startDT)
+        self.assertEqual(self.calItem.get('End'), self.endDT)
+        self.assertEqual(self.calItem.Get('Duration'), 5400)
+        self.assertEqual(self.calItem.Get('Subject'), 'Review')
+        self.assertIsNone(self.calItem.Get('OrganizerName'))
+
+    def test_data_is_a_copy(self):
+        data = self.calItem.Data
+        self.assertEqual(data['Start_ISO'], self.startDT.isoformat())
+        self.assertEqual(data['End_ISO'], self.endDT.isoformat())
+        data['Subject'] = 'Changed by the caller'
+        self.assertEqual(self.calItem.Data['Subject'], 'Review')
+
+        jsonDict = self.calItem.dict()
+        self.assertEqual(jsonDict['Start'], self.startDT.timestamp())
+        self.assertEqual(jsonDict['End'], self.endDT.timestamp())
+        self.assertEqual(jsonDict['Duration'], 5400)
+        jsonDict['Subject'] = 'Changed by the caller'
+        self.assertEqual(self.calItem.dict()['Subject'], 'Review')
+
+    def test_add_data_updates_the_caches(self):
+        before = self.calItem.Fingerprint
+        self.calItem.Data, self.calItem.dict()  # fill the caches
+
+        self.calItem.AddData('Subject', 'Moved')
+        self.assertEqual(self.calItem.Data['Subject'], 'Moved')
+        self.assertEqual(self.calItem.dict()['Subject'], 'Moved')
+        self.assertNotEqual(self.calItem.Fingerprint, before)
+
+        self.calItem.AddData('OrganizerName', 'Pat Lee')
+        self.assertEqual(self.calItem.Get('OrganizerName'), 'Pat Lee')
+        self.assertEqual(self.calItem.Data['OrganizerName'], 'Pat Lee')
+
+    def test_equality(self):
+        same = _CalendarItem(self.startDT, self.endDT, {'Subject': 'Review', 'ItemId': 'A'}, None)
+        self.assertEqual(self.calItem, same)
+        self.assertNotEqual(self.calItem, _CalendarItem(self.startDT, self.endDT, {'ItemId': 'A', 'Subject': 'X'}, None))
+        self.assertNotEqual(self.calItem, _CalendarItem(self.startDT, self.endDT, {'ItemId': 'B', 'Subject': 'Review'}, None))
+        self.assertNotEqual(self.calItem, _CalendarItem(self.startDT, self.startDT + HOUR, {'ItemId': 'A', 'Subject': 'Review'}, None))
+
+    def test_comparisons(self):
+        later = _CalendarItem(self.startDT + HOUR, self.endDT + HOUR, {'ItemId': 'B', 'Subject': 'Later'}, None)
+        self.assertTrue(self.calItem < later)
+        self.assertTrue(self.calItem <= later)
+        self.assertTrue(later > self.calItem)
+        self.assertTrue(later >= self.calItem)
+        self.assertTrue(self.calItem <= self.startDT)
+        self.assertFalse(self.calItem < self.startDT)
+        self.assertTrue(self.calItem >= self.endDT)
+        self.assertFalse(self.calItem > self.endDT)
+
+        self.assertIn(self.startDT + HOUR, self.calItem)
+        self.assertNotIn(self.endDT + HOUR, self.calItem)
+        self.assertIn(self.startDT.date(), self.calItem)
+        self.assertNotIn(self.startDT.date() + DAY, self.calItem)
+
+    def test_iter(self):
+        self.assertEqual(dict(self.calItem), {
+            'ItemId': 'A', 'Subject': 'Review', 'Duration': 5400, 'Start': self.startDT, 'End': self.endDT,
+        })
+
+
+class TestSharedData(_CalendarTestCase):
+
+    def _Item(self, itemId, **data):
+        startDT = datetime.datetime(2026, 3, 2, 9, 0)
+        return _CalendarItem(startDT, startDT + HOUR, dict({'ItemId': itemId}, **data), None)
+
+    def test_schema_and_strings_are_shared(self):
+        # built at runtime, so they are different str objects until they are interned
+        room = ''.join(['Room', ' 1'])
+        a = self._Item('a', RoomName=room, Subject='x')
+        b = self._Item('b', RoomName=''.join(['Room', ' 1']), Subject='y')
+
+        self.assertIs(a._schema, b._schema)
+        self.assertIs(a.Get('RoomName'), b.Get('RoomName'))
+
+        a.AddData('Body', 'one')
+        b.AddData('Body', 'two')
+        self.assertIs(a._schema, b._schema)
+        self.assertEqual((a.Get('Body'), b.Get('Body')), ('one', 'two'))
+
+    def test_key_order_doesnt_matter(self):
+        a = self._Item('a', RoomName='Room 1', Subject='x')
+        b = _CalendarItem(a.Get('Start'), a.Get('End'), {'Subject': 'x', 'RoomName': 'Room 1', 'ItemId': 'a'}, None)
+        self.assertIsNot(a._schema, b._schema)
+        self.assertEqual(a, b)
+        self.assertEqual(a.Fingerprint, b.Fingerprint)
+
+    def test_other_values_are_kept_as_they_are(self):
+        attendees = ['Pat Lee', 'Sam Jones']
+        long = 'x' * 1000
+        calItem = self._Item('a', Attendees=attendees, Count=3, Long=long, Missing=None)
+        self.assertEqual(calItem.Get('Attendees'), attendees)
+        self.assertEqual(calItem.Get('Count'), 3)
+        self.assertEqual(calItem.Get('Long'), long)
+        self.assertIsNone(calItem.Get('Missing'))
+        self.assertEqual(calItem.Data['Attendees'], attendees)
+
+    def test_loaded_items_share_too(self):
+        events = GenerateEvents(50, seed=22, startDT=datetime.datetime(2026, 3, 2))
+        calendar = self.Synced(events, persistentStorage=self.path)
+        calendar.Flush()
+
+        calItems = list(self.Calendar(persistentStorage=self.path).GetAllEvents())
+        self.assertEqual(len(calItems), 50)
+        self.assertEqual(len({id(calItem._schema) for calItem in calItems}), 1)
+        self.assertEqual(len({id(calItem.Get('RoomName')) for calItem in calItems}), 1)
+        self.assertEqual(len({id(calItem.Get('Subject')) for calItem in calItems}), len({e['Subject'] for e in events}))
+
+
+class TestNextPrevious(_CalendarTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.startDT = datetime.datetime(2026, 3, 2)
+        self.events = GenerateEvents(300, seed=2, startDT=self.startDT, allDayEvery=25)
+        self.calendar = self.Synced(self.events)
+
+    def test_matches_a_scan(self):
+        calItems = self.calendar.GetAllEvents()
+        rand = random.Random(2)
+        times = [self.startDT + datetime.timedelta(minutes=rand.randrange(-24 * 60, 35 * 24 * 60)) for _ in range(100)]
+        times += [e['Start'] for e in self.events[:20]] + [e['End'] for e in self.events[:20]]
+
+        for dt in times:
+            starts = [c.Get('Start') for c in calItems if c.Get('Start') > dt]
+            expected = [c for c in calItems if starts and c.Get('Start') == min(starts)]
+            self.assertEqual(Ids(self.calendar._index.Next(dt)), Ids(expected))
+
+            ends = [c.Get('End') for c in calItems if c.Get('End') < dt]
+            expected = [c for c in calItems if ends and c.Get('End') == max(ends)]
+            self.assertEqual(Ids(self.calendar._index.Previous(dt)), Ids(expected))
+
+    def test_ties_are_returned_together(self):
+        nowDT = datetime.datetime.now().replace(second=0, microsecond=0)
+        events = [
+            {'ItemId': 'now', 'Subject': 'Now', 'Start': nowDT - HOUR, 'End': nowDT + 2 * HOUR},
+            {'ItemId': 'a', 'Subject': 'A', 'Start': nowDT + HOUR, 'End': nowDT + 2 * HOUR},
+            {'ItemId': 'b', 'Subject': 'B', 'Start': nowDT + HOUR, 'End': nowDT + 3 * HOUR},
+            {'ItemId': 'later', 'Subject': 'Later', 'Start': nowDT + 2 * HOUR, 'End': nowDT + 3 * HOUR},
+            {'ItemId': 'c', 'Subject': 'C', 'Start': nowDT - 3 * HOUR, 'End': nowDT - HOUR},
+            {'ItemId': 'd', 'Subject': 'D', 'Start': nowDT - 2 * HOUR, 'End': nowDT - HOUR},
+            {'ItemId': 'earlier', 'Subject': 'Earlier', 'Start': nowDT - 3 * HOUR, 'End': nowDT - 2 * HOUR},
+        ]
+        calendar = self.Synced(events)
+
+        self.assertEqual(sorted(Ids(calendar.GetNextCalItems())), ['a', 'b'])
+        self.assertEqual(sorted(Ids(calendar.GetPreviousCalItems())), ['c', 'd'])
+        self.assertEqual(Ids(calendar.GetNowCalItems()), ['now'])
+
+    def test_empty(self):
+        calendar = self.Calendar()
+        self.assertEqual(calendar.GetNextCalItems(), [])
+        self.assertEqual(calendar.GetPreviousCalItems(), [])
+
+
+class TestReconcile(_CalendarTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.events = GenerateEvents(100, seed=3, startDT=datetime.datetime(2026, 3, 2))
+        self.startDT, self.endDT = Window(self.events)
+        self.calendar = self.Synced(self.events)
+        self.recorder = Recorder(self.calendar)
+
+    def _Sync(self, events, startDT=None, endDT=None):
+        self.calendar.RegisterCalendarItems(
+            [self.calendar._MakeItem(e) for e in events], startDT or self.startDT, endDT or self.endDT)
+
+    def test_same_items_no_callbacks(self):
+        self._Sync(list(reversed(self.events)))
+        self.assertEqual(self.recorder.calls, [])
+
+    def test_new_changed_deleted(self):
+        changed = dict(self.events[3], Subject='Moved to the big room')
+        moved = dict(self.events[4], End=self.events[4]['End'] + HOUR)
+        added = {'ItemId': 'added', 'Subject': 'Added', 'Start': self.events[0]['Start'], 'End': self.events[0]['End']}
+        events = self.events[:3] + [changed, moved] + self.events[5:7] + self.events[8:] + [added]
+
+        self._Sync(events)
+        self.assertEqual(self.recorder.calls, [
+            ('Changed', changed['ItemId']),
+            ('Changed', moved['ItemId']),
+            ('New', 'added'),
+            ('Deleted', self.events[7]['ItemId']),
+        ])
+        calItems = {c.Get('ItemId'): c for c in self.calendar.GetAllEvents()}
+        self.assertEqual(calItems[changed['ItemId']].Get('Subject'), 'Moved to the big room')
+        self.assertEqual(calItems[moved['ItemId']].Get('End'), moved['End'])
+        self.assertEqual(len(calItems), len(self.events))
+
+    def test_only_the_window_is_deleted(self):
+        endDT = sorted(e['Start'] for e in self.events)[50]
+        self._Sync([e for e in self.events if e['End'] < endDT], self.startDT, endDT)
+
+        deleted = [e['ItemId'] for e in self.events if e['Start'] <= endDT <= e['End']]
+        self.assertTrue(deleted)
+        self.assertEqual(self.recorder.calls, [('Deleted', itemId) for itemId in deleted])
+        self.assertEqual(len(self.calendar.GetAllEvents()), len(self.events) - len(deleted))
+
+
+class TestReloadParity(_CalendarTestCase):
+    '''
+    Loading from disk and then syncing the same items must look the same as never having restarted
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.events = GenerateEvents(200, seed=1)
+        first = self.events[0]['Start'].replace(hour=9, minute=0)
+        self.events.append({
+            'ItemId': 'series', 'Subject': 'Standup', 'Start': first, 'End': first + HOUR / 4,
+            'Recurrence': {'Freq': 'DAILY', 'Count': 30},
+        })
+        self.startDT, self.endDT = Window(self.events)
+
+    def _Reload(self, **kwargs):
+        calendar = self.Calendar(self.events, persistentStorage=self.path, **kwargs)
+        calendar.RegisterCalendarItems([calendar._MakeItem(e) for e in self.events], self.startDT, self.endDT)
+        calendar.Flush()
+
+        reloaded = self.Calendar(self.events, persistentStorage=self.path, **kwargs)
+        self.assertEqual(len(reloaded.GetAllEvents()), len(self.events))
+        return reloaded
+
+    def _AssertParity(self, **kwargs):
+        reloaded = self._Reload(**kwargs)
+        recorder = Recorder(reloaded)
+        reloaded.RegisterCalendarItems([reloaded._MakeItem(e) for e in self.events], self.startDT, self.endDT)
+        self.assertEqual(recorder.calls, [])
+
+        changed = dict(self.events[5], Subject='Moved to the big room')
+        reloaded.RegisterCalendarItems(
+            [reloaded._MakeItem(e) for e in self.events[:5] + [changed] + self.events[6:]], self.startDT, self.endDT)
+        self.assertEqual(recorder.calls, [('Changed', changed['ItemId'])])
+
+    def test_json(self):
+        self._AssertParity(snapshotFormat='json')
+
+    def test_binary(self):
+        self._AssertParity(snapshotFormat='binary')
+
+    def test_journal(self):
+        self._AssertParity(persistenceMode='journal')
+
+
+class TestSnapshotFiles(_CalendarTestCase):
+    snapshotFormat = 'json'
+
+    def setUp(self):
+        super().setUp()
+        self.events = GenerateEvents(50, seed=5, startDT=datetime.datetime(2026, 3, 2))
+        self.startDT, self.endDT = Window(self.events)
+
+    def Stored(self, **kwargs):
+        return self.Calendar(persistentStorage=self.path, snapshotFormat=self.snapshotFormat, **kwargs)
+
+    def _Save(self, calendar, events):
+        calendar.RegisterCalendarItems([calendar._MakeItem(e) for e in events], self.startDT, self.endDT)
+        calendar.Flush()
+
+    def _Subjects(self, calendar):
+        return sorted((c.Get('ItemId'), c.Get('Subject')) for c in calendar.GetAllEvents())
+
+    def _Files(self):
+        return [os.path.join(self._tempDir.name, f) for f in os.listdir(self._tempDir.name)]
+
+    def _WriteLegacy(self, calItems):
+        with open(self.path, 'w') as file:
+            json.dump({'lastUpdateTime': 0, 'items': [c.dict() for c in calItems]}, file)
+        return self.path
+
+    def test_cut_off_snapshot_loads_the_older_one(self):
+        calendar = self.Stored()
+        self._Save(calendar, self.events)
+        olderPath, = self._Files()
+        with open(olderPath, 'rb') as file:
+            older = file.read()
+
+        changed = [dict(e, Subject='Changed') for e in self.events]
+        self._Save(calendar, changed)
+        newerPath, = self._Files()
+        self.assertNotEqual(newerPath, olderPath)
+
+        # as if we lost power while writing the newer one, before the older one was deleted
+        with open(newerPath, 'rb') as file:
+            newer = file.read()
+        with open(newerPath, 'wb') as file:
+            file.write(newer[:len(newer) // 2])
+        with open(olderPath, 'wb') as file:
+            file.write(older)
+
+        reloaded = self.Stored()
+        self.assertEqual(self._Subjects(reloaded), self._Subjects(self.Synced(self.events)))
+
+        self._Save(reloaded, changed)
+        self.assertEqual(self._Files(), [newerPath])
+        self.assertEqual(self._Subjects(self.Stored()), self._Subjects(calendar))
+
+    def test_loads_a_file_from_before_the_snapshots_were_numbered(self):
+        calendar = self.Synced(self.events)
+        legacyPath = self._WriteLegacy(calendar.GetAllEvents())
+
+        reloaded = self.Stored()
+        self.assertEqual(self._Subjects(reloaded), self._Subjects(calendar))
+
+        self._Save(reloaded, [dict(e, Subject='Changed') for e in self.events])
+        self.assertFalse(os.path.exists(legacyPath))
+        self.assertEqual(self._Subjects(self.Stored()), self._Subjects(reloaded))
+
+    def test_polls_without_changes_are_not_journaled(self):
+        calendar = self.Stored(persistenceMode='journal')
+        self._Save(calendar, self.events)
+        journalPath = calendar._JournalPath(calendar._journalGeneration)
+        size = os.path.getsize(journalPath)
+
+        for _ in range(3):
+            self._Save(calendar, self.events)
+            calendar._NewConnectionStatus('Connected')
+            calendar.Flush()
+        self.assertEqual(os.path.getsize(journalPath), size)
+
+        self._Save(calendar, self.events[1:])
+        self.assertGreater(os.path.getsize(journalPath), size)
+        self.assertEqual(len(self.Stored(persistenceMode='journal').GetAllEvents()), 49)
+
+
+class TestBinarySnapshotFiles(TestSnapshotFiles):
+    snapshotFormat = 'binary'
+
+    def _WriteLegacy(self, calItems):
+        with open(self.path + '.bin', 'wb') as file:
+            file.write(_DumpSnapshot(calItems, {'lastUpdateTime': 0}))
+        return self.path + '.bin'
+
+
+class TestCallbackDispatch(_CalendarTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.events = GenerateEvents(20, seed=8, startDT=datetime.datetime(2026, 3, 2))
+        self.startDT, self.endDT = Window(self.events)
+
+    def _Sync(self, calendar, events):
+        calendar.RegisterCalendarItems([calendar._MakeItem(e) for e in events], self.startDT, self.endDT)
+
+    def test_async_handlers_dont_block_the_sync(self):
+        calendar = self.Calendar(callbackMode='async')
+        release = threading.Event()
+        calls = []
+
+        def NewCalendarItem(cal, calItem):
+            release.wait(5)
+            calls.append((calItem.Get('ItemId'), threading.current_thread()))
+
+        calendar.NewCalendarItem = NewCalendarItem
+        self._Sync(calendar, self.events)
+        self.assertEqual(calls, [])  # the sync returned while the first handler is still waiting
+        self.assertEqual(len(calendar.GetAllEvents()), 20)
+
+        release.set()
+        calendar.WaitForCallbacks()
+        self.assertEqual([itemId for itemId, thread in calls], [e['ItemId'] for e in self.events])
+        self.assertNotIn(threading.current_thread(), [thread for itemId, thread in calls])
+        self.assertEqual(calendar.CallbackStats['New']['calls'], 20)
+
+    def test_full_queue_drops_and_counts(self):
+        calendar = self.Calendar(callbackMode='async', callbackQueueSize=2)
+        release = threading.Event()
+        calendar.NewCalendarItem = lambda cal, calItem: release.wait(5)
+        self._Sync(calendar, self.events)
+        release.set()
+        calendar.WaitForCallbacks()
+
+        stats = calendar.CallbackStats['New']
+        self.assertGreater(stats['dropped'], 0)
+        self.assertEqual(stats['calls'] + stats['dropped'], 20)
+
+    def test_errors_and_slow_handlers_are_counted(self):
+        calendar = self.Calendar(callbackMode='async', callbackBudget=0.001)
+
+        def CalendarItemChanged(cal, calItem):
+            time.sleep(0.01)
+            raise ValueError('handler bug')
+
+        calendar.CalendarItemChanged = CalendarItemChanged
+        self._Sync(calendar, self.events)
+        self._Sync(calendar, [dict(e, Subject='Changed') for e in self.events[:3]] + self.events[3:])
+        calendar.WaitForCallbacks()
+
+        stats = calendar.CallbackStats['Changed']
+        self.assertEqual((stats['calls'], stats['errors'], stats['slow']), (3, 3, 3))
+
+    def test_one_batch_per_sync(self):
+        calendar = self.Calendar(batchCallbacks=True)
+        batches = []
+        calendar.CalendarItemsBatch = lambda cal, batch: batches.append(
+            {kind: Ids(calItems) for kind, calItems in batch.items()})
+        calendar.NewCalendarItem = lambda cal, calItem: self.fail('not called when batching')
+
+        self._Sync(calendar, self.events)
+        self._Sync(calendar, self.events)  # nothing changed, no batch
+        self._Sync(calendar, [dict(self.events[0], Subject='Changed')] + self.events[2:])
+        self.assertEqual(batches, [
+            {'New': [e['ItemId'] for e in self.events], 'Changed': [], 'Deleted': []},
+            {'New': [], 'Changed': [self.events[0]['ItemId']], 'Deleted': [self.events[1]['ItemId']]},
+        ])
+
+
+class TestRangeCache(_CalendarTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.dayDT = datetime.datetime(2026, 3, 2)
+        self.events = GenerateEvents(50, seed=9, startDT=self.dayDT)
+
+    def _Calendar(self, **kwargs):
+        calendar = self.Calendar(self.events, **kwargs)
+        fetched = calendar.fetched = []
+        update = calendar.UpdateCalendar
+
+        def UpdateCalendar(calendar=None, startDT=None, endDT=None):
+            fetched.append((startDT, endDT))
+            update(calendar, startDT, endDT)
+
+        calendar.UpdateCalendar = UpdateCalendar
+        return calendar
+
+    def test_only_the_missing_parts_are_fetched(self):
+        calendar = self._Calendar(rangeCacheTTL=60)
+        day = [self.dayDT + i * DAY for i in range(4)]
+
+        found = calendar.GetEventsInRange(day[0], day[2])
+        self.assertEqual(Ids(found), [e['ItemId'] for e in self.events if e['End'] >= day[0] and e['Start'] <= day[2]])
+        calendar.GetEventsInRange(day[1], day[3])
+        calendar.GetEventsInRange(day[0], day[3])
+        self.assertEqual(calendar.fetched, [(day[0], day[2]), (day[2], day[3])])
+        self.assertEqual(calendar.RangeCacheStats, {'hits': 1, 'misses': 2, 'fetches': 2})
+
+    def test_no_ttl_always_fetches(self):
+        calendar = self._Calendar()
+        calendar.GetEventsInRange(self.dayDT, self.dayDT + DAY)
+        calendar.GetEventsInRange(self.dayDT, self.dayDT + DAY)
+        self.assertEqual(len(calendar.fetched), 2)
+        self.assertEqual(calendar.RangeCacheStats, {'hits': 0, 'misses': 2, 'fetches': 2})
+
+    def test_stale_windows_are_fetched_again(self):
+        coverage = _CoverageCache(60)
+        day = [self.dayDT + i * DAY for i in range(4)]
+        coverage.Add(day[0], day[2], fetchedTime=0)
+        coverage.Add(day[1], day[3], fetchedTime=50)
+
+        self.assertEqual(coverage.Missing(day[0], day[3], nowTime=55), [])
+        self.assertEqual(coverage.Missing(day[0], day[3], nowTime=100), [(day[0], day[1])])
+        self.assertEqual(coverage.Missing(day[0], day[3], nowTime=200), [(day[0], day[3])])
+
+
+class TestSubjectSearch(_CalendarTestCase):
+    queries = [
+        ('Design Review', None), (None, 'Review'), (None, 'e'), (None, 'Re'), (None, 'review'), (None, '1:1'),
+        (None, 'Standup'), ('Nothing', None), (None, 'Nothing'), ('Interview', 'Call'), (None, None),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.events = GenerateEvents(200, seed=10, startDT=datetime.datetime(2026, 3, 2))
+        self.calendar = self.Synced(self.events)
+
+    def _Check(self, calendar):
+        calItems = calendar.GetAllEvents()
+        for exactMatch, partialMatch in self.queries:
+            self.assertEqual(
+                Ids(calendar.GetCalendarItemsBySubject(exactMatch, partialMatch)),
+                Ids(c for c in calItems if c.Get('Subject') == exactMatch or (
+                    partialMatch and partialMatch in c.Get('Subject'))),
+                (exactMatch, partialMatch),
+            )
+
+    def test_matches_a_scan(self):
+        self._Check(self.calendar)
+
+    def test_matches_a_scan_after_changes(self):
+        self.calendar.GetCalendarItemsBySubject('Design Review')  # build the index before the changes
+        events = [dict(e, Subject='Quarterly Review') if i % 7 == 0 else e for i, e in enumerate(self.events)]
+        events = Mutate(events, 0.1, seed=10)
+        self.calendar.RegisterCalendarItems([self.calendar._MakeItem(e) for e in events], *Window(self.events))
+        self._Check(self.calendar)
+
+    def test_one_refresh_for_all_the_matches(self):
+        refreshed = []
+        self.calendar._UpdateItemsFromServer = lambda calItems: refreshed.append(Ids(calItems)) or calItems
+
+        found = self.calendar.GetCalendarItemsBySubject(partialMatch='Review')
+        self.assertEqual(refreshed, [Ids(found)])
+        self.calendar.GetCalendarItemsBySubject(exactMatch='Nothing')
+        self.assertEqual(len(refreshed), 1)
+
+    def test_one_at_a_time_refresh(self):
+        refreshed = []
+        self.calendar._UpdateItemFromServer = lambda calItem: refreshed.append(calItem.Get('ItemId')) or calItem
+
+        found = self.calendar.GetCalendarItemsBySubject(exactMatch='Design Review')
+        self.assertEqual(refreshed, Ids(found))
+
+
+def _OriginalAdjust(dt, fromZone):
+    # AdjustDatetimeForTimezone before the DST transitions were cached
+    delta = datetime.timedelta(hours=abs(gs_calendar_base.MY_TIME_ZONE))
+    dtIsDST = time.localtime(time.mktime(dt.timetuple())).tm_isdst > 0
+    nowIsDST = time.localtime().tm_isdst > 0
+    if fromZone == 'Mine':
+        dt = dt + delta
+        if dtIsDST and not nowIsDST:
+            dt -= HOUR
+        elif nowIsDST and not dtIsDST:
+            dt += HOUR
+    else:
+        dt = dt - delta
+        if dtIsDST and not nowIsDST:
+            dt += HOUR
+        elif nowIsDST and not dtIsDST:
+            dt -= HOUR
+    return dt
+
+
+class TestTimezone(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(11)
+        firstDT = datetime.datetime(2025, 1, 1)
+        self.datetimes = [firstDT + datetime.timedelta(minutes=rand.randrange(2 * 365 * 24 * 60)) for _ in range(500)]
+
+    def test_same_as_before(self):
+        strings = [dt.strftime('%Y-%m-%dT%H:%M:%SZ') for dt in self.datetimes]
+        expected = [_OriginalAdjust(dt, 'Exchange') for dt in self.datetimes]
+        self.assertEqual([ConvertTimeStringToDatetime(string) for string in strings], expected)
+        self.assertEqual(ConvertTimeStringsToDatetimes(strings), expected)
+
+        expected = [_OriginalAdjust(dt, 'Mine').strftime('%Y-%m-%dT%H:%M:%SZ') for dt in self.datetimes]
+        self.assertEqual([ConvertDatetimeToTimeString(dt) for dt in self.datetimes], expected)
+        self.assertEqual(ConvertDatetimesToTimeStrings(self.datetimes), expected)
+
+    def test_short_fields(self):
+        self.assertEqual(
+            ConvertTimeStringToDatetime('2026-3-2T9:05:07Z'),
+            ConvertTimeStringToDatetime('2026-03-02T09:05:07Z'),
+        )
+
+    @unittest.skipUnless(hasattr(time, 'tzset'), 'needs time.tzset')
+    def test_dst_transitions(self):
+        oldTZ = os.environ.get('TZ', None)
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        try:
+            converter = _TimezoneConverter()
+            hour = datetime.datetime(2026, 1, 1)
+            while hour.year == 2026:
+                for dt in (hour, hour + datetime.timedelta(minutes=59, seconds=59)):
+                    self.assertEqual(converter.IsDST(dt), _IsDST(dt), dt)
+                hour += HOUR
+            isDST, transitions, states = converter._years[2026]
+            self.assertEqual(len(transitions), 2)
+        finally:
+            if oldTZ is None:
+                os.environ.pop('TZ')
+            else:
+                os.environ['TZ'] = oldTZ
+            time.tzset()
+
+
+class TestSnapshots(_CalendarTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.events = GenerateEvents(300, seed=16, startDT=datetime.datetime(2026, 3, 2))
+        self.startDT, self.endDT = Window(self.events)
+        self.calendar = self.Synced(self.events)
+
+    def _Sync(self, events):
+        self.calendar.RegisterCalendarItems([self.calendar._MakeItem(e) for e in events], self.startDT, self.endDT)
+
+    def test_published_snapshots_dont_change(self):
+        before = self.calendar._snapshot
+        ids = list(before.items)
+        reviews = Ids(before.index.BySubject(partialMatch='Review'))  # builds the subject index before the changes
+        ranged = Ids(before.index.Range(self.startDT, self.endDT))
+
+        events = Mutate(self.events, 0.2, seed=16)
+        events = [dict(e, Subject='Review ' + e['Subject']) if i % 5 == 0 else e for i, e in enumerate(events)]
+        self._Sync(events)
+
+        self.assertIsNot(self.calendar._snapshot, before)
+        self.assertEqual(list(before.items), ids)
+        self.assertEqual(Ids(before.index.BySubject(partialMatch='Review')), reviews)
+        self.assertEqual(Ids(before.index.Range(self.startDT, self.endDT)), ranged)
+        self.assertEqual(len(self.calendar.GetAllEvents()), len(events))
+        self.assertEqual(
+            Ids(self.calendar.GetCalendarItemsBySubject(partialMatch='Review')),
+            [e['ItemId'] for e in events if 'Review' in e['Subject']],
+        )
+
+    def test_readers_see_whole_syncs(self):
+        changed = Mutate(self.events, 0.3, seed=17)
+        expected = {
+            frozenset(e['ItemId'] for e in self.events),
+            frozenset(e['ItemId'] for e in changed),
+        }
+        seen = set()
+        done = threading.Event()
+
+        def Read():
+            while not done.is_set():
+                seen.add(frozenset(Ids(self.calendar.GetEventsInRange(self.startDT, self.endDT, update=False))))
+
+        reader = threading.Thread(target=Read)
+        reader.start()
+        for i in range(20):
+            self._Sync(changed if i % 2 == 0 else self.events)
+        done.set()
+        reader.join()
+        self.assertLessEqual(seen, expected)
+
+    def test_layered_dict_is_a_dict(self):
+        rand = random.Random(16)
+        versions = []
+        layered = _ItemDict()
+        expected = {}
+        for step in range(5000):
+            if rand.random() < 0.02:
+                versions.append((layered, dict(expected)))
+                layered = layered.Copy()
+            key = rand.randrange(200)
+            roll = rand.random()
+            if roll < 0.3:
+                self.assertEqual(layered.pop(key, None), expected.pop(key, None))
+            elif roll < 0.35 and key in expected:
+                del layered[key]
+                del expected[key]
+            else:
+                layered[key] = step
+                expected[key] = step
+            self.assertEqual(layered[key], expected.get(key, None))
+
+        for layered, expected in versions + [(layered, expected)]:
+            self.assertEqual(list(layered.items()), list(expected.items()))
+            self.assertEqual(len(layered), len(expected))
+
+
+class TestCalendarItemsShim(_CalendarTestCase):
+    '''
+    self._calendarItems, for subclasses written against the old dict
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.events = GenerateEvents(20, seed=18, startDT=datetime.datetime(2026, 3, 2))
+        self.calendar = self.Synced(self.events, persistentStorage=self.path, persistenceMode='journal')
+        self.recorder = Recorder(self.calendar)
+        self.first, self.second = self.events[0]['ItemId'], self.events[1]['ItemId']
+
+    def test_reads(self):
+        calItems = self.calendar._calendarItems
+        self.assertEqual(len(calItems), 20)
+        self.assertEqual(list(calItems), [e['ItemId'] for e in self.events])
+        self.assertIn(self.first, calItems)
+        self.assertEqual(calItems[self.first].Get('ItemId'), self.first)
+        self.assertIsNone(calItems['missing'])
+        self.assertEqual(calItems.get('missing', 'default'), 'default')
+        self.assertEqual(len(calItems.copy()), 20)
+
+    def test_writes_are_committed_and_journaled(self):
+        calItems = self.calendar._calendarItems
+        moved = self.calendar._MakeItem(dict(self.events[2], Subject='Moved'))
+        calItems[moved.Get('ItemId')] = moved
+        del calItems[self.first]
+        self.assertEqual(calItems.pop(self.second).Get('ItemId'), self.second)
+        self.assertEqual(calItems.pop('missing', None), None)
+        with self.assertRaises(KeyError):
+            del calItems['missing']
+        with self.assertRaises(KeyError):
+            calItems['wrong id'] = moved
+
+        self.assertEqual(self.recorder.calls, [])
+        self.assertEqual(len(self.calendar.GetAllEvents()), 18)
+        self.assertEqual(self.calendar.GetCalendarItemByID(moved.Get('ItemId')).Get('Subject'), 'Moved')
+        self.assertEqual(Ids(self.calendar.GetCalendarItemsBySubject('Moved')), [moved.Get('ItemId')])
+
+        self.calendar.Flush()
+        reloaded = self.Calendar(persistentStorage=self.path, persistenceMode='journal')
+        self.assertEqual(sorted(Ids(reloaded.GetAllEvents())), sorted(Ids(self.calendar.GetAllEvents())))
+
+    def test_replace_and_clear(self):
+        kept = self.calendar.GetCalendarItemByID(self.first)
+        self.calendar._calendarItems = {self.first: kept}
+        self.assertEqual(Ids(self.calendar.GetAllEvents()), [self.first])
+
+        self.calendar._calendarItems.clear()
+        self.assertEqual(len(self.calendar.GetAllEvents()), 0)
+        self.assertEqual(self.calendar.GetEventsInRange(*Window(self.events), update=False), [])
+        self.assertEqual(self.recorder.calls, [])
+
+
+class TestDeltaSyncRetention(_CalendarTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.nowDT = datetime.datetime.now().replace(second=0, microsecond=0)
+        self.events = GenerateEvents(600, seed=2, startDT=self.nowDT - 30 * DAY, allDayEvery=0)
+        self.kwargs = dict(
+            persistentStorage=self.path,
+            persistenceMode='journal',
+            retainPast=7 * DAY,
+            retainFuture=14 * DAY,
+        )
+
+    def _Retained(self, events):
+        lowDT, highDT = self.nowDT - 7 * DAY, self.nowDT + 14 * DAY
+        return {e['ItemId'] for e in events if e['End'] >= lowDT and e['Start'] <= highDT}
+
+    def test_changes_and_retention(self):
+        calendar = self.Calendar(self.events, **self.kwargs)
+        calendar.UpdateCalendar()
+        self.assertEqual(set(calendar._calendarItems), self._Retained(self.events))
+
+        recorder = Recorder(calendar)
+        inside = {'ItemId': 'inside', 'Subject': 'New', 'Start': self.nowDT + DAY, 'End': self.nowDT + DAY + HOUR}
+        outside = {'ItemId': 'outside', 'Subject': 'Old', 'Start': self.nowDT - 20 * DAY, 'End': self.nowDT - 20 * DAY + HOUR}
+        deletedId = sorted(self._Retained(self.events))[0]
+        calendar.RegisterCalendarChanges(
+            [calendar._MakeItem(inside), calendar._MakeItem(outside)], [deletedId], syncToken='token1')
+
+        self.assertEqual(recorder.calls, [('New', 'inside'), ('Deleted', deletedId)])
+        self.assertEqual(calendar.SyncToken, 'token1')
+        self.assertIsNotNone(calendar.GetCalendarItemByID('inside'))
+        self.assertIsNone(calendar.GetCalendarItemByID('outside'))
+        self.assertIsNone(calendar.GetCalendarItemByID(deletedId))
+
+        calendar.Flush()
+        reloaded = self.Calendar(self.events, **self.kwargs)
+        self.assertEqual(set(reloaded._calendarItems), set(calendar._calendarItems))
+        self.assertEqual(reloaded.SyncToken, 'token1')
+
+    def test_cut_off_journal_keeps_the_older_token(self):
+        calendar = self.Calendar(self.events, **self.kwargs)
+        calendar.UpdateCalendar()
+        event = self.events[-1]
+        calendar.RegisterCalendarChanges([calendar._MakeItem(dict(event, Subject='First'))], syncToken='token1')
+        calendar.Flush()
+        calendar.RegisterCalendarChanges([calendar._MakeItem(dict(event, Subject='Second'))], syncToken='token2')
+        calendar.Flush()
+
+        # as if we lost power while appending the last change
+        journalPath = calendar._JournalPath(calendar._journalGeneration)
+        with open(journalPath, 'rb') as file:
+            lines = file.read().splitlines(keepends=True)
+        self.assertEqual(json.loads(lines[-1])['op'], 'meta')
+        self.assertEqual(json.loads(lines[-1])['syncToken'], 'token2')
+        with open(journalPath, 'wb') as file:
+            file.write(b''.join(lines[:-1]) + lines[-1][:10])
+
+        reloaded = self.Calendar(self.events, **self.kwargs)
+        self.assertEqual(reloaded.SyncToken, 'token1')
+
+    def test_item_moved_back_into_the_window_is_kept(self):
+        # an item that drifted out of the window is evicted by the same sync that brings it back, the new version wins
+        event = {'ItemId': 'A', 'Subject': 'x', 'Start': self.nowDT - 3 * DAY, 'End': self.nowDT - 3 * DAY + HOUR}
+        calendar = self.Calendar([event])
+        calendar.RegisterCalendarItems([calendar._MakeItem(event)], event['Start'], event['End'])
+        calendar._retainPast = DAY
+
+        moved = dict(event, Start=self.nowDT + DAY, End=self.nowDT + DAY + HOUR)
+        calendar.RegisterCalendarItems([calendar._MakeItem(moved)], self.nowDT - 5 * DAY, self.nowDT + 5 * DAY)
+        calItem = calendar.GetCalendarItemByID('A')
+        self.assertIsNotNone(calItem)
+        self.assertEqual(calItem.Get('Start'), moved['Start'])
+        self.assertEqual(calendar.GetEventAtTime(moved['Start'] + HOUR / 2), [calItem])
+
+    def _MovedOut(self, Move):
+        # an item in memory that the server moved outside the window is evicted, not left where it was
+        event = {'ItemId': 'A', 'Subject': 'x', 'Start': self.nowDT + DAY, 'End': self.nowDT + DAY + HOUR}
+        archivePath = os.path.join(self._tempDir.name, 'archive.json')
+        calendar = self.Calendar([event], retainFuture=60 * DAY, archiveFile=archivePath)
+        calendar.UpdateCalendar()
+        recorder = Recorder(calendar)
+
+        moved = dict(event, Start=self.nowDT + 90 * DAY, End=self.nowDT + 90 * DAY + HOUR)
+        Move(calendar, moved)
+        self.assertIsNone(calendar.GetCalendarItemByID('A'))
+        self.assertEqual(calendar.GetEventAtTime(event['Start'] + HOUR / 2), [])
+        self.assertEqual(calendar.GetEventsInRange(self.nowDT, self.nowDT + 60 * DAY, update=False), [])
+        self.assertEqual(recorder.calls, [])
+        with open(archivePath) as file:
+            archived, = [json.loads(line) for line in file]
+        self.assertEqual(archived['Start'], moved['Start'].timestamp())
+
+    def test_item_moved_out_of_the_window_is_evicted(self):
+        self._MovedOut(lambda calendar, moved: calendar.RegisterCalendarItems(
+            [calendar._MakeItem(moved)], self.nowDT, self.nowDT + 100 * DAY))
+
+    def test_change_moved_out_of_the_window_is_evicted(self):
+        self._MovedOut(lambda calendar, moved: calendar.RegisterCalendarChanges([calendar._MakeItem(moved)]))
+
+    def test_queued_move_out_of_the_window_is_evicted(self):
+        def Move(calendar, moved):
+            calendar.QueueChangeEventTime(calendar.GetCalendarItemByID('A'), moved['Start'], moved['End'])
+            self.assertTrue(calendar.WaitForWrites(5))
+            self.assertEqual(calendar.serverEvents['A']['Start'], moved['Start'])
+
+        self._MovedOut(Move)
+
+
+class TestTransitions(_CalendarTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.nowDT = datetime.datetime.now()
+        self.calls = []
+        self.changed = threading.Event()
+
+    def tearDown(self):
+        for calendar in self._calendars:
+            calendar._timerTransition.Stop()
+        super().tearDown()
+
+    def _Watch(self, calendar):
+        def Record(*call):
+            self.calls.append(call)
+            self.changed.set()
+
+        calendar.RoomStateChanged = lambda cal, state: Record('State', state)
+        calendar.EventStarted = lambda cal, calItem: Record('Started', calItem.Get('ItemId'))
+        calendar.EventEnded = lambda cal, calItem: Record('Ended', calItem.Get('ItemId'))
+
+    def _Sync(self, calendar, events):
+        calendar.RegisterCalendarItems([calendar._MakeItem(e) for e in events], self.nowDT - DAY, self.nowDT + DAY)
+
+    def _WaitFor(self, count):
+        endTime = time.monotonic() + 5
+        while len(self.calls) < count and time.monotonic() < endTime:
+            self.changed.wait(0.05)
+            self.changed.clear()
+        return self.calls
+
+    def test_in_progress(self):
+        event = {'ItemId': 'now', 'Subject': 'Now', 'Start': self.nowDT - HOUR, 'End': self.nowDT + HOUR / 6}
+        later = {'ItemId': 'later', 'Subject': 'Later', 'Start': self.nowDT + 3 * HOUR, 'End': self.nowDT + 4 * HOUR}
+        calendar = self.Calendar()
+        self._Watch(calendar)
+        self._Sync(calendar, [event, later])
+
+        self.assertEqual(self.calls, [('State', 'Vacant'), ('Started', 'now'), ('State', 'Occupied')])
+        self.assertEqual(calendar.RoomState, 'Occupied')
+        # the timer is armed for the end of the item in progress, not the start of the next one
+        self.assertAlmostEqual(calendar._timerTransition.Interval, 10 * 60, delta=5)
+
+    def test_in_progress_when_watching_starts(self):
+        event = {'ItemId': 'now', 'Subject': 'Now', 'Start': self.nowDT - HOUR, 'End': self.nowDT + HOUR}
+        calendar = self.Synced([event])
+        calendar.EventStarted = lambda cal, calItem: self.calls.append(('Started', calItem.Get('ItemId')))
+        self.assertEqual(self.calls, [('Started', 'now')])
+        self.assertEqual(calendar.RoomState, 'Occupied')
+
+    def test_start_and_end_are_timed(self):
+        calendar = self.Calendar()
+        self._Watch(calendar)
+        self._Sync(calendar, [{
+            'ItemId': 'short', 'Subject': 'Short',
+            'Start': self.nowDT + datetime.timedelta(seconds=0.3),
+            'End': self.nowDT + datetime.timedelta(seconds=0.6),
+        }])
+        self.assertEqual(self.calls, [('State', 'Vacant')])
+
+        self.assertEqual(self._WaitFor(5), [
+            ('State', 'Vacant'),
+            ('Started', 'short'), ('State', 'Occupied'),
+            ('Ended', 'short'), ('State', 'Vacant'),
+        ])
+
+    def test_deleting_an_item_in_progress_ends_it(self):
+        event = {'ItemId': 'now', 'Subject': 'Now', 'Start': self.nowDT - HOUR, 'End': self.nowDT + HOUR}
+        calendar = self.Calendar()
+        self._Watch(calendar)
+        self._Sync(calendar, [event])
+        self._Sync(calendar, [])
+
+        self.assertEqual(self.calls, [
+            ('State', 'Vacant'),
+            ('Started', 'now'), ('State', 'Occupied'),
+            ('Ended', 'now'), ('State', 'Vacant'),
+        ])
+        self.assertEqual(calendar._timerTransition.State, 'Stopped')  # nothing left to wait for
+
+
+class TestExport(_CalendarTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.startDT = datetime.datetime(2026, 3, 2)
+        self.events = GenerateEvents(100, seed=23, startDT=self.startDT)
+        self.calendar = self.Synced(self.events)
+
+    def test_ndjson_matches_dict(self):
+        lines = list(self.calendar.ExportNDJSON())
+        calItems = list(self.calendar.GetAllEvents())
+        self.assertEqual([json.loads(line) for line in lines], [calItem.dict() for calItem in calItems])
+
+    def test_ndjson_doesnt_fill_the_caches(self):
+        for line in self.calendar.ExportNDJSON():
+            pass
+        self.assertTrue(all(calItem._dataCache is None for calItem in self.calendar.GetAllEvents()))
+
+    def test_ndjson_window_and_keys(self):
+        endDT = self.startDT + 2 * DAY
+        lines = self.calendar.ExportNDJSON(self.startDT, endDT, keys=('ItemId', 'Start'))
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            [{'ItemId': c.Get('ItemId'), 'Start': c.Get('Start').timestamp()}
+             for c in self.calendar.GetEventsInRange(self.startDT, endDT, update=False)],
+        )
+
+    def test_ndjson_is_one_snapshot(self):
+        lines = self.calendar.ExportNDJSON()
+        first = next(lines)
+        self.calendar.RegisterCalendarItems([], *Window(self.events))  # deletes everything
+        self.assertEqual(len([first] + list(lines)), 100)
+        self.assertEqual(list(self.calendar.ExportNDJSON()), [])
+
+    def test_columns(self):
+        endDT = self.startDT + 3 * DAY
+        columns = self.calendar.ExportColumns(self.startDT, endDT, keys=('ItemId', 'Subject', 'Missing'))
+        calItems = sorted(self.calendar.GetEventsInRange(self.startDT, endDT, update=False), key=lambda c: c.Get('Start'))
+
+        self.assertEqual(list(columns['Start']), [c.Get('Start').timestamp() for c in calItems])
+        self.assertEqual(list(columns['End']), [c.Get('End').timestamp() for c in calItems])
+        self.assertEqual(columns['ItemId'], Ids(calItems))
+        self.assertEqual(columns['Subject'], [c.Get('Subject') for c in calItems])
+        self.assertEqual(columns['Missing'], [None] * len(calItems))
+
+    def test_columns_of_items_loaded_from_a_binary_snapshot(self):
+        calendar = self.Synced(self.events, persistentStorage=self.path, snapshotFormat='binary')
+        calendar.Flush()
+        reloaded = self.Calendar(persistentStorage=self.path, snapshotFormat='binary')
+
+        keys = ('ItemId', 'Subject', 'OrganizerName')
+        endDT = self.startDT + 3 * DAY
+        self.assertEqual(
+            reloaded.ExportColumns(self.startDT, endDT, keys=keys),
+            self.calendar.ExportColumns(self.startDT, endDT, keys=keys),
+        )
+
+
+class TestRecurrence(_CalendarTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.firstDT = datetime.datetime(2026, 3, 2, 9, 0)  # a Monday
+        self.master = {
+            'ItemId': 'series', 'Subject': 'Standup', 'Start': self.firstDT, 'End': self.firstDT + HOUR / 2,
+            'Recurrence': {'Freq': 'WEEKLY', 'ByDay': [0, 2], 'Count': 6},
+        }
+
+    def test_at_with_only_a_series(self):
+        calendar = self.Synced([self.master])
+        wednesdayDT = self.firstDT + 2 * DAY
+
+        found = calendar.GetEventAtTime(wednesdayDT.date())
+        self.assertEqual([calItem.Get('Start') for calItem in found], [wednesdayDT])
+        found = calendar.GetEventAtTime(wednesdayDT + HOUR / 4)
+        self.assertEqual([calItem.Get('Start') for calItem in found], [wednesdayDT])
+        self.assertEqual(calendar.GetEventAtTime(self.firstDT + DAY), [])  # a Tuesday
+
+    def test_at_date_with_aware_series(self):
+        tz = datetime.timezone(datetime.timedelta(hours=-5))
+        firstDT = self.firstDT.replace(tzinfo=tz)
+        master = dict(self.master, Start=firstDT, End=firstDT + HOUR / 2)
+        calendar = self.Synced([master])
+
+        found = calendar._index.At(firstDT.date())
+        self.assertEqual([calItem.Get('Start') for calItem in found], [firstDT])
+
+    def test_occurrence_data(self):
+        calendar = self.Synced([self.master])
+        occurrenceDT = self.firstDT + 7 * DAY
+
+        occurrence, = calendar.GetEventAtTime(occurrenceDT)
+        data = occurrence.Data
+        self.assertEqual(data['SeriesId'], 'series')
+        self.assertEqual(data['ItemId'], 'series_{}'.format(round(occurrenceDT.timestamp())))
+        self.assertNotIn('Recurrence', data)
+        self.assertEqual(data['Start_ISO'], occurrenceDT.isoformat())
+        self.assertEqual(data['End_ISO'], (occurrenceDT + HOUR / 2).isoformat())
+        self.assertEqual(data['Subject'], 'Standup')
+
+    def test_range_mixes_series_and_items(self):
+        meeting = {'ItemId': 'meeting', 'Subject': 'Review', 'Start': self.firstDT + HOUR, 'End': self.firstDT + 2 * HOUR}
+        calendar = self.Synced([self.master, meeting])
+
+        found = calendar.GetEventsInRange(self.firstDT, self.firstDT + 7 * DAY, update=False)
+        self.assertEqual(
+            [calItem.Get('Start') for calItem in found],
+            [self.firstDT, self.firstDT + 2 * DAY, self.firstDT + 7 * DAY, self.firstDT + HOUR],
+        )
+
+
+class TestAttachmentSpill(unittest.TestCase):
+
+    def test_files_from_before_a_restart_are_deleted(self):
+        with tempfile.TemporaryDirectory() as spillPath:
+            for filename in ('room1-0123.attachment', 'room1-4567.attachment', 'room2-89ab.attachment', 'notes.txt'):
+                with open(os.path.join(spillPath, filename), 'w') as file:
+                    file.write('old')
+
+            _AttachmentCache(1024, spillPath=spillPath, spillMaxBytes=4096, spillPrefix='room1-')
+            self.assertEqual(sorted(os.listdir(spillPath)), ['notes.txt', 'room2-89ab.attachment'])
+
+    def test_caches_share_the_directory(self):
+        with tempfile.TemporaryDirectory() as spillPath:
+            first = _AttachmentCache(4, spillPath=spillPath, spillMaxBytes=4096, spillPrefix='room1-')
+            for i in range(3):
+                first.Read(('item', i), lambda: b'1234')  # each one pushes the one before to disk
+            self.assertEqual(len(os.listdir(spillPath)), 2)
+
+            _AttachmentCache(4, spillPath=spillPath, spillMaxBytes=4096, spillPrefix='room2-')
+            self.assertEqual(first.Read(('item', 0), lambda: b'gone'), b'1234')
+            self.assertEqual(first.Stats['diskHits'], 1)
+
+    def test_off_by_default(self):
+        calendar = InMemoryCalendar()
+        calendar._timerSaveToFile.Stop()
+        self.assertIsNone(calendar._attachmentCache)
+        self.assertEqual(calendar.AttachmentCacheStats, {})
+
+
+class FlakyCalendar(InMemoryCalendar):
+    '''
+    Rejects the writes for the ItemIds in .reject and raises IOError for the next .failures writes
+    '''
+
+    def __init__(self, *a, **k):
+        self.reject = set()
+        self.failures = 0
+        self.delay = 0.01  # seconds each write takes
+        super().__init__(*a, **k)
+
+    def _Check(self, itemId):
+        if self.delay:
+            time.sleep(self.delay)
+        if itemId in self.reject:
+            raise WriteRejected('rejected {}'.format(itemId))
+        if self.failures:
+            self.failures -= 1
+            raise IOError('timed out')
+
+    def ChangeEventTime(self, calItem, newStartDT, newEndDT):
+        self._Check(calItem.Get('ItemId'))
+        super().ChangeEventTime(calItem, newStartDT, newEndDT)
+
+    def DeleteEvent(self, calItem):
+        self._Check(calItem.Get('ItemId'))
+        super().DeleteEvent(calItem)
+
+
+class TestWriteQueueRollback(_CalendarTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.events = GenerateEvents(20, seed=3)
+        self.calendar = FlakyCalendar(self.events, writeBackoff=0.01, writeMaxAttempts=3)
+        self._calendars.append(self.calendar)
+        self.calendar.UpdateCalendar()
+        self.failed = []
+        self.calendar.WriteFailed = lambda cal, kind, item, e: self.failed.append((kind, item.Get('ItemId')))
+        self.itemId = self.events[0]['ItemId']
+        self.original = self.calendar.GetCalendarItemByID(self.itemId)
+
+    def _Move(self):
+        self.calendar.QueueChangeEventTime(
+            self.original, self.original.Get('Start') + HOUR, self.original.Get('End') + HOUR)
+        self.assertEqual(self.calendar.GetCalendarItemByID(self.itemId).Get('Start'), self.original.Get('Start') + HOUR)
+
+    def test_rejected_change_is_rolled_back(self):
+        self.calendar.reject.add(self.itemId)
+        recorder = Recorder(self.calendar)
+        self._Move()
+        self.assertTrue(self.calendar.WaitForWrites(5))
+
+        self.assertEqual(self.calendar.GetCalendarItemByID(self.itemId).Fingerprint, self.original.Fingerprint)
+        self.assertEqual(self.failed, [('Change', self.itemId)])
+        self.assertEqual(recorder.calls, [('Changed', self.itemId), ('Changed', self.itemId)])
+
+    def test_immediate_rejection_is_rolled_back(self):
+        # the server answers while the change is still being applied in memory, the rollback must still win
+        self.calendar.delay = 0
+        self.calendar.reject.add(self.itemId)
+        applyLocally = self.calendar._ApplyLocally
+
+        def SlowApply(itemId, calItem):
+            if calItem.Fingerprint != self.original.Fingerprint:
+                time.sleep(0.05)  # only the change, not its rollback
+            applyLocally(itemId, calItem)
+
+        self.calendar._ApplyLocally = SlowApply
+        for i in range(3):
+            self.calendar.QueueChangeEventTime(
+                self.original, self.original.Get('Start') + HOUR, self.original.Get('End') + HOUR)
+            self.assertTrue(self.calendar.WaitForWrites(5))
+            self.assertEqual(self.calendar.GetCalendarItemByID(self.itemId).Fingerprint, self.original.Fingerprint)
+        self.assertEqual(self.failed, [('Change', self.itemId)] * 3)
+
+    def test_rejected_delete_is_rolled_back(self):
+        self.calendar.reject.add(self.itemId)
+        self.calendar.QueueDeleteEvent(self.original)
+        self.assertIsNone(self.calendar.GetCalendarItemByID(self.itemId))
+        self.assertTrue(self.calendar.WaitForWrites(5))
+
+        self.assertEqual(self.calendar.GetCalendarItemByID(self.itemId).Fingerprint, self.original.Fingerprint)
+        self.assertEqual(self.failed, [('Delete', self.itemId)])
+
+    def test_retries_then_rolls_back(self):
+        self.calendar.failures = 100
+        self._Move()
+        self.assertTrue(self.calendar.WaitForWrites(5))
+        self.calendar.failures = 0
+
+        self.assertEqual(self.calendar.GetCalendarItemByID(self.itemId).Fingerprint, self.original.Fingerprint)
+        self.assertEqual(self.failed, [('Change', self.itemId)])
+        self.assertEqual(self.calendar.WriteStats['retries'], 2)
+
+    def test_retry_succeeds(self):
+        self.calendar.failures = 1
+        self._Move()
+        self.assertTrue(self.calendar.WaitForWrites(5))
+
+        self.assertEqual(self.failed, [])
+        self.assertEqual(self.calendar.serverEvents[self.itemId]['Start'], self.original.Get('Start') + HOUR)
+
+    def test_sync_does_not_revert_a_pending_write(self):
+        self.calendar.failures = 1  # keeps the write pending for one backoff
+        self._Move()
+        self.calendar.UpdateCalendar()
+        self.assertEqual(self.calendar.GetCalendarItemByID(self.itemId).Get('Start'), self.original.Get('Start') + HOUR)
+        self.assertTrue(self.calendar.WaitForWrites(5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+'''
+Tests for gs_calendar_freebusy, see test_calendar_base.py
+'''
+import asyncio
+import datetime
+import unittest
+from unittest import mock
+
+from benchmarks import stubs
+
+stubs.Install()
+
+import gs_calendar_freebusy  # noqa: E402
+from gs_calendar_freebusy import FreeBusy  # noqa: E402
+from benchmarks.mock_calendar import InMemoryCalendar  # noqa: E402
+from benchmarks.synthetic import GenerateEvents  # noqa: E402
+from tests.test_calendar_async import AsyncCalendar  # noqa: E402
+
+MINUTE = datetime.timedelta(minutes=1)
+HOUR = datetime.timedelta(hours=1)
+
+
+def FreeGaps(events, startDT, endDT, duration):
+    # the free gaps of one room by walking its events in order
+    gaps = []
+    cursorDT = startDT
+    for event in sorted(events, key=lambda e: e['Start']):
+        if event['End'] <= startDT or event['Start'] >= endDT:
+            continue
+        if event['Start'] - cursorDT >= duration:
+            gaps.append((cursorDT, event['Start']))
+        cursorDT = max(cursorDT, event['End'])
+    if endDT - cursorDT >= duration:
+        gaps.append((cursorDT, endDT))
+    return gaps
+
+
+class TestFreeBusy(unittest.TestCase):
+    numpy = gs_calendar_freebusy.numpy  # what is installed, the subclass below runs without it
+
+    def setUp(self):
+        patcher = mock.patch.object(gs_calendar_freebusy, 'numpy', self.numpy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.dayDT = datetime.datetime(2026, 3, 2)
+        self.startDT = self.dayDT + 8 * HOUR
+        self.endDT = self.dayDT + 18 * HOUR
+        self.rooms = {}
+        self.events = {}
+        for i in range(6):
+            events = GenerateEvents(8 * i, seed=i, startDT=self.dayDT, allDayEvery=0)
+            calendar = InMemoryCalendar(events)
+            calendar._timerSaveToFile.Stop()
+            if events:
+                calendar.RegisterCalendarItems(
+                    [calendar._MakeItem(e) for e in events], self.dayDT - HOUR, self.dayDT + 30 * HOUR)
+            self.rooms['Room {}'.format(i)] = calendar
+            self.events['Room {}'.format(i)] = events
+
+        self.freeBusy = FreeBusy(self.rooms)
+        self.freeBusy.Refresh(self.startDT, self.endDT)
+
+    def test_free_slots(self):
+        for duration in (15 * MINUTE, 30 * MINUTE, 2 * HOUR, 12 * HOUR):
+            found = self.freeBusy.FindFreeSlots(duration)
+            for room, events in self.events.items():
+                self.assertEqual(found[room], FreeGaps(events, self.startDT, self.endDT, duration), (room, duration))
+
+    def test_free_slots_in_part_of_the_window(self):
+        startDT, endDT = self.startDT + 2 * HOUR, self.startDT + 6 * HOUR
+        found = self.freeBusy.FindFreeSlots(30 * MINUTE, startDT, endDT)
+        for room, events in self.events.items():
+            self.assertEqual(found[room], FreeGaps(events, startDT, endDT, 30 * MINUTE))
+
+    def test_first_free_slot(self):
+        found = self.freeBusy.FirstFreeSlot(HOUR)
+        expected = []
+        for room, events in self.events.items():
+            gaps = FreeGaps(events, self.startDT, self.endDT, HOUR)
+            if gaps:
+                expected.append((room, gaps[0][0], gaps[0][0] + HOUR))
+        bySoonest = lambda slot: (slot[1], slot[0])  # noqa: E731
+        self.assertEqual(sorted(found, key=bySoonest), sorted(expected, key=bySoonest))
+        self.assertEqual([slot[1] for slot in found], sorted(slot[1] for slot in found))
+
+    def test_availability_matrix(self):
+        slotStarts, rooms, matrix = self.freeBusy.AvailabilityMatrix(30 * MINUTE)
+        self.assertEqual(rooms, list(self.rooms))
+        self.assertEqual(slotStarts[0], self.startDT)
+        self.assertEqual(len(slotStarts), 20)
+
+        for roomIndex, room in enumerate(rooms):
+            for slotIndex, slotStartDT in enumerate(slotStarts):
+                slotEndDT = slotStartDT + 30 * MINUTE
+                free = not any(e['Start'] < slotEndDT and e['End'] > slotStartDT for e in self.events[room])
+                self.assertEqual(bool(matrix[roomIndex][slotIndex]), free, (room, slotStartDT))
+
+    def test_busy_intervals(self):
+        events = [
+            {'ItemId': 'a', 'Subject': 'A', 'Start': self.startDT - HOUR, 'End': self.startDT + HOUR},
+            {'ItemId': 'b', 'Subject': 'B', 'Start': self.startDT + HOUR, 'End': self.startDT + 2 * HOUR},
+            {'ItemId': 'c', 'Subject': 'C', 'Start': self.startDT + 90 * MINUTE, 'End': self.startDT + 3 * HOUR},
+            {'ItemId': 'd', 'Subject': 'D', 'Start': self.endDT - HOUR, 'End': self.endDT + HOUR},
+        ]
+        calendar = InMemoryCalendar(events)
+        calendar._timerSaveToFile.Stop()
+        calendar.RegisterCalendarItems([calendar._MakeItem(e) for e in events], self.dayDT, self.dayDT + 30 * HOUR)
+        freeBusy = FreeBusy([calendar])
+        freeBusy.Refresh(self.startDT, self.endDT)
+
+        self.assertEqual(freeBusy.BusyIntervals(calendar), [
+            (self.startDT, self.startDT + 3 * HOUR),
+            (self.endDT - HOUR, self.endDT),
+        ])
+
+
+class TestFreeBusyAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.dayDT = datetime.datetime(2026, 3, 2)
+        self.startDT = self.dayDT + 8 * HOUR
+        self.endDT = self.dayDT + 18 * HOUR
+        self.events = GenerateEvents(30, seed=3, startDT=self.dayDT, allDayEvery=0)
+        self.asyncCalendar = AsyncCalendar(self.events)
+        self.calendar = InMemoryCalendar(self.events)
+        for calendar in (self.asyncCalendar, self.calendar):
+            calendar._timerSaveToFile.Stop()
+
+    def _Check(self, freeBusy):
+        expected = FreeGaps(self.events, self.startDT, self.endDT, 30 * MINUTE)
+        self.assertEqual(freeBusy.FindFreeSlots(30 * MINUTE), {'async': expected, 'sync': expected})
+
+    def test_refresh_from_memory(self):
+        asyncio.run(self.asyncCalendar.UpdateCalendar())
+        self.calendar.UpdateCalendar()
+        freeBusy = FreeBusy({'async': self.asyncCalendar, 'sync': self.calendar})
+        freeBusy.Refresh(self.startDT, self.endDT)
+        self._Check(freeBusy)
+
+    def test_refresh_async_updates_both_kinds(self):
+        freeBusy = FreeBusy({'async': self.asyncCalendar, 'sync': self.calendar}, update=True)
+        with self.assertRaises(TypeError):
+            freeBusy.Refresh(self.startDT, self.endDT)
+
+        asyncio.run(freeBusy.RefreshAsync(self.startDT, self.endDT))
+        self._Check(freeBusy)
+
+
+@unittest.skipIf(gs_calendar_freebusy.numpy is None, 'numpy is not installed, TestFreeBusy already ran without it')
+class TestFreeBusyWithoutNumpy(TestFreeBusy):
+    numpy = None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+'''
+Tests for gs_calendar_pool, see test_calendar_base.py
+'''
+import datetime
+import threading
+import time
+import unittest
+
+from benchmarks import stubs
+
+stubs.Install()
+
+from gs_calendar_pool import CalendarPool  # noqa: E402
+
+
+class PolledCalendar:
+    '''
+    Just what the pool uses of a calendar, UpdateCalendar remembers when and how it was called
+    '''
+    running = 0
+    mostRunning = 0
+    lock = threading.Lock()
+
+    def __init__(self, name, duration=0.01, gate=None):
+        self.name = name
+        self.duration = duration
+        self.gate = gate  # a threading.Event to wait for in UpdateCalendar
+        self.calls = []
+        self.formatted = 0  # times str() was called
+        self.LastUpdated = 0
+
+    def UpdateCalendar(self, startDT=None, endDT=None):
+        with self.lock:
+            PolledCalendar.running += 1
+            PolledCalendar.mostRunning = max(PolledCalendar.mostRunning, PolledCalendar.running)
+        try:
+            if self.gate:
+                self.gate.wait(5)
+            time.sleep(self.duration)
+            self.calls.append((time.monotonic(), startDT, endDT))
+            self.LastUpdated = time.time()
+        finally:
+            with self.lock:
+                PolledCalendar.running -= 1
+
+    def __str__(self):
+        self.formatted += 1
+        return self.name
+
+
+def WaitFor(condition, timeout=5):
+    endTime = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > endTime:
+            raise AssertionError('timed out')
+        time.sleep(0.005)
+
+
+class TestCalendarPool(unittest.TestCase):
+
+    def setUp(self):
+        PolledCalendar.running = 0
+        PolledCalendar.mostRunning = 0
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.Stop()
+        # a poll that was already running finishes on its own, it must not count in the next test
+        WaitFor(lambda: PolledCalendar.running == 0)
+
+    def Pool(self, **kwargs):
+        pool = CalendarPool(**kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def test_polls_every_calendar_with_bounded_workers(self):
+        pool = self.Pool(maxWorkers=3, interval=0.1)
+        calendars = [PolledCalendar('room{}'.format(i), duration=0.02) for i in range(12)]
+        for calendar in calendars:
+            pool.Add(calendar)
+        pool.Start()
+
+        WaitFor(lambda: all(len(calendar.calls) >= 2 for calendar in calendars))
+        self.assertLessEqual(PolledCalendar.mostRunning, 3)
+
+        freshness = pool.Freshness
+        self.assertEqual(freshness['count'], 12)
+        self.assertEqual(freshness['neverUpdated'], 0)
+        self.assertLess(freshness['oldest'], 1)
+        self.assertEqual(pool.GetStale(60), [])
+
+    def test_priority_jumps_the_queue(self):
+        pool = self.Pool(maxWorkers=1, interval=60)
+        gate = threading.Event()
+        blocker = PolledCalendar('blocker', gate=gate)
+        pool.Add(blocker)
+        pool.Start()
+        pool.UpdateNow(blocker)
+        WaitFor(lambda: PolledCalendar.running == 1)
+
+        # all of these are ready while the only worker is busy
+        low = [PolledCalendar('low{}'.format(i)) for i in range(3)]
+        high = PolledCalendar('high')
+        for calendar in low:
+            pool.Add(calendar)
+        pool.Add(high, priority=10)
+        pool.UpdateNow()
+        time.sleep(0.05)  # let the scheduler move them to the ready queue
+        gate.set()
+
+        WaitFor(lambda: high.calls and all(calendar.calls for calendar in low))
+        self.assertLess(high.calls[0][0], min(calendar.calls[0][0] for calendar in low))
+
+    def test_window(self):
+        pool = self.Pool(maxWorkers=1, interval=60, window=(datetime.timedelta(days=1), datetime.timedelta(days=7)))
+        calendar = PolledCalendar('room')
+        pool.Add(calendar)
+        pool.Start()
+        pool.UpdateNow(calendar)
+
+        WaitFor(lambda: calendar.calls)
+        callTime, startDT, endDT = calendar.calls[0]
+        self.assertEqual(endDT - startDT, datetime.timedelta(days=8))
+
+    def test_stop_and_start_again(self):
+        pool = self.Pool(maxWorkers=2, interval=0.05)
+        calendar = PolledCalendar('room')
+        pool.Add(calendar)
+        pool.Start()
+        WaitFor(lambda: len(calendar.calls) >= 2)
+
+        pool.Stop()
+        time.sleep(0.05)  # a poll that was already running may finish
+        count = len(calendar.calls)
+        time.sleep(0.2)
+        self.assertEqual(len(calendar.calls), count)
+
+        pool.Start()
+        WaitFor(lambda: len(calendar.calls) >= count + 2)
+
+    def test_remove(self):
+        pool = self.Pool(maxWorkers=1, interval=0.05)
+        calendar = PolledCalendar('room')
+        pool.Add(calendar)
+        pool.Start()
+        WaitFor(lambda: calendar.calls)
+
+        pool.Remove(calendar)
+        time.sleep(0.05)
+        count = len(calendar.calls)
+        time.sleep(0.2)
+        self.assertEqual(len(calendar.calls), count)
+        self.assertEqual(pool.Calendars, [])
+
+    def test_no_formatting_without_debug(self):
+        pool = self.Pool(maxWorkers=1, interval=0.02)
+        calendar = PolledCalendar('room')
+        pool.Add(calendar)
+        pool.Start()
+        WaitFor(lambda: len(calendar.calls) >= 3)
+        self.assertEqual(calendar.formatted, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()